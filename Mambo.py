@@ -8,6 +8,33 @@ from bluepy.btle import Peripheral, UUID, DefaultDelegate, BTLEException
 import untangle
 import struct
 import time
+import collections
+import math
+import threading
+from MamboMetrics import MamboMetrics, COUNT_BUCKETS
+from MamboFTP import MamboFTP
+from MamboLatency import MamboLatencyTracker
+from MamboTracer import MamboTracer
+
+# immutable snapshots of the sensors (see MamboSensors.snapshot).  Each group is filled in from one BLE packet.
+SpeedSnapshot = collections.namedtuple("SpeedSnapshot", ("speed_x", "speed_y", "speed_z", "speed_ts", "receive_time"))
+AltitudeSnapshot = collections.namedtuple("AltitudeSnapshot", ("altitude", "altitude_ts", "receive_time"))
+QuaternionSnapshot = collections.namedtuple("QuaternionSnapshot", ("quaternion_w", "quaternion_x", "quaternion_y",
+                                                                   "quaternion_z", "quaternion_ts", "receive_time"))
+StateSnapshot = collections.namedtuple("StateSnapshot", ("battery", "flying_state", "claw_id", "claw_state",
+                                                         "gun_id", "gun_state", "receive_time"))
+SensorSnapshot = collections.namedtuple("SensorSnapshot", ("speed", "altitude", "quaternion", "state"))
+
+# the snapshot group updated by each sensor message
+SNAPSHOT_GROUPS = {
+    'DroneSpeed': 'speed',
+    'DroneAltitude': 'altitude',
+    'DroneQuaternion': 'quaternion',
+    'BatteryStateChanged': 'state',
+    'FlyingStateChanged': 'state',
+    'ClawState': 'state',
+    'GunState': 'state',
+}
 
 class MamboDelegate(DefaultDelegate):
     """
@@ -25,7 +52,13 @@ class MamboDelegate(DefaultDelegate):
         #print "channel map is %s " % self.mambo.characteristic_receive_uuids[self.handle_map[cHandle]]
         #print "data is %s " % data
 
-        channel = self.mambo.characteristic_receive_uuids[self.handle_map[cHandle]]
+        hex_str = self.handle_map[cHandle]
+        if hex_str in self.mambo.characteristic_ftp_uuids:
+            # FTP replies (file listings and downloads)
+            self.mambo._ftp_notification(self.mambo.characteristic_ftp_uuids[hex_str], data)
+            return
+
+        channel = self.mambo.characteristic_receive_uuids[hex_str]
         if channel == 'ACK_DRONE_DATA':
             # data received from drone (needs to be ack on 1e)
             self.mambo._update_sensors(data, ack=True)
@@ -82,6 +115,26 @@ class MamboSensors:
         self.quaternion_z = 0
         self.quaternion_ts = 0
 
+        # consistent copy of the sensors for other threads, replaced as a whole after each packet
+        self.snapshot = SensorSnapshot(SpeedSnapshot(0, 0, 0, 0, None), AltitudeSnapshot(0, 0, None),
+                                       QuaternionSnapshot(0, 0, 0, 0, 0, None),
+                                       StateSnapshot(self.battery, self.flying_state, self.claw_id, self.claw_state,
+                                                     self.gun_id, self.gun_state, None))
+
+        # derived state is computed lazily when it is read and the cache is cleared when
+        # the sensors it depends on change (see the attitude, world_velocity and position properties)
+        self._attitude = None
+        self._world_velocity = None
+
+        # dead reckoning integrates the speed samples that arrived since the position was last read
+        self._position = [0.0, 0.0]
+        self._pending_speeds = list()
+        self._last_speed_ts = None
+        self.max_pending_speeds = 64
+
+        # gaps in the speed samples longer than this (seconds) are not integrated
+        self.max_dead_reckoning_gap = 1.0
+
     def update(self, name, value, sensor_enum):
         """
         Update the sensor
@@ -114,47 +167,257 @@ class MamboSensors:
             self.gun_state = value
         elif (name == "DroneSpeed_speed_x"):
             self.speed_x = value
+            self._world_velocity = None
         elif (name == "DroneSpeed_speed_y"):
             self.speed_y = value
+            self._world_velocity = None
         elif (name == "DroneSpeed_speed_z"):
             self.speed_z = value
+            self._world_velocity = None
         elif (name == "DroneSpeed_ts"):
+            # the timestamp is the last argument of DroneSpeed so the sample is complete now
             self.speed_ts = value
+            self._pending_speeds.append((value, self.speed_x, self.speed_y, self.speed_z,
+                                         self.quaternion_w, self.quaternion_x, self.quaternion_y, self.quaternion_z))
+            if (len(self._pending_speeds) > self.max_pending_speeds):
+                self._integrate_pending_speeds()
         elif (name == "DroneAltitude_altitude"):
             self.altitude = value
-        elif (name == "DroneAltitude_altitude_ts"):
+        elif (name == "DroneAltitude_ts"):
             self.altitude_ts = value
         elif (name == "DroneQuaternion_q_w"):
             self.quaternion_w = value
+            self._attitude = None
+            self._world_velocity = None
         elif (name == "DroneQuaternion_q_x"):
             self.quaternion_x = value
+            self._attitude = None
+            self._world_velocity = None
         elif (name == "DroneQuaternion_q_y"):
             self.quaternion_y = value
+            self._attitude = None
+            self._world_velocity = None
         elif (name == "DroneQuaternion_q_z"):
             self.quaternion_z = value
-        elif (name == "DroneQuaternion_tz"):
+            self._attitude = None
+            self._world_velocity = None
+        elif (name == "DroneQuaternion_ts"):
             self.quaternion_ts = value
         else:
             #print "new sensor - add me to the struct but saving in the dict for now"
             self.unknown_sensors[name] = value
 
+    def publish_snapshot(self, message, receive_time):
+        """
+        Replace the snapshot group a sensor message belongs to (called after each packet is decoded).  Readers on
+        other threads should use self.snapshot: it is immutable and swapped in with a single assignment so it is
+        never torn and the BLE thread never waits for them.
+
+        :param message: name of the sensor message (e.g. DroneSpeed)
+        :param receive_time: time the packet was received
+        """
+        group = SNAPSHOT_GROUPS.get(message)
+        if (group == 'speed'):
+            value = SpeedSnapshot(self.speed_x, self.speed_y, self.speed_z, self.speed_ts, receive_time)
+        elif (group == 'altitude'):
+            value = AltitudeSnapshot(self.altitude, self.altitude_ts, receive_time)
+        elif (group == 'quaternion'):
+            value = QuaternionSnapshot(self.quaternion_w, self.quaternion_x, self.quaternion_y, self.quaternion_z,
+                                       self.quaternion_ts, receive_time)
+        elif (group == 'state'):
+            value = StateSnapshot(self.battery, self.flying_state, self.claw_id, self.claw_state, self.gun_id,
+                                  self.gun_state, receive_time)
+        else:
+            return
+        self.snapshot = self.snapshot._replace(**{group: value})
+
+    def _quaternion_to_euler(self, w, x, y, z):
+        """
+        Convert the quaternion (rotation from the NED frame to the body frame) to euler angles
+
+        :return: (roll, pitch, yaw) in radians
+        """
+        roll = math.atan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + y * y))
+        pitch = math.asin(max(-1.0, min(1.0, 2.0 * (w * y - z * x))))
+        yaw = math.atan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z))
+        return (roll, pitch, yaw)
+
+    @property
+    def attitude(self):
+        """
+        Euler angles from the last quaternion (cached until the quaternion changes)
+
+        :return: (roll, pitch, yaw) in radians
+        """
+        if (self._attitude is None):
+            self._attitude = self._quaternion_to_euler(self.quaternion_w, self.quaternion_x,
+                                                       self.quaternion_y, self.quaternion_z)
+        return self._attitude
+
+    @property
+    def roll(self):
+        """
+        :return: roll in degrees (positive is right side down)
+        """
+        return math.degrees(self.attitude[0])
+
+    @property
+    def pitch(self):
+        """
+        :return: pitch in degrees (positive is nose up)
+        """
+        return math.degrees(self.attitude[1])
+
+    @property
+    def yaw(self):
+        """
+        :return: yaw in degrees [-180, 180] relative to the orientation at startup
+        """
+        return math.degrees(self.attitude[2])
+
+    @property
+    def heading(self):
+        """
+        :return: heading in degrees [0, 360) relative to the orientation at startup
+        """
+        return self.yaw % 360.0
+
+    @property
+    def world_velocity(self):
+        """
+        Speed rotated from the drone's heading frame into the world frame (cached until the speed or
+        quaternion changes)
+
+        :return: (north, east, down) in m/s
+        """
+        if (self._world_velocity is None):
+            yaw = self.attitude[2]
+            (cos_yaw, sin_yaw) = (math.cos(yaw), math.sin(yaw))
+            self._world_velocity = (cos_yaw * self.speed_x - sin_yaw * self.speed_y,
+                                    sin_yaw * self.speed_x + cos_yaw * self.speed_y,
+                                    self.speed_z)
+        return self._world_velocity
+
+    def _integrate_pending_speeds(self):
+        """
+        Fold the speed samples received since the last read into the dead reckoned position
+        """
+        for (ts, speed_x, speed_y, speed_z, w, x, y, z) in self._pending_speeds:
+            if (self._last_speed_ts is not None):
+                # timestamps are in ms and wrap at 16 bits
+                dt = ((ts - self._last_speed_ts) % 65536) / 1000.0
+                if (dt <= self.max_dead_reckoning_gap):
+                    yaw = self._quaternion_to_euler(w, x, y, z)[2]
+                    (cos_yaw, sin_yaw) = (math.cos(yaw), math.sin(yaw))
+                    self._position[0] += (cos_yaw * speed_x - sin_yaw * speed_y) * dt
+                    self._position[1] += (sin_yaw * speed_x + cos_yaw * speed_y) * dt
+            self._last_speed_ts = ts
+        self._pending_speeds = list()
+
+    @property
+    def position(self):
+        """
+        Dead reckoned position estimate from integrating the speed since startup (or the last reset_position)
+        together with the reported altitude.  This drifts over time!
+
+        :return: (north, east, altitude) in meters
+        """
+        if (len(self._pending_speeds) > 0):
+            self._integrate_pending_speeds()
+        return (self._position[0], self._position[1], self.altitude)
+
+    def reset_position(self):
+        """
+        Reset the dead reckoned position to (0, 0)
+        """
+        self._pending_speeds = list()
+        self._position = [0.0, 0.0]
+
     def __str__(self):
         """
         Make a nicely printed struct for debugging
 
         :return: string for print calls
         """
-        my_str = "mambo state: battery %d, " % self.battery
-        my_str += "flying state is %s, " % self.flying_state
-        my_str += "speed (x, y, z) and ts is (%f, %f, %f) at %f " % (self.speed_x, self.speed_y, self.speed_z, self.speed_ts)
-        my_str += "altitude (m) %f and ts is %f " % (self.altitude, self.altitude_ts)
-        my_str += "quaternion (w, x, y, z) and ts is (%f, %f, %f, %f) at %f " % (
-            self.quaternion_w, self.quaternion_x, self.quaternion_y, self.quaternion_z, self.quaternion_ts)
-        my_str += "gun id: %d, state %s, " % (self.gun_id, self.gun_state)
-        my_str += "claw id: %d, state %s, " % (self.claw_id, self.claw_state)
+        # print from the snapshot so a packet arriving on another thread can't mix old and new values
+        (speed, altitude, quaternion, state) = self.snapshot
+        my_str = "mambo state: battery %d, " % state.battery
+        my_str += "flying state is %s, " % state.flying_state
+        my_str += "speed (x, y, z) and ts is (%f, %f, %f) at %f " % speed[0:4]
+        my_str += "altitude (m) %f and ts is %f " % altitude[0:2]
+        my_str += "quaternion (w, x, y, z) and ts is (%f, %f, %f, %f) at %f " % quaternion[0:5]
+        my_str += "gun id: %d, state %s, " % (state.gun_id, state.gun_state)
+        my_str += "claw id: %d, state %s, " % (state.claw_id, state.claw_state)
         my_str += "unknown sensors: %s," % self.unknown_sensors
         return my_str
 
+class MamboSequenceTracker:
+    """
+    Track the sequence numbers on one of the drone data channels so duplicate (retransmitted) packets
+    can be skipped and lost packets can be counted
+    """
+
+    def __init__(self, window=32):
+        """
+        :param window: number of recent sequence numbers remembered for duplicate detection
+        """
+        self.window = window
+        self.last_seq = None
+
+        # bit i is set if sequence number (last_seq - i) has been received
+        self.seen = 0
+
+        self.received = 0
+        self.duplicates = 0
+        self.drops = 0
+
+    def check(self, seq):
+        """
+        Check a sequence number and update the counters.  Sequence numbers wrap at 256.
+
+        :param seq: sequence number from the packet header
+        :return: True if the packet is new and False if it is a duplicate
+        """
+        if (self.last_seq is None):
+            self.last_seq = seq
+            self.seen = 1
+            self.received += 1
+            return True
+
+        ahead = (seq - self.last_seq) % 256
+        if (ahead == 0):
+            self.duplicates += 1
+            return False
+        elif (ahead < 128):
+            # newer packet, anything we skipped over is (for now) dropped
+            self.drops += ahead - 1
+            self.seen = ((self.seen << ahead) | 1) & ((1 << self.window) - 1)
+            self.last_seq = seq
+        else:
+            behind = 256 - ahead
+            if (behind >= self.window):
+                # too old to be a retransmission so the drone must have restarted its counter
+                self.last_seq = seq
+                self.seen = 1
+            elif (self.seen & (1 << behind)):
+                self.duplicates += 1
+                return False
+            else:
+                # late packet that we already counted as dropped
+                self.seen |= (1 << behind)
+                self.drops -= 1
+
+        self.received += 1
+        return True
+
+    def reset(self):
+        """
+        Forget the recent sequence numbers (the drone starts counting again on a new connection).  The counters
+        are kept.
+        """
+        self.last_seq = None
+        self.seen = 0
+
 class Mambo:
     def __init__(self, address, debug_level=None):
         """
@@ -234,9 +497,13 @@ class Mambo:
         # FTP commands (obtained via ARUTILS_BLEFtp.m in the SDK)
         self.ftp_commands = {
             "list" : "LIS",
-            "get" : "GET"
+            "get" : "GET",
+            "delete" : "DEL"
         }
 
+        # FTP client for listing, downloading and deleting the pictures on the drone
+        self.ftp = MamboFTP(self)
+
         # need to save for communication (but they are initialized in connect)
         self.services = None
         self.send_characteristics = dict()
@@ -262,6 +529,29 @@ class Mambo:
             'SEND_HIGH_PRIORITY': False,
             'ACK_COMMAND': False
         }
+
+        # notified whenever the flying state changes (for threads that are not pumping notifications)
+        self.state_changed = threading.Condition()
+
+        # how often (seconds) and how many times safe_takeoff/safe_land send their command
+        self.state_command_interval = 1.0
+        self.max_state_command_tries = 3
+
+        # and when the last ack arrived (used for the ack latency metrics)
+        self.command_received_time = {
+            'SEND_WITH_ACK': 0,
+            'SEND_HIGH_PRIORITY': 0,
+            'ACK_COMMAND': 0
+        }
+
+        # latency histograms, retry counts, reconnects and PCMD rate for this mambo
+        self.metrics = MamboMetrics(constant_labels={'address': address})
+
+        # glass to command latency traces (frame capture to PCMD write, see MamboLatency.py)
+        self.latency_tracker = MamboLatencyTracker(self.metrics)
+
+        # timeline of BLE, command and sensor events (None unless enable_tracing was called, see MamboTracer.py)
+        self.tracer = None
         
         # sensors are stored in a MamboSensor object
         self.sensors = MamboSensors()
@@ -270,9 +560,49 @@ class Mambo:
         self.command_tuple_cache = dict()
         self.sensor_tuple_cache = dict()
 
+        # reverse of the command cache so packets can be named in the metrics
+        self.command_name_cache = dict()
+
+        # acks for ACK_DRONE_DATA are queued by the notification handler and sent once it returns
+        # (the oldest are dropped if it ever fills up and the drone will just send those again)
+        self.pending_acks = collections.deque(maxlen=32)
+
+        # sequence tracking on the data channels (to skip duplicates and count drops)
+        self.sequence_trackers = {
+            'ACK_DRONE_DATA': MamboSequenceTracker(),
+            'NO_ACK_DRONE_DATA': MamboSequenceTracker()
+        }
+
+        # functions called with (sensors, names, receive_time) after each sensor packet (see add_sensor_listener)
+        self.sensor_listeners = list()
+
         # maximum number of times to try a packet before assuming it failed
         self.max_packet_retries = 3
 
+        # precompiled layouts and reusable buffers for the packets sent many times a second.  The
+        # buffers are filled in once and then only the sequence number (and changed fields) are patched.
+        self.pcmd_struct = struct.Struct("<BBBBBBBbbbbI")
+        self.pcmd_packet = bytearray(self.pcmd_struct.size)
+        self.ack_struct = struct.Struct("<BBB")
+        self.ack_packet = bytearray(self.ack_struct.size)
+        self.noparam_struct = struct.Struct("<BBBBBB")
+        self.noparam_packet = bytearray(self.noparam_struct.size)
+
+        # struct formats for the argument types in the xml files (used to unpack sensor data)
+        self.sensor_data_formats = {
+            'u8': '<B',
+            'enum': '<i',
+            'i8': '<b',
+            'u16': '<H',
+            'i16': '<h',
+            'u32': '<I',
+            'i32': '<i',
+            'u64': '<Q',
+            'i64': '<q',
+            'float': '<f',
+            'double': '<d'
+        }
+
     def _debug_print(self, print_str, level):
         """
         Internal method to only print based on the debugging level
@@ -311,13 +641,20 @@ class Mambo:
         :return: True if it succeeds and False otherwise
         """
 
+        tracer = self.tracer
         try_num = 1
         while (try_num < num_retries):
+            if (tracer is not None):
+                start = time.time()
             try:
                 self._connect()
+                if (tracer is not None):
+                    tracer.complete("connect", "ble", start, {'try': try_num, 'success': True})
                 return True
             except BTLEException:
                 self._debug_print("retrying connections", 10)
+                if (tracer is not None):
+                    tracer.complete("connect", "ble", start, {'try': try_num, 'success': False})
                 try_num += 1
 
         # if we fell through the while loop, it failed to connect
@@ -332,6 +669,7 @@ class Mambo:
 
         :return: True if it succeeds and False otherwise
         """
+        start_time = time.time()
         try_num = 1
         success = False
         while (try_num < num_retries and not success):
@@ -345,9 +683,15 @@ class Mambo:
                 try_num += 1
 
         if (success):
+            self._reset_link_state()
             # do the magic handshake
             self._perform_handshake()
 
+        if (self.tracer is not None):
+            self.tracer.complete("reconnect", "ble", start_time, {'tries': try_num, 'success': success})
+        self.metrics.record("reconnect_duration_seconds", time.time() - start_time)
+        self.metrics.increment("reconnects_total", labels={'success': success})
+
         return success
         
     def _connect(self):
@@ -360,6 +704,7 @@ class Mambo:
         self._debug_print("trying to connect to the mambo at address %s" % self.address, 10)
         self.drone.connect(self.address, "random")
         self._debug_print("connected!  Asking for services and characteristics", 5)
+        self._reset_link_state()
 
         # re-try until all services have been found
         allServicesFound = False
@@ -367,6 +712,10 @@ class Mambo:
         # used for notifications
         handle_map = dict()
 
+        tracer = self.tracer
+        if (tracer is not None):
+            start = time.time()
+
         while not allServicesFound:
             # get the services
             self.services = self.drone.getServices()
@@ -399,6 +748,7 @@ class Mambo:
                         hex_str = self._get_byte_str_from_uuid(c.uuid, 4, 4)
                         if hex_str in self.characteristic_ftp_uuids:
                             self.ftp_characteristics[self.characteristic_ftp_uuids[hex_str]] = c
+                            handle_map[c.getHandle()] = hex_str
 
                 elif (self.service_uuids[hex_str] == 'NORMAL_BLE_FTP_SERVICE'):
                     # store the FTP info
@@ -406,6 +756,7 @@ class Mambo:
                         hex_str = self._get_byte_str_from_uuid(c.uuid, 4, 4)
                         if hex_str in self.characteristic_ftp_uuids:
                             self.ftp_characteristics[self.characteristic_ftp_uuids[hex_str]] = c
+                            handle_map[c.getHandle()] = hex_str
 
                 # need to register for notifications and write 0100 to the right handles
                 # this is sort of magic (not in the docs!) but it shows up on the forum here
@@ -439,6 +790,8 @@ class Mambo:
                 self._debug_print("setting to false in len", 5)
                 allServicesFound = False
 
+        if (tracer is not None):
+            tracer.complete("discover_services", "ble", start)
 
         # do the magic handshake
         self._perform_handshake()
@@ -446,6 +799,15 @@ class Mambo:
         # initialize the delegate to handle notifications
         self.drone.setDelegate(MamboDelegate(handle_map, self))
 
+    def _reset_link_state(self):
+        """
+        Start a new connection with empty sequence windows and no acks left over from the old one.  Otherwise
+        the drone's restarted counters land inside the duplicate window and real packets are thrown away.
+        """
+        for tracker in self.sequence_trackers.itervalues():
+            tracker.reset()
+        self.pending_acks.clear()
+
     def _perform_handshake(self):
         """
         Magic handshake
@@ -456,6 +818,9 @@ class Mambo:
         :return: nothing
         """
         self._debug_print("magic handshake to make the drone listen to our commands", 2)
+        tracer = self.tracer
+        if (tracer is not None):
+            start = time.time()
         
         # Note this code snippet below more or less came from the python example posted to that forum (I adapted it to my interface)
         for c in self.handshake_characteristics.itervalues():
@@ -463,6 +828,9 @@ class Mambo:
             # Need to write 0x0100 to the characteristics value handle (which is 2 higher)
             self.drone.writeCharacteristic(c.handle + 2, struct.pack("<BB", 1, 0))
 
+        if (tracer is not None):
+            tracer.complete("handshake", "ble", start)
+
     def disconnect(self):
         """
         Disconnect the BLE connection.  Always call this at the end of your programs to
@@ -478,53 +846,57 @@ class Mambo:
         :param data: BLE packet of sensor data
         :return:
         """
-        print "updating sensors with "
+        receive_time = time.time()
+        self._debug_print("updating sensors with ", 1)
         header_tuple = struct.unpack_from("<BBBBBB", data)
-        print header_tuple
+        self._debug_print(header_tuple, 1)
+
+        # skip retransmitted packets before decoding them (but still ack them so the drone stops sending)
+        if (ack):
+            channel = 'ACK_DRONE_DATA'
+        else:
+            channel = 'NO_ACK_DRONE_DATA'
+        tracker = self.sequence_trackers[channel]
+        drops = tracker.drops
+        is_new = tracker.check(header_tuple[1])
+        if (tracker.drops != drops):
+            self.metrics.increment("dropped_packets_total", tracker.drops - drops, labels={'channel': channel})
+
+        if (not is_new):
+            self._debug_print("duplicate packet %d on %s" % (header_tuple[1], channel), 2)
+            self.metrics.increment("duplicate_packets_total", labels={'channel': channel})
+            if (self.tracer is not None):
+                self.tracer.instant("duplicate_packet", "sensors", {'channel': channel, 'seq': header_tuple[1]})
+            if (ack):
+                self._queue_ack(header_tuple[1])
+            return
+
+        self.metrics.increment("received_packets_total", labels={'channel': channel})
         (names, data_sizes) = self._parse_sensor_tuple(header_tuple)
-        print "name of sensor is %s" % names
-        print "data size is %s" % data_sizes
+        self._debug_print("name of sensor is %s" % names, 1)
+        self._debug_print("data size is %s" % data_sizes, 1)
 
         if names is not None:
+            # the arguments are packed one after the other right after the 6 byte header
+            offset = 6
             for idx, name in enumerate(names):
                 data_size = data_sizes[idx]
 
-                if (data_size == "u8" or data_size == "enum"):
-                    # unsigned 8 bit, single byte
-                    sensor_data = struct.unpack_from("<B", data, offset=6)
-                    sensor_data = int(sensor_data[0])
-                elif (data_size == "i8"):
-                    # signed 8 bit, single byte
-                    sensor_data = struct.unpack_from("<b", data, offset=6)
-                    sensor_data = int(sensor_data[0])
-                elif (data_size == "u16"):
-                    sensor_data = struct.unpack_from("<H", data, offset=6)
-                    sensor_data = int(sensor_data[0])
-                elif (data_size == "i16"):
-                    sensor_data = struct.unpack_from("<h", data, offset=6)
-                    sensor_data = int(sensor_data[0])
-                elif (data_size == "u32"):
-                    sensor_data = struct.unpack_from("<I", data, offset=6)
-                    sensor_data = int(sensor_data[0])
-                elif (data_size == "i32"):
-                    sensor_data = struct.unpack_from("<i", data, offset=6)
-                    sensor_data = int(sensor_data[0])
-                elif (data_size == "u64"):
-                    sensor_data = struct.unpack_from("<Q", data, offset=6)
-                    sensor_data = int(sensor_data[0])
-                elif (data_size == "i64"):
-                    sensor_data = struct.unpack_from("<q", data, offset=6)
-                    sensor_data = int(sensor_data[0])
-                elif (data_size == "float"):
-                    sensor_data = struct.unpack_from("<f", data, offset=6)
-                    sensor_data = float(sensor_data[0])
-                elif (data_size == "double"):
-                    sensor_data = struct.unpack_from("<d", data, offset=6)
-                    sensor_data = float(sensor_data[0])
-                elif (data_size == "string"):
-                    # string
-                    sensor_data = struct.unpack_from("<s", data, offset=6)
-                    sensor_data = sensor_data[0]
+                if (data_size == "string"):
+                    # strings are null terminated
+                    end = data.find("\0", offset)
+                    if (end < 0):
+                        end = len(data)
+                    sensor_data = data[offset:end]
+                    offset = end + 1
+                elif (data_size in self.sensor_data_formats):
+                    fmt = self.sensor_data_formats[data_size]
+                    sensor_data = struct.unpack_from(fmt, data, offset=offset)[0]
+                    offset += struct.calcsize(fmt)
+                    if (data_size == "float" or data_size == "double"):
+                        sensor_data = float(sensor_data)
+                    else:
+                        sensor_data = int(sensor_data)
                 else:
                     sensor_data = None
                     self._debug_print("Write the parser for this value", 10)
@@ -532,14 +904,40 @@ class Mambo:
 
                 self._debug_print("updating the sensor!", 1)
                 self.sensors.update(name, sensor_data, self.sensor_tuple_cache)
+
+            self.sensors.publish_snapshot(names[0].split("_")[0], receive_time)
         else:
             #print header_tuple
             self._debug_print("Error parsing sensor information!", 10)
 
         self._debug_print(self.sensors, 1)
 
+        if (names is not None and "FlyingStateChanged_state" in names):
+            with self.state_changed:
+                self.state_changed.notify_all()
+
+        tracer = self.tracer
+        if (tracer is not None):
+            tracer.complete("decode_sensors", "sensors", receive_time,
+                            {'message': names[0].split("_")[0] if names is not None else None})
+            start = time.time()
+
+        # queue the ack before running the listeners so a failing listener can't keep the drone resending
         if (ack):
-            self._ack_packet(header_tuple[1])
+            self._queue_ack(header_tuple[1])
+
+        if (names is not None):
+            for listener in self.sensor_listeners:
+                try:
+                    listener(self.sensors, names, receive_time)
+                except Exception as error:
+                    # an exception here would reach _wait_for_notifications and look like a BLE failure
+                    self._debug_print("sensor listener %r failed: %s: %s" % (listener, type(error).__name__, error),
+                                      10)
+                    self.metrics.increment("sensor_listener_errors_total")
+
+        if (tracer is not None and names is not None and len(self.sensor_listeners) > 0):
+            tracer.complete("sensor_listeners", "sensors", start)
 
     def _parse_sensor_tuple(self, sensor_tuple):
         """
@@ -646,23 +1044,68 @@ class Mambo:
         """
         Get the listing of files from the ftp on the drone
 
-        :return:
+        :return: list of (name, size in bytes) for the pictures on the drone
         """
-        BLE_PACKET_MAX_SIZE=132
+        return self.ftp.list_files()
 
-        num_zeros = BLE_PACKET_MAX_SIZE-len(self.ftp_commands["list"])
-        my_zeros = "\0" * num_zeros
-        print len(my_zeros)
-        print self.ftp_commands["list"]
-        fmt = format("<3s%dss" % num_zeros)
-        print fmt
+    def download_camera_file(self, name, local_path):
+        """
+        Download a picture from the drone (streamed to disk and checked with md5).  If the BLE drops, the drone
+        sends the file again from the start and the bytes already on disk are skipped (see MamboFTP.get_file).
 
-        packet = struct.pack(fmt, self.ftp_commands["list"], my_zeros, "/.")
-        print len(packet)
-        print packet
-                
-        self.ftp_characteristics['NORMAL_FTP_HANDLING'].write(packet)
+        :param name: name of the file on the drone (from get_camera_files)
+        :param local_path: where to save it
+        :return: md5 (hex string) of the file
+        """
+        return self.ftp.get_file(name, local_path)
+
+    def delete_camera_file(self, name):
+        """
+        Delete a picture on the drone
 
+        :param name: name of the file on the drone (from get_camera_files)
+        :return: True if it was deleted and False otherwise
+        """
+        return self.ftp.delete_file(name)
+
+    def _ftp_notification(self, channel, data):
+        """
+        Hand a notification on one of the FTP characteristics to the FTP client
+
+        :param channel: name of the FTP characteristic
+        :param data: the packet
+        """
+        self.ftp._handle_notification(channel, data)
+
+    def _queue_ack(self, packet_id):
+        """
+        Queue an ack for the packet id.  Called from the notification handler so it never writes to BLE itself;
+        the queue is sent by _flush_acks as soon as the handler returns.
+
+        :param packet_id: the packet id to ack
+        :return: nothing
+        """
+        # a retransmission that arrives before the first ack went out only needs one ack
+        if (len(self.pending_acks) > 0 and self.pending_acks[-1] == packet_id):
+            return
+        self.pending_acks.append(packet_id)
+
+    def _flush_acks(self):
+        """
+        Send all of the queued acks in the order they were received.  A failed write leaves the rest of the
+        queue for the next flush rather than waiting on a reconnect (the drone resends anything not acked).
+
+        :return: nothing
+        """
+        while (len(self.pending_acks) > 0):
+            packet_id = self.pending_acks[0]
+            try:
+                self._ack_packet(packet_id)
+            except BTLEException:
+                self._debug_print("failed to send ack for packet %d" % packet_id, 10)
+                self.metrics.increment("ack_write_errors_total")
+                return
+            self.pending_acks.popleft()
 
     def _ack_packet(self, packet_id):
         """
@@ -673,13 +1116,12 @@ class Mambo:
         """
         self._debug_print("ack last packet on the ACK_COMMAND channel", 1)
         self.characteristic_send_counter['ACK_COMMAND'] = (self.characteristic_send_counter['ACK_COMMAND'] + 1) % 256
-        packet = struct.pack("<BBB", self.data_types['ACK'], self.characteristic_send_counter['ACK_COMMAND'],
-                             packet_id)
+        self.ack_struct.pack_into(self.ack_packet, 0, self.data_types['ACK'],
+                                  self.characteristic_send_counter['ACK_COMMAND'], packet_id)
         self._debug_print("sending packet %d %d %d" % (self.data_types['ACK'], self.characteristic_send_counter['ACK_COMMAND'],
                                            packet_id), 1)
 
-        self._safe_ble_write(characteristic=self.send_characteristics['ACK_COMMAND'], packet=packet)
-        #self.send_characteristics['ACK_COMMAND'].write(packet)
+        self.send_characteristics['ACK_COMMAND'].write(self.ack_packet)
 
 
 
@@ -712,6 +1154,69 @@ class Mambo:
         :return:
         """
         self.command_received[channel] = val
+        if (val):
+            self.command_received_time[channel] = time.time()
+
+    def _get_command_name(self, packet):
+        """
+        Get the name of the command in a packet (from the command cache) for use in the metrics
+
+        :param packet: command packet
+        :return: name of the command as "class.command" or "unknown"
+        """
+        command_tuple = struct.unpack_from("<BBB", packet, offset=2)
+        return self.command_name_cache.get(command_tuple, "unknown")
+
+    def add_sensor_listener(self, listener):
+        """
+        Call a function every time a sensor packet is decoded.  It is called on the thread handling the BLE
+        notifications so keep it quick (and don't send commands from it).  Exceptions it raises are printed and
+        counted in the sensor_listener_errors_total metric.
+
+        :param listener: function called with (sensors, names, receive_time): the MamboSensors object, the list of
+        sensor names in the packet and the time.time() the packet was decoded
+        """
+        # replace the list instead of changing it so the notification thread can loop over it without a lock
+        self.sensor_listeners = self.sensor_listeners + [listener]
+
+    def remove_sensor_listener(self, listener):
+        """
+        Stop calling a function added with add_sensor_listener
+
+        :param listener: the function
+        """
+        self.sensor_listeners = [other for other in self.sensor_listeners if other != listener]
+
+    def enable_tracing(self, size=100000):
+        """
+        Start recording a timeline of the BLE, command and sensor events (see MamboTracer.py)
+
+        :param size: maximum number of events kept
+        :return: the MamboTracer (export it with tracer.export(path))
+        """
+        if (self.tracer is None):
+            self.tracer = MamboTracer(size)
+        return self.tracer
+
+    def disable_tracing(self):
+        """
+        Stop recording trace events
+
+        :return: the MamboTracer with the events recorded so far (or None if tracing wasn't on)
+        """
+        tracer = self.tracer
+        self.tracer = None
+        return tracer
+
+    def get_metrics(self):
+        """
+        Get a snapshot of the link metrics: ack latency histograms (with p50/p90/p99) and retries per command,
+        BLE write errors, reconnect durations, and the achieved PCMD rate.  Use
+        self.metrics.write_prometheus(path) or self.metrics.start_prometheus_writer(path) to export them.
+
+        :return: dictionary with 'counters', 'gauges' and 'histograms' (see MamboMetrics.get_metrics)
+        """
+        return self.metrics.get_metrics()
 
     def _get_command_tuple(self, myclass, cmd):
         """
@@ -741,6 +1246,7 @@ class Mambo:
 
                         # cache the result
                         self.command_tuple_cache[(myclass, cmd)] = (project_id, class_id, cmd_id)
+                        self.command_name_cache[(project_id, class_id, cmd_id)] = "%s.%s" % (myclass, cmd)
                         return (project_id, class_id, cmd_id)
 
         # do the search in common since minidrone failed
@@ -759,6 +1265,7 @@ class Mambo:
 
                         # cache the result
                         self.command_tuple_cache[(myclass, cmd)] = (project_id, class_id, cmd_id)
+                        self.command_name_cache[(project_id, class_id, cmd_id)] = "%s.%s" % (myclass, cmd)
                         return (project_id, class_id, cmd_id)
 
 
@@ -799,6 +1306,7 @@ class Mambo:
 
                                         # cache the result
                                         self.command_tuple_cache[(myclass, cmd, enum_name)] = ((project_id, class_id, cmd_id), enum_id)
+                                        self.command_name_cache[(project_id, class_id, cmd_id)] = "%s.%s" % (myclass, cmd)
 
                                         print  ((project_id, class_id, cmd_id), enum_id)
                                         return ((project_id, class_id, cmd_id), enum_id)
@@ -825,6 +1333,7 @@ class Mambo:
 
                                         # cache the result
                                         self.command_tuple_cache[(myclass, cmd, enum_name)] = ((project_id, class_id, cmd_id), enum_id)
+                                        self.command_name_cache[(project_id, class_id, cmd_id)] = "%s.%s" % (myclass, cmd)
 
                                         print ((project_id, class_id, cmd_id), enum_id)
                                         return ((project_id, class_id, cmd_id), enum_id)
@@ -840,6 +1349,9 @@ class Mambo:
         """
 
         success = False
+        tracer = self.tracer
+        if (tracer is not None):
+            start = time.time()
 
         while (not success):
             try:
@@ -847,8 +1359,14 @@ class Mambo:
                 success = True
             except BTLEException:
                 self._debug_print("reconnecting to send packet", 10)
+                self.metrics.increment("ble_write_errors_total")
+                if (tracer is not None):
+                    tracer.instant("ble_write_error", "ble")
                 self._reconnect(3)
 
+        if (tracer is not None):
+            tracer.complete("ble_write", "ble", start)
+
 
     def _send_command_packet_ack(self, packet):
         """
@@ -857,22 +1375,79 @@ class Mambo:
         :param packet: packet constructed according to the command rules (variable size, constructed elsewhere)
         :return: True if the command was sent and False otherwise
         """
+        tracer = self.tracer
+        if (tracer is not None):
+            start = time.time()
+
         try_num = 0
         self._set_command_received('SEND_WITH_ACK', False)
         while (try_num < self.max_packet_retries and not self.command_received['SEND_WITH_ACK']):
             self._debug_print("sending command packet on try %d" % try_num, 2)
+            send_time = time.time()
             self._safe_ble_write(characteristic=self.send_characteristics['SEND_WITH_ACK'], packet=packet)
             #self.send_characteristics['SEND_WITH_ACK'].write(packet)
             try_num += 1
-            self._debug_print("sleeping for a notification", 2)
+            self._debug_print("waiting for the ack", 2)
             #notify = self.drone.waitForNotifications(1.0)
-            self.smart_sleep(0.5)
+            self._wait_for_ack('SEND_WITH_ACK', 0.5)
             #self._debug_print("awake %s " % notify, 2)
 
+        # latency is measured from the write that got the ack
+        labels = {'command': self._get_command_name(packet)}
+        self.metrics.record("command_retries", try_num - 1, labels=labels, buckets=COUNT_BUCKETS)
+        if (self.command_received['SEND_WITH_ACK']):
+            self.metrics.record("command_ack_latency_seconds",
+                                self.command_received_time['SEND_WITH_ACK'] - send_time, labels=labels)
+        else:
+            self.metrics.increment("command_ack_failures_total", labels=labels)
+
+        if (tracer is not None):
+            tracer.complete("command_ack", "command", start, {'command': labels['command'], 'tries': try_num,
+                                                              'acked': self.command_received['SEND_WITH_ACK']})
         return self.command_received['SEND_WITH_ACK']
 
 
 
+    def _send_precompiled_packet_ack(self, packet):
+        """
+        Send a command packet that was packed ahead of time (e.g. by MamboMission) on the ack channel.  Only the
+        sequence number is patched in before sending.
+
+        :param packet: bytearray with the full command packet
+        :return: True if the command was acked and False otherwise
+        """
+        self.characteristic_send_counter['SEND_WITH_ACK'] = (self.characteristic_send_counter['SEND_WITH_ACK'] + 1) % 256
+        packet[1] = self.characteristic_send_counter['SEND_WITH_ACK']
+        return self._send_command_packet_ack(packet)
+
+    def _send_precompiled_pcmd(self, packet):
+        """
+        Send a PCMD packet that was packed ahead of time (e.g. by MamboMission).  Only the sequence number is
+        patched in before sending.  This does not wait for notifications.
+
+        :param packet: bytearray with the full PCMD packet
+        :return: nothing
+        """
+        self.characteristic_send_counter['SEND_NO_ACK'] = (self.characteristic_send_counter['SEND_NO_ACK'] + 1) % 256
+        packet[1] = self.characteristic_send_counter['SEND_NO_ACK']
+        self._safe_ble_write(characteristic=self.send_characteristics['SEND_NO_ACK'], packet=packet)
+
+    def _wait_for_ack(self, channel, timeout):
+        """
+        Pump notifications until the command on the channel is acked (returns as soon as the ack arrives)
+
+        :param channel: channel the command was sent on
+        :param timeout: maximum number of seconds to wait
+        :return: True if the ack arrived and False otherwise
+        """
+        end_time = time.time() + timeout
+        while (not self.command_received[channel]):
+            remaining = end_time - time.time()
+            if (remaining <= 0):
+                return False
+            self._wait_for_notifications(min(remaining, 0.1))
+        return True
+
     def _send_noparam_command_packet_ack(self, command_tuple):
         """
         Send a command on the ack channel - where all commands except PCMD go, per
@@ -886,9 +1461,10 @@ class Mambo:
         :return: True if the command was sent and False otherwise
         """
         self.characteristic_send_counter['SEND_WITH_ACK'] = (self.characteristic_send_counter['SEND_WITH_ACK'] + 1) % 256
-        packet = struct.pack("<BBBBBB", self.data_types['DATA_WITH_ACK'], self.characteristic_send_counter['SEND_WITH_ACK'],
-                             command_tuple[0], command_tuple[1], command_tuple[2], 0)
-        return self._send_command_packet_ack(packet)
+        self.noparam_struct.pack_into(self.noparam_packet, 0, self.data_types['DATA_WITH_ACK'],
+                                      self.characteristic_send_counter['SEND_WITH_ACK'],
+                                      command_tuple[0], command_tuple[1], command_tuple[2], 0)
+        return self._send_command_packet_ack(self.noparam_packet)
 
 
 
@@ -931,20 +1507,14 @@ class Mambo:
 
     def safe_takeoff(self, timeout):
         """
-        Sends commands to takeoff until the mambo reports it is taking off
-        """
-        
-        start_time = time.time()
-        # take off until it really listens
-        while (self.sensors.flying_state != "takingoff" and (time.time() - start_time < timeout)):
-            self.smart_sleep(1)
-            success = self.takeoff()
-
-        # now wait until it finishes takeoff before returning
-        while ((self.sensors.flying_state != "flying" or self.sensors.flying_state != "hovering") and
-               (time.time() - start_time < timeout)):
-            self.smart_sleep(1)
+        Sends commands to takeoff until the mambo reports it is taking off and then waits until it is
+        flying or hovering.  Returns as soon as the flying state changes (no polling).  The takeoff command
+        is resent every state_command_interval seconds, at most max_state_command_tries times.
 
+        :param timeout: maximum number of seconds for the whole takeoff
+        :return: True if the mambo is flying or hovering and False if it timed out
+        """
+        return self._command_until_state(self.takeoff, ("takingoff",), ("hovering", "flying"), timeout)
 
     def land(self):
         """
@@ -957,16 +1527,67 @@ class Mambo:
         #print command_tuple
         return self._send_noparam_command_packet_ack(command_tuple)
 
-    def safe_land(self):
+    def safe_land(self, timeout=15):
         """
-        Ensure the mambo lands by sending the command until it shows landed on sensors
+        Ensure the mambo lands by sending the command until it shows landing (or landed) on sensors and then
+        waiting for it to land.  Returns as soon as the flying state changes (no polling).  The land command
+        is resent every state_command_interval seconds, at most max_state_command_tries times.
+
+        :param timeout: maximum number of seconds for the whole landing.  Defaults to 15.
+        :return: True if the mambo landed and False if it timed out
         """
-        
-        while (self.sensors.flying_state != "landed"):
-            self._debug_print("trying to land", 10)
-            self.smart_sleep(1)
-            success = self.land()
-        
+        return self._command_until_state(self.land, ("landing",), ("landed",), timeout)
+
+    def _command_until_state(self, command, started_states, final_states, timeout):
+        """
+        Send a command until the flying state shows it started and then wait for one of the final states
+
+        :param command: function that sends the command (e.g. self.takeoff)
+        :param started_states: flying states that show the command was accepted
+        :param final_states: flying states that show the command finished
+        :param timeout: maximum number of seconds for the whole thing
+        :return: True if a final state was reached and False if it timed out
+        """
+        end_time = time.time() + timeout
+        accepted_states = started_states + final_states
+
+        tries = 0
+        while (self.sensors.flying_state not in accepted_states):
+            if (tries >= self.max_state_command_tries or time.time() >= end_time):
+                self._debug_print("gave up waiting for %s" % (accepted_states,), 10)
+                return False
+            command()
+            tries += 1
+            self.wait_for_flying_state(accepted_states, min(self.state_command_interval, end_time - time.time()))
+
+        return self.wait_for_flying_state(final_states, end_time - time.time())
+
+    def wait_for_flying_state(self, states, timeout, pump=True):
+        """
+        Wait until the flying state is one of the states.  This wakes up as soon as the FlyingStateChanged
+        notification arrives.
+
+        :param states: a flying state name or a tuple of them (e.g. ("hovering", "flying"))
+        :param timeout: maximum number of seconds to wait
+        :param pump: if True (default) this thread handles the BLE notifications while it waits.  Use False when
+        another thread is already handling notifications (this thread then just waits to be notified).
+        :return: True if the mambo reached one of the states and False if it timed out
+        """
+        if (isinstance(states, basestring)):
+            states = (states,)
+
+        end_time = time.time() + timeout
+        while (self.sensors.flying_state not in states):
+            remaining = end_time - time.time()
+            if (remaining <= 0):
+                return False
+            if (pump):
+                self._wait_for_notifications(min(remaining, 0.1))
+            else:
+                with self.state_changed:
+                    if (self.sensors.flying_state not in states):
+                        self.state_changed.wait(remaining)
+        return True
 
     def hover(self):
         """
@@ -1034,12 +1655,34 @@ class Mambo:
 
         start_time = time.time()
         while (time.time() - start_time < timeout):
-            try:
-                notify = self.drone.waitForNotifications(0.1)
-            except:
-                self._debug_print("reconnecting to wait", 10)
-                self._reconnect(3)
-            
+            self._wait_for_notifications(0.1)
+
+    def _wait_for_notifications(self, timeout):
+        """
+        Wait up to timeout seconds for BLE notifications (the notification handlers run inside this call) and
+        then send any acks the handlers queued.  Everything that pumps notifications should go through here.
+
+        :param timeout: maximum number of seconds to wait
+        :return: True if a notification was received and False otherwise
+        """
+        tracer = self.tracer
+        if (tracer is not None):
+            start = time.time()
+
+        notify = False
+        try:
+            notify = self.drone.waitForNotifications(timeout)
+        except:
+            self._debug_print("reconnecting to wait", 10)
+            self._reconnect(3)
+
+        if (len(self.pending_acks) > 0):
+            self._flush_acks()
+
+        if (tracer is not None):
+            tracer.complete("wait_notifications", "ble", start, {'notified': notify})
+
+        return notify
 
     def turn_on_auto_takeoff(self):
         """
@@ -1093,7 +1736,7 @@ class Mambo:
         else:
             return value
 
-    def fly_direct(self, roll, pitch, yaw, vertical_movement, duration):
+    def fly_direct(self, roll, pitch, yaw, vertical_movement, duration, trace=None):
         """
         Direct fly commands using PCMD.  Each argument ranges from -100 to 100.  Numbers outside that are clipped
         to that range.
@@ -1105,8 +1748,13 @@ class Mambo:
         :param pitch:
         :param yaw:
         :param vertical_movement:
+        :param duration: seconds to send the command for
+        :param trace: optional MamboLatencyTrace for the frame this command came from (see MamboLatency.py).  The
+        command and the first BLE write are recorded in it.
         :return:
         """
+        self.latency_tracker.mark(trace, "command")
+        tracer = self.tracer
 
         my_roll = self._ensure_fly_command_in_range(roll)
         my_pitch = self._ensure_fly_command_in_range(pitch)
@@ -1114,17 +1762,37 @@ class Mambo:
         my_vertical = self._ensure_fly_command_in_range(vertical_movement)
         command_tuple = self._get_command_tuple("Piloting", "PCMD")
 
+        # fill in the packet once and only patch the sequence number on each send
+        packet = self.pcmd_packet
+        self.pcmd_struct.pack_into(packet, 0, self.data_types['DATA_NO_ACK'], 0,
+                                   command_tuple[0], command_tuple[1], command_tuple[2], 0,
+                                   1, my_roll, my_pitch, my_yaw, my_vertical, 0)
+        characteristic = self.send_characteristics['SEND_NO_ACK']
+        seq = self.characteristic_send_counter['SEND_NO_ACK']
+
         start_time = time.time()
+        num_packets = 0
         while (time.time() - start_time < duration):
-            self.characteristic_send_counter['SEND_NO_ACK'] = (self.characteristic_send_counter['SEND_NO_ACK'] + 1) % 256
-            packet = struct.pack("<BBBBBBBbbbbI", self.data_types['DATA_NO_ACK'],
-                                 self.characteristic_send_counter['SEND_NO_ACK'],
-                                 command_tuple[0], command_tuple[1], command_tuple[2], 0,
-                                 1, my_roll, my_pitch, my_yaw, my_vertical, 0)
+            seq = (seq + 1) % 256
+            packet[1] = seq
 
-            self._safe_ble_write(characteristic=self.send_characteristics['SEND_NO_ACK'], packet=packet)
+            self._safe_ble_write(characteristic=characteristic, packet=packet)
             #self.send_characteristics['SEND_NO_ACK'].write(packet)
-            notify = self.drone.waitForNotifications(0.1)
+            if (num_packets == 0):
+                self.latency_tracker.mark(trace, "ble_write")
+            num_packets += 1
+            notify = self._wait_for_notifications(0.1)
+
+        self.characteristic_send_counter['SEND_NO_ACK'] = seq
+
+        # achieved PCMD rate for this call
+        elapsed = time.time() - start_time
+        self.metrics.increment("pcmd_packets_total", num_packets)
+        if (elapsed > 0):
+            self.metrics.set_gauge("pcmd_rate_hz", num_packets / elapsed)
+        if (tracer is not None):
+            tracer.complete("fly_direct", "command", start_time, {'roll': my_roll, 'pitch': my_pitch, 'yaw': my_yaw,
+                                                                  'vertical': my_vertical, 'packets': num_packets})
         
 
     def open_claw(self):
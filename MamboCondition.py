@@ -0,0 +1,89 @@
+"""
+MamboCondition is a condition variable for handing frames between threads without delay.
+
+On python 2, threading.Condition.wait(timeout) doesn't block on the lock: it polls it with sleeps that grow to
+50 ms, so a waiter wakes up tens of milliseconds after notify.  MamboCondition gives each waiting thread a pipe
+and waits in select on it, so the kernel wakes the waiter as soon as notify writes to the pipe (and still
+handles the timeout and lets ctrl-c through).
+
+It supports the parts of threading.Condition this library uses: with, wait, notify and notify_all.
+"""
+import os
+import select
+import threading
+
+
+class MamboWakePipe:
+    """
+    Pipe a thread waits on (closed when the thread ends)
+    """
+
+    def __init__(self):
+        (self.reader, self.writer) = os.pipe()
+
+    def __del__(self):
+        os.close(self.reader)
+        os.close(self.writer)
+
+
+class MamboCondition:
+    """
+    Condition variable whose wait sleeps in select instead of polling
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # pipes of the threads waiting to be notified (only changed while holding the lock)
+        self.waiters = list()
+        self.pipes = threading.local()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+        return False
+
+    def _pipe(self):
+        pipe = getattr(self.pipes, "pipe", None)
+        if (pipe is None):
+            pipe = MamboWakePipe()
+            self.pipes.pipe = pipe
+        return pipe
+
+    def wait(self, timeout=None):
+        """
+        Release the lock, wait for notify (or the timeout) and take the lock again (call this holding the lock)
+
+        :param timeout: maximum seconds to wait (None waits until notified)
+        :return: True if notified and False if the timeout ran out
+        """
+        pipe = self._pipe()
+        self.waiters.append(pipe)
+        self.lock.release()
+        try:
+            select.select([pipe.reader], [], [], timeout)
+        finally:
+            self.lock.acquire()
+            notified = (pipe not in self.waiters)
+            if (notified):
+                # notify wrote the byte while holding the lock so it is in the pipe
+                os.read(pipe.reader, 1)
+            else:
+                self.waiters.remove(pipe)
+        return notified
+
+    def notify(self, n=1):
+        """
+        Wake up to n waiting threads (call this holding the lock)
+        """
+        for pipe in self.waiters[:n]:
+            os.write(pipe.writer, "x")
+        del self.waiters[:n]
+
+    def notify_all(self):
+        """
+        Wake up every waiting thread (call this holding the lock)
+        """
+        self.notify(len(self.waiters))
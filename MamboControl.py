@@ -0,0 +1,306 @@
+"""
+MamboControl runs closed loop controllers at the rate the mambo sends its sensors instead of a
+smart_sleep/read/fly_direct loop.  Each controller is registered against a sensor message (DroneAltitude,
+DroneSpeed or DroneQuaternion) and is evaluated as soon as that message is decoded.  Its output goes straight
+into the PCMD setpoint, which is sent right away, so the delay between a measurement and the command it
+produces is the controller's own compute time.
+
+    loop = MamboControlLoop(mambo)
+    altitude_hold = MamboPID(kp=80.0, ki=10.0, kd=5.0, setpoint=1.0)
+    loop.add_controller("altitude", "vertical", altitude_hold, lambda sensors: sensors.altitude,
+                        trigger="DroneAltitude")
+    loop.set_output("pitch", 20)
+    loop.run(duration=5)
+
+run has to be called on the thread that talks to the drone (like fly_direct): it pumps the notifications the
+controllers run in and sends the PCMD packets.  Between sensor updates it resends the setpoint every
+keepalive_interval seconds.
+
+Loop timing is recorded in the mambo's metrics: control_compute_seconds and control_loop_interval_seconds
+(labelled with the controller) and control_sensor_to_pcmd_seconds (from receiving the sensor packet to writing
+the PCMD it produced).  get_stats() summarises them.
+"""
+import time
+
+# axes of the PCMD setpoint
+CONTROL_AXES = ("roll", "pitch", "yaw", "vertical")
+
+
+class MamboPID:
+    """
+    PID controller.  The derivative is taken on the measurement (so changing the setpoint doesn't kick the
+    output) and the integral stops growing while the output is saturated.
+    """
+
+    def __init__(self, kp, ki=0.0, kd=0.0, setpoint=0.0, output_limit=100.0, integral_limit=None):
+        """
+        :param kp: proportional gain
+        :param ki: integral gain
+        :param kd: derivative gain
+        :param setpoint: target for the measurement
+        :param output_limit: the output is clipped to [-output_limit, output_limit]
+        :param integral_limit: optional limit on the magnitude of the integral term (in output units)
+        """
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.setpoint = setpoint
+        self.output_limit = output_limit
+        self.integral_limit = integral_limit
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the integral and the previous measurement
+        """
+        self.integral = 0.0
+        self.last_measurement = None
+        self.last_time = None
+        self.output = 0.0
+
+    def _clip(self, value, limit):
+        if (limit is None):
+            return value
+        return max(-limit, min(limit, value))
+
+    def update(self, measurement, now):
+        """
+        Compute the output for a new measurement
+
+        :param measurement: the measured value
+        :param now: time of the measurement (seconds)
+        :return: the output
+        """
+        error = self.setpoint - measurement
+        derivative = 0.0
+        dt = None
+        if (self.last_time is not None):
+            dt = now - self.last_time
+            if (dt > 0):
+                derivative = -(measurement - self.last_measurement) / dt
+
+        unclipped = self.kp * error + self.integral + self.kd * derivative
+        output = self._clip(unclipped, self.output_limit)
+        if (dt is not None and dt > 0 and self.ki != 0.0):
+            # only integrate when it doesn't push further into saturation
+            if (output == unclipped or (error > 0) != (unclipped > 0)):
+                self.integral = self._clip(self.integral + self.ki * error * dt, self.integral_limit)
+
+        self.last_measurement = measurement
+        self.last_time = now
+        self.output = output
+        return output
+
+
+class MamboCascade:
+    """
+    Two controllers in a cascade: the outer controller's output is the inner controller's setpoint (e.g. a
+    position controller feeding a speed controller).  The measurement is (outer measurement, inner measurement).
+    """
+
+    def __init__(self, outer, inner):
+        """
+        :param outer: outer controller (anything with setpoint and update(measurement, now))
+        :param inner: inner controller
+        """
+        self.outer = outer
+        self.inner = inner
+
+    @property
+    def setpoint(self):
+        return self.outer.setpoint
+
+    @setpoint.setter
+    def setpoint(self, value):
+        self.outer.setpoint = value
+
+    def reset(self):
+        self.outer.reset()
+        self.inner.reset()
+
+    def update(self, measurement, now):
+        """
+        :param measurement: (outer measurement, inner measurement)
+        :param now: time of the measurement (seconds)
+        :return: the inner controller's output
+        """
+        (outer_measurement, inner_measurement) = measurement
+        self.inner.setpoint = self.outer.update(outer_measurement, now)
+        return self.inner.update(inner_measurement, now)
+
+
+class MamboControlEntry:
+    """
+    A controller registered with a MamboControlLoop
+    """
+
+    def __init__(self, name, axis, controller, measurement, trigger):
+        self.name = name
+        self.axis = axis
+        self.controller = controller
+        self.measurement = measurement
+        self.trigger = trigger
+        self.last_time = None
+        self.evaluations = 0
+        self.labels = {'controller': name}
+
+
+class MamboControlLoop:
+    """
+    Evaluates controllers on each sensor update and sends their outputs as PCMD commands
+    """
+
+    def __init__(self, mambo, keepalive_interval=0.1, metrics=None):
+        """
+        :param mambo: the Mambo to fly
+        :param keepalive_interval: seconds between PCMD packets when no controller output changed (the drone
+        goes back to hovering if it doesn't get them)
+        :param metrics: MamboMetrics for the loop timing (defaults to mambo.metrics)
+        """
+        self.mambo = mambo
+        self.keepalive_interval = keepalive_interval
+        if (metrics is None):
+            metrics = mambo.metrics
+        self.metrics = metrics
+
+        self.controllers = list()
+        self.outputs = dict([(axis, 0) for axis in CONTROL_AXES])
+
+        # receive time of the oldest sensor packet whose outputs haven't been sent yet
+        self.pending_time = None
+        self.running = False
+
+        self.command_tuple = mambo._get_command_tuple("Piloting", "PCMD")
+        self.packet = bytearray(mambo.pcmd_struct.size)
+
+    def add_controller(self, name, axis, controller, measurement, trigger):
+        """
+        Register a controller
+
+        :param name: name of the controller (used in the metrics)
+        :param axis: PCMD axis it drives: roll, pitch, yaw or vertical
+        :param controller: MamboPID, MamboCascade or anything with update(measurement, now)
+        :param measurement: function that takes the MamboSensors and returns the controller's measurement
+        :param trigger: sensor message that triggers an update: DroneAltitude, DroneSpeed or DroneQuaternion
+        """
+        if (axis not in CONTROL_AXES):
+            raise ValueError("axis must be one of %s" % ", ".join(CONTROL_AXES))
+        entry = MamboControlEntry(name, axis, controller, measurement, trigger)
+        self.controllers = [other for other in self.controllers if other.name != name] + [entry]
+
+    def remove_controller(self, name):
+        """
+        Remove a controller (its axis keeps its last output until it is set again)
+        """
+        self.controllers = [other for other in self.controllers if other.name != name]
+
+    def set_output(self, axis, value):
+        """
+        Set an axis that no controller drives (or override one until the controller's next update)
+
+        :param axis: roll, pitch, yaw or vertical
+        :param value: -100 to 100
+        """
+        self.outputs[axis] = self.mambo._ensure_fly_command_in_range(int(round(value)))
+        if (self.pending_time is None):
+            self.pending_time = time.time()
+
+    def _sensor_update(self, sensors, names, receive_time):
+        message = names[0].split("_")[0]
+        for entry in self.controllers:
+            if (entry.trigger != message):
+                continue
+
+            start = time.time()
+            output = entry.controller.update(entry.measurement(sensors), receive_time)
+            self.outputs[entry.axis] = self.mambo._ensure_fly_command_in_range(int(round(output)))
+            self.metrics.record("control_compute_seconds", time.time() - start, labels=entry.labels)
+
+            if (entry.last_time is not None):
+                self.metrics.record("control_loop_interval_seconds", receive_time - entry.last_time,
+                                    labels=entry.labels)
+            entry.last_time = receive_time
+            entry.evaluations += 1
+            if (self.pending_time is None):
+                self.pending_time = receive_time
+
+    def _send_outputs(self, flag=1):
+        mambo = self.mambo
+        # take the pending time before packing: bluepy delivers notifications while it writes, so a sensor update
+        # can set new outputs (and a new pending time) during the write and those must go out in the next packet
+        pending_time = self.pending_time
+        self.pending_time = None
+        mambo.pcmd_struct.pack_into(self.packet, 0, mambo.data_types['DATA_NO_ACK'], 0,
+                                    self.command_tuple[0], self.command_tuple[1], self.command_tuple[2], 0,
+                                    flag, self.outputs["roll"], self.outputs["pitch"], self.outputs["yaw"],
+                                    self.outputs["vertical"], 0)
+        mambo._send_precompiled_pcmd(self.packet)
+        mambo.metrics.increment("pcmd_packets_total")
+
+        if (pending_time is not None):
+            self.metrics.record("control_sensor_to_pcmd_seconds", time.time() - pending_time)
+
+    def run(self, duration, until=None):
+        """
+        Fly with the controllers (call this on the thread that talks to the drone)
+
+        :param duration: maximum number of seconds to run
+        :param until: optional function that is checked after each update and stops the loop when it returns True
+        :return: True if until stopped the loop and False if it ran for the whole duration
+        """
+        mambo = self.mambo
+        for entry in self.controllers:
+            entry.last_time = None
+        self.pending_time = None
+        mambo.add_sensor_listener(self._sensor_update)
+        self.running = True
+
+        stopped = False
+        start_time = time.time()
+        end_time = start_time + duration
+        next_keepalive = start_time
+        try:
+            while (self.running):
+                now = time.time()
+                if (now >= end_time):
+                    break
+                if (self.pending_time is not None or now >= next_keepalive):
+                    self._send_outputs()
+                    next_keepalive = time.time() + self.keepalive_interval
+                if (until is not None and until()):
+                    stopped = True
+                    break
+                # returns as soon as a notification arrives so new outputs go out right away
+                mambo._wait_for_notifications(max(min(next_keepalive, end_time) - time.time(), 0.0))
+        finally:
+            mambo.remove_sensor_listener(self._sensor_update)
+            self.running = False
+            # leave the drone hovering
+            for axis in CONTROL_AXES:
+                self.outputs[axis] = 0
+            self.pending_time = None
+            self._send_outputs(flag=0)
+        return stopped
+
+    def stop(self):
+        """
+        Stop run at its next update (e.g. from a sensor listener)
+        """
+        self.running = False
+
+    def get_stats(self):
+        """
+        :return: dictionary with 'controllers' (for each controller: the number of evaluations and snapshots of its
+        compute time and loop interval histograms, see MamboHistogram) and 'sensor_to_pcmd' (latency snapshot)
+        """
+        controllers = dict()
+        for entry in self.controllers:
+            controllers[entry.name] = {
+                'evaluations': entry.evaluations,
+                'compute': self.metrics.get_histogram_snapshot("control_compute_seconds", entry.labels),
+                'interval': self.metrics.get_histogram_snapshot("control_loop_interval_seconds", entry.labels)
+            }
+        return {
+            'controllers': controllers,
+            'sensor_to_pcmd': self.metrics.get_histogram_snapshot("control_sensor_to_pcmd_seconds")
+        }
@@ -0,0 +1,571 @@
+"""
+MamboDaemon keeps one warm BLE connection to a mambo and shares it with any number of local processes over a
+Unix domain socket.  Scripts no longer pay for parsing the xml, connecting and the handshake every time they
+start, and several cooperating processes can use the drone at once.
+
+Start the daemon (it connects and then serves until it is killed):
+
+    python MamboDaemon.py e0:14:d0:63:3d:d0 --socket /tmp/mambo.sock
+
+and use it from other processes:
+
+    from MamboDaemon import MamboDaemonClient
+    mambo = MamboDaemonClient("/tmp/mambo.sock")
+    mambo.safe_takeoff(5)
+    print mambo.get_sensors()['altitude']
+    mambo.subscribe(lambda sensors: ..., min_interval=0.05)
+    mambo.safe_land(5)
+
+BLE (bluepy) isn't thread safe so every command runs on the daemon's main thread, which is also the thread
+pumping BLE notifications.  A second thread handles the sockets: it answers sensor reads straight from
+MamboSensors and queues commands for the main thread.  It wakes the main thread through a socket pair, and the
+main thread waits on that socket and on the pipe from bluepy's helper process (where notifications arrive) at
+the same time, so it sleeps until there is something to do instead of polling.  Peripherals without a helper
+process (the simulator) are pumped in short slices (pump_interval) with a check for commands in between.
+Commands from different clients run one at a time in the order they arrive.
+
+The protocol is binary.  Every message is a 9 byte header (payload length uint32, message type uint8, request
+id uint32, little endian) followed by the payload.  Values in payloads are type tagged: 'n' None, '?' bool
+(1 byte), 'q' int (8 bytes), 'd' float (8 bytes), 's' string (uint16 length and the bytes) and 'l' list
+(uint16 count and the items).
+
+* CALL: method id (uint8, index into DAEMON_METHODS) and a list of the arguments.  Answered with RESULT or ERROR.
+* GET_SENSORS: answered with SENSORS
+* SUBSCRIBE: the minimum interval (float) between pushed SENSORS messages (request id 0).  0 unsubscribes.
+* SENSORS: list with the receive time and then the values of DAEMON_SENSOR_FIELDS
+"""
+import argparse
+import collections
+import os
+import select
+import socket
+import struct
+import threading
+import time
+import Queue
+
+MSG_CALL = 1
+MSG_GET_SENSORS = 2
+MSG_SUBSCRIBE = 3
+MSG_SENSORS = 4
+MSG_RESULT = 5
+MSG_ERROR = 6
+
+HEADER = struct.Struct("<IBI")
+MAX_PAYLOAD = 65536
+
+# commands clients can call (the index is the method id on the wire)
+DAEMON_METHODS = ("takeoff", "safe_takeoff", "land", "safe_land", "hover", "flip", "turn_degrees", "fly_direct",
+                  "open_claw", "close_claw", "fire_gun", "take_picture", "turn_on_auto_takeoff",
+                  "ask_for_state_update", "wait_for_flying_state", "smart_sleep")
+
+DAEMON_SENSOR_FIELDS = ("battery", "flying_state", "altitude", "speed_x", "speed_y", "speed_z",
+                        "quaternion_w", "quaternion_x", "quaternion_y", "quaternion_z", "claw_id", "claw_state",
+                        "gun_id", "gun_state")
+
+
+def encode_value(value, parts):
+    """
+    Append the type tagged encoding of a value to a list of strings
+    """
+    if (value is None):
+        parts.append("n")
+    elif (isinstance(value, bool)):
+        parts.append(struct.pack("<cB", "?", value))
+    elif (isinstance(value, (int, long))):
+        parts.append(struct.pack("<cq", "q", value))
+    elif (isinstance(value, float)):
+        parts.append(struct.pack("<cd", "d", value))
+    elif (isinstance(value, basestring)):
+        if (isinstance(value, unicode)):
+            value = value.encode("utf-8")
+        parts.append(struct.pack("<cH", "s", len(value)))
+        parts.append(value)
+    elif (isinstance(value, (list, tuple))):
+        parts.append(struct.pack("<cH", "l", len(value)))
+        for item in value:
+            encode_value(item, parts)
+    else:
+        raise ValueError("can't encode a %s" % type(value).__name__)
+
+
+def decode_value(data, offset=0):
+    """
+    Decode a type tagged value
+
+    :return: (value, offset after the value)
+    """
+    tag = data[offset]
+    offset += 1
+    if (tag == "n"):
+        return (None, offset)
+    if (tag == "?"):
+        return (data[offset] != "\0", offset + 1)
+    if (tag == "q"):
+        return (struct.unpack_from("<q", data, offset)[0], offset + 8)
+    if (tag == "d"):
+        return (struct.unpack_from("<d", data, offset)[0], offset + 8)
+    if (tag == "s"):
+        length = struct.unpack_from("<H", data, offset)[0]
+        offset += 2
+        return (data[offset:offset + length], offset + length)
+    if (tag == "l"):
+        count = struct.unpack_from("<H", data, offset)[0]
+        offset += 2
+        items = list()
+        for idx in range(count):
+            (item, offset) = decode_value(data, offset)
+            items.append(item)
+        return (items, offset)
+    raise ValueError("unknown value tag %r" % tag)
+
+
+def encode_message(msg_type, request_id, value=None, prefix=""):
+    """
+    :return: a complete message (header and payload) as a string
+    """
+    parts = [prefix]
+    if (value is not None or msg_type == MSG_RESULT):
+        encode_value(value, parts)
+    payload = "".join(parts)
+    return HEADER.pack(len(payload), msg_type, request_id) + payload
+
+
+class MamboMessageReader:
+    """
+    Splits the bytes read from a socket into messages
+    """
+
+    def __init__(self):
+        self.data = ""
+
+    def feed(self, data):
+        """
+        :param data: bytes read from the socket
+        :return: list of (message type, request id, payload)
+        """
+        self.data += data
+        messages = list()
+        while (len(self.data) >= HEADER.size):
+            (length, msg_type, request_id) = HEADER.unpack_from(self.data)
+            if (length > MAX_PAYLOAD):
+                raise ValueError("message too long (%d bytes)" % length)
+            if (len(self.data) < HEADER.size + length):
+                break
+            messages.append((msg_type, request_id, self.data[HEADER.size:HEADER.size + length]))
+            self.data = self.data[HEADER.size + length:]
+        return messages
+
+
+class MamboDaemonConnection:
+    """
+    One client connected to the daemon
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = MamboMessageReader()
+        self.send_lock = threading.Lock()
+        self.subscribe_interval = None
+        self.last_push = 0.0
+        self.closed = False
+
+    def send(self, message, blocking=True):
+        """
+        Send a message (pushes use blocking=False and are dropped if the client isn't keeping up)
+
+        :return: True if it was sent
+        """
+        if (self.closed):
+            return False
+        if (not blocking and not self.send_lock.acquire(False)):
+            return False
+        if (blocking):
+            self.send_lock.acquire()
+        try:
+            if (not blocking):
+                ready = select.select([], [self.sock], [], 0)[1]
+                if (len(ready) == 0):
+                    return False
+            self.sock.sendall(message)
+            return True
+        except socket.error:
+            self.closed = True
+            return False
+        finally:
+            self.send_lock.release()
+
+
+class MamboDaemon:
+    """
+    Shares a connected Mambo with local processes over a Unix domain socket
+    """
+
+    def __init__(self, mambo, socket_path="/tmp/mambo.sock", pump_interval=0.01, notification_timeout=0.1):
+        """
+        :param mambo: a connected Mambo
+        :param socket_path: path of the Unix domain socket
+        :param pump_interval: seconds the main thread waits for notifications before checking for commands when the
+        peripheral has no bluepy helper process to wait on (e.g. the simulator)
+        :param notification_timeout: longest the main thread sleeps with nothing to do (acks are sent and a lost
+        connection is noticed at least this often)
+        """
+        self.mambo = mambo
+        self.socket_path = socket_path
+        self.pump_interval = pump_interval
+        self.notification_timeout = notification_timeout
+
+        self.connections = list()
+        self.commands = Queue.Queue()
+        # the socket thread writes a byte to wake_writer when it queues a command
+        (self.wake_reader, self.wake_writer) = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.running = False
+        self.server = None
+        self.io_thread = None
+
+        mambo.add_sensor_listener(self._push_sensors)
+
+    def _sensor_values(self, receive_time):
+        # sensor reads come from the socket thread so use the snapshot (it can't be torn by a packet arriving)
+        values = dict()
+        for group in self.mambo.sensors.snapshot:
+            values.update(zip(group._fields, group))
+        return [receive_time] + [values[field] for field in DAEMON_SENSOR_FIELDS]
+
+    def _push_sensors(self, sensors, names, receive_time):
+        """
+        Sensor listener (on the main thread): send the sensors to the subscribers that are due for an update
+        """
+        message = None
+        for connection in self.connections:
+            if (connection.subscribe_interval is None or
+                    receive_time - connection.last_push < connection.subscribe_interval):
+                continue
+            if (message is None):
+                message = encode_message(MSG_SENSORS, 0, self._sensor_values(receive_time))
+            if (connection.send(message, blocking=False)):
+                connection.last_push = receive_time
+
+    def start(self):
+        """
+        Open the socket and start the thread that handles the clients
+        """
+        if (os.path.exists(self.socket_path)):
+            os.remove(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(8)
+
+        self.running = True
+        self.io_thread = threading.Thread(target=self._handle_sockets)
+        self.io_thread.daemon = True
+        self.io_thread.start()
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        """
+        self.running = False
+        self._wake()
+        if (self.io_thread is not None):
+            self.io_thread.join()
+            self.io_thread = None
+        for connection in self.connections:
+            connection.sock.close()
+        self.connections = list()
+        if (self.server is not None):
+            self.server.close()
+            self.server = None
+        if (os.path.exists(self.socket_path)):
+            os.remove(self.socket_path)
+        self.mambo.remove_sensor_listener(self._push_sensors)
+
+    def serve_forever(self):
+        """
+        Run the daemon on this thread (it must be the thread that owns the BLE connection) until stop is called
+        or ctrl-c
+        """
+        if (self.server is None):
+            self.start()
+        try:
+            while (self.running):
+                self.run_pending_commands()
+                self._wait_for_work()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _wake(self):
+        """
+        Wake the main thread (from the socket thread)
+        """
+        try:
+            self.wake_writer.send("x")
+        except socket.error:
+            # the buffer is full so it is already awake
+            pass
+
+    def _notification_pipe(self):
+        """
+        :return: the pipe from bluepy's helper process that the notifications arrive on (None if the peripheral
+        doesn't have one).  Looked up every time since reconnecting starts a new helper.
+        """
+        helper = getattr(self.mambo.drone, "_helper", None)
+        if (helper is None):
+            return None
+        return helper.stdout
+
+    def _wait_for_work(self):
+        """
+        Sleep until a notification arrives, a client queues a command or notification_timeout passes (on the main
+        thread)
+        """
+        pipe = self._notification_pipe()
+        if (pipe is None):
+            end_time = time.time() + self.notification_timeout
+            while (self.running and self.commands.empty() and time.time() < end_time):
+                self.mambo._wait_for_notifications(self.pump_interval)
+            return
+
+        readable = select.select([self.wake_reader, pipe], [], [], self.notification_timeout)[0]
+        if (self.wake_reader in readable):
+            try:
+                self.wake_reader.recv(4096)
+            except socket.error:
+                pass
+        if (pipe in readable or not readable):
+            # the notifications are waiting so this returns right away (after a timeout it sends any pending acks
+            # and notices a lost connection).  bluepy treats a timeout of 0 as wait forever.
+            self.mambo._wait_for_notifications(0.001)
+
+    def run_pending_commands(self):
+        """
+        Run the commands the clients have sent (on the thread that owns the BLE connection)
+        """
+        while True:
+            try:
+                (connection, request_id, method, args) = self.commands.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                result = getattr(self.mambo, method)(*args)
+                message = encode_message(MSG_RESULT, request_id, result)
+            except Exception as error:
+                message = encode_message(MSG_ERROR, request_id, "%s: %s" % (type(error).__name__, error))
+            connection.send(message)
+
+    def _handle_sockets(self):
+        """
+        Socket thread: accept clients, read their messages, answer sensor reads and queue the commands
+        """
+        while (self.running):
+            sockets = [self.server] + [connection.sock for connection in self.connections]
+            readable = select.select(sockets, [], [], 0.1)[0]
+            for sock in readable:
+                if (sock is self.server):
+                    (client, address) = self.server.accept()
+                    self.connections = self.connections + [MamboDaemonConnection(client)]
+                    continue
+
+                connection = [other for other in self.connections if other.sock is sock][0]
+                try:
+                    data = sock.recv(65536)
+                    messages = connection.reader.feed(data) if data else None
+                except (socket.error, ValueError):
+                    messages = None
+
+                if (messages is None):
+                    connection.closed = True
+                    sock.close()
+                    self.connections = [other for other in self.connections if other is not connection]
+                    continue
+
+                for (msg_type, request_id, payload) in messages:
+                    self._handle_message(connection, msg_type, request_id, payload)
+
+    def _handle_message(self, connection, msg_type, request_id, payload):
+        try:
+            if (msg_type == MSG_CALL):
+                method_id = ord(payload[0])
+                if (method_id >= len(DAEMON_METHODS)):
+                    raise ValueError("unknown method id %d" % method_id)
+                (args, offset) = decode_value(payload, 1)
+                self.commands.put((connection, request_id, DAEMON_METHODS[method_id], args))
+                self._wake()
+            elif (msg_type == MSG_GET_SENSORS):
+                connection.send(encode_message(MSG_SENSORS, request_id, self._sensor_values(time.time())))
+            elif (msg_type == MSG_SUBSCRIBE):
+                (interval, offset) = decode_value(payload)
+                if (interval is None or interval <= 0):
+                    connection.subscribe_interval = None
+                else:
+                    connection.subscribe_interval = interval
+                connection.send(encode_message(MSG_RESULT, request_id, True))
+            else:
+                raise ValueError("unknown message type %d" % msg_type)
+        except (ValueError, IndexError, struct.error) as error:
+            connection.send(encode_message(MSG_ERROR, request_id, str(error)))
+
+
+class MamboDaemonError(Exception):
+    """
+    Raised by the client when the daemon reports an error
+    """
+    pass
+
+
+class MamboDaemonClient:
+    """
+    Uses a mambo through a MamboDaemon.  The DAEMON_METHODS can be called as methods (e.g. client.takeoff()).
+    """
+
+    def __init__(self, socket_path="/tmp/mambo.sock", timeout=60.0):
+        """
+        :param socket_path: path of the daemon's socket
+        :param timeout: seconds to wait for the reply to a command
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.send_lock = threading.Lock()
+
+        self.next_request_id = 1
+        self.replies = dict()
+        self.reply_ready = threading.Condition()
+        self.subscriber = None
+
+        # latest pushed sensors
+        self.sensors = None
+        self.closed = False
+
+        self.reader_thread = threading.Thread(target=self._read_messages)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+
+    def _read_messages(self):
+        reader = MamboMessageReader()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                data = ""
+            if (not data):
+                break
+
+            for (msg_type, request_id, payload) in reader.feed(data):
+                value = decode_value(payload)[0] if payload else None
+                if (msg_type == MSG_SENSORS):
+                    value = self._sensor_dict(value)
+                if (request_id == 0):
+                    self.sensors = value
+                    if (self.subscriber is not None):
+                        self.subscriber(value)
+                    continue
+                with self.reply_ready:
+                    self.replies[request_id] = (msg_type, value)
+                    self.reply_ready.notify_all()
+
+        with self.reply_ready:
+            self.closed = True
+            self.reply_ready.notify_all()
+
+    def _sensor_dict(self, values):
+        sensors = dict(zip(DAEMON_SENSOR_FIELDS, values[1:]))
+        sensors['receive_time'] = values[0]
+        return sensors
+
+    def _request(self, msg_type, value=None, prefix="", timeout=None):
+        with self.reply_ready:
+            request_id = self.next_request_id
+            self.next_request_id = self.next_request_id % 0xffffffff + 1
+
+        with self.send_lock:
+            self.sock.sendall(encode_message(msg_type, request_id, value, prefix))
+
+        if (timeout is None):
+            timeout = self.timeout
+        end_time = time.time() + timeout
+        with self.reply_ready:
+            while (request_id not in self.replies):
+                remaining = end_time - time.time()
+                if (self.closed or remaining <= 0):
+                    raise MamboDaemonError("no reply from the daemon")
+                self.reply_ready.wait(remaining)
+            (reply_type, value) = self.replies.pop(request_id)
+
+        if (reply_type == MSG_ERROR):
+            raise MamboDaemonError(value)
+        return value
+
+    def call(self, method, *args):
+        """
+        Call a Mambo method in the daemon
+
+        :param method: name of the method (one of DAEMON_METHODS)
+        :param args: its arguments
+        :return: what the method returned
+        """
+        if (method not in DAEMON_METHODS):
+            raise ValueError("%s can't be called through the daemon" % method)
+        return self._request(MSG_CALL, list(args), prefix=chr(DAEMON_METHODS.index(method)))
+
+    def __getattr__(self, name):
+        if (name in DAEMON_METHODS):
+            return lambda *args: self.call(name, *args)
+        raise AttributeError(name)
+
+    def get_sensors(self):
+        """
+        :return: dictionary with the current DAEMON_SENSOR_FIELDS and the receive_time
+        """
+        return self._request(MSG_GET_SENSORS)
+
+    def subscribe(self, callback=None, min_interval=0.05):
+        """
+        Have the daemon push the sensors as they arrive (the latest are always in self.sensors)
+
+        :param callback: optional function called with the sensor dictionary (on the client's reader thread)
+        :param min_interval: minimum seconds between pushes
+        """
+        self.subscriber = callback
+        self._request(MSG_SUBSCRIBE, float(min_interval))
+
+    def unsubscribe(self):
+        """
+        Stop the sensor pushes
+        """
+        self._request(MSG_SUBSCRIBE, 0.0)
+        self.subscriber = None
+
+    def close(self):
+        """
+        Disconnect from the daemon (the daemon keeps the drone connected)
+        """
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share a mambo's BLE connection over a Unix domain socket")
+    parser.add_argument("address", help="BLE address of the mambo (or 'simulator' to use MamboSimulator)")
+    parser.add_argument("--socket", default="/tmp/mambo.sock", help="path of the Unix domain socket")
+    args = parser.parse_args()
+
+    from Mambo import Mambo
+    mambo = Mambo(args.address)
+    if (args.address == "simulator"):
+        from MamboSimulator import MamboFleetSimulator, SimulatedPeripheral
+        mambo.drone = SimulatedPeripheral(MamboFleetSimulator(num_drones=1), index=0)
+
+    print "connecting to %s" % args.address
+    if (not mambo.connect(num_retries=3)):
+        raise SystemExit("could not connect to %s" % args.address)
+
+    print "serving on %s" % args.socket
+    daemon = MamboDaemon(mambo, args.socket)
+    daemon.serve_forever()
+    mambo.disconnect()
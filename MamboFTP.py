@@ -0,0 +1,265 @@
+"""
+MamboFTP is a client for the FTP the mambo runs over BLE (used to list, download and delete the
+pictures taken with take_picture).  The protocol follows ARUTILS_BLEFtp.m in the Parrot SDK:
+
+* commands ("LIS", "GET", "DEL" followed by the path) are written to the NORMAL_FTP_HANDLING characteristic
+* the reply is sent back as notifications on the NORMAL_FTP_GETTING characteristic in packets of at most
+  132 bytes
+* while downloading, the drone stops after every 100 packets and sends "MD5" plus the md5 of that block.
+  We check it and answer "MD5 OK" to get the next block
+* the end of a transfer is marked with "End of Transfer" and then "MD5" plus the md5 of the whole file
+
+Downloads are streamed one packet at a time (at most one block is ever queued) so memory use doesn't depend
+on the file size.  get_file() writes to a .part file and can resume it after a disconnect: the drone always
+sends the file from the start so the bytes we already have are skipped (but still checked with the md5).
+"""
+import collections
+import hashlib
+import os
+import time
+
+BLE_PACKET_MAX_SIZE = 132
+BLE_PACKET_EOF = "End of Transfer"
+BLE_PACKET_MD5 = "MD5"
+BLE_PACKET_MD5_OK = "MD5 OK"
+BLE_PACKET_DELETE_SUCCESS = "Delete successful"
+BLE_PACKET_BLOCK_GETTING_COUNT = 100
+
+
+class MamboFTPError(Exception):
+    """
+    Raised when an FTP transfer fails (timeout or an error reply from the drone)
+    """
+    pass
+
+
+class MamboFTPChecksumError(MamboFTPError):
+    """
+    Raised when the md5 sent by the drone doesn't match the data received
+    """
+    pass
+
+
+class MamboFTP:
+    """
+    FTP over BLE for a connected Mambo.  The Mambo creates one of these as mambo.ftp.
+    """
+
+    def __init__(self, mambo, media_path="/internal_000/mambo/media/", packet_timeout=5.0, max_retries=3):
+        """
+        :param mambo: the Mambo (it routes the FTP notifications here)
+        :param media_path: folder on the drone where the pictures are stored
+        :param packet_timeout: seconds to wait for the next packet before giving up
+        :param max_retries: number of times get_file restarts a download after a failure
+        """
+        self.mambo = mambo
+        self.media_path = media_path
+        self.packet_timeout = packet_timeout
+        self.max_retries = max_retries
+
+        # packets received on the getting characteristic that haven't been read yet.  The drone sends at most
+        # a block (100 packets) before waiting for our MD5 OK so this never holds more than that.
+        self.packets = collections.deque()
+
+    def _handle_notification(self, channel, data):
+        """
+        Called by the Mambo for every notification on one of the FTP characteristics
+
+        :param channel: name of the FTP characteristic
+        :param data: the packet
+        """
+        if (channel == 'NORMAL_FTP_GETTING'):
+            self.packets.append(data)
+        else:
+            self.mambo._debug_print("ftp data on %s: %s" % (channel, data), 2)
+
+    def _send_command(self, command, param):
+        """
+        Send a command (with its null terminated parameter) to the FTP handling characteristic
+
+        :param command: "LIS", "GET" or "DEL"
+        :param param: path on the drone
+        """
+        self.packets.clear()
+        packet = command + param + "\0"
+        if (len(packet) > BLE_PACKET_MAX_SIZE):
+            raise MamboFTPError("path is too long for a BLE FTP command: %s" % param)
+        self.mambo._safe_ble_write(characteristic=self.mambo.ftp_characteristics['NORMAL_FTP_HANDLING'],
+                                   packet=packet)
+
+    def _send_response(self, response):
+        """
+        Send a response (e.g. MD5 OK) on the FTP getting characteristic
+        """
+        self.mambo._safe_ble_write(characteristic=self.mambo.ftp_characteristics['NORMAL_FTP_GETTING'],
+                                   packet=response + "\0")
+
+    def _next_packet(self):
+        """
+        Wait for the next packet from the drone (handling BLE notifications while waiting)
+
+        :return: the packet as a string
+        """
+        end_time = time.time() + self.packet_timeout
+        while (len(self.packets) == 0):
+            remaining = end_time - time.time()
+            if (remaining <= 0):
+                raise MamboFTPError("timed out waiting for FTP data")
+            self.mambo._wait_for_notifications(min(remaining, 0.1))
+        return str(self.packets.popleft())
+
+    def _is_md5_packet(self, packet):
+        return (packet.startswith(BLE_PACKET_MD5) and len(packet.rstrip("\0")) == len(BLE_PACKET_MD5) + 32)
+
+    def _iter_transfer(self, file_md5, skip=0):
+        """
+        Read the reply to a LIS or GET one packet at a time, checking the block and file md5s
+
+        :param file_md5: hashlib md5 object for the whole file (may already include bytes we skip)
+        :param skip: number of bytes at the start of the file to skip (already downloaded)
+        :return: generator of the data packets
+        """
+        block_md5 = hashlib.md5()
+        block_count = 0
+        received = 0
+
+        while True:
+            packet = self._next_packet()
+
+            if (packet.startswith(BLE_PACKET_EOF)):
+                break
+
+            if (block_count == BLE_PACKET_BLOCK_GETTING_COUNT and self._is_md5_packet(packet)):
+                # end of a block: check it and ask for the next one
+                if (packet[3:35] != block_md5.hexdigest()):
+                    raise MamboFTPChecksumError("md5 mismatch in block ending at byte %d" % received)
+                self._send_response(BLE_PACKET_MD5_OK)
+                block_md5 = hashlib.md5()
+                block_count = 0
+                continue
+
+            block_count += 1
+            block_md5.update(packet)
+
+            # skip anything we already have (it was hashed when we resumed)
+            if (received + len(packet) <= skip):
+                received += len(packet)
+                continue
+            elif (received < skip):
+                packet = packet[skip - received:]
+                received = skip
+
+            received += len(packet)
+            file_md5.update(packet)
+            yield packet
+
+        # the md5 of the whole file follows the end of transfer
+        packet = self._next_packet()
+        if (not self._is_md5_packet(packet)):
+            raise MamboFTPError("expected the file md5 after the end of the transfer")
+        if (packet[3:35] != file_md5.hexdigest()):
+            raise MamboFTPChecksumError("md5 mismatch for the whole file")
+
+    def list_files(self, path=None):
+        """
+        List the files in a folder on the drone
+
+        :param path: folder on the drone (defaults to the media folder)
+        :return: list of (name, size in bytes) for the files in the folder
+        """
+        if (path is None):
+            path = self.media_path
+
+        self._send_command(self.mambo.ftp_commands["list"], path)
+        listing = "".join(self._iter_transfer(hashlib.md5()))
+
+        # the listing looks like ls -l: "-rw-r--r--    1 root     root     123456 Jan  1 00:00 name.jpg"
+        files = list()
+        for line in listing.replace("\0", "").splitlines():
+            parts = line.split(None, 8)
+            if (len(parts) == 9 and line.startswith("-")):
+                files.append((parts[8], int(parts[4])))
+        return files
+
+    def iter_file(self, name, path=None):
+        """
+        Download a file from the drone chunk by chunk.  The md5 is checked at the end (raises MamboFTPError if
+        it doesn't match).
+
+        :param name: name of the file
+        :param path: folder on the drone (defaults to the media folder)
+        :return: generator of the chunks of the file
+        """
+        if (path is None):
+            path = self.media_path
+
+        self._send_command(self.mambo.ftp_commands["get"], path + name)
+        for chunk in self._iter_transfer(hashlib.md5()):
+            yield chunk
+
+    def get_file(self, name, local_path, path=None, resume=True):
+        """
+        Download a file from the drone into a local file.  The data is streamed into local_path + ".part" which is
+        renamed once the md5 has been checked.  If the download fails (or the BLE disconnects) it is restarted
+        up to max_retries times, skipping the bytes already written (or from scratch after an md5 mismatch).
+
+        :param name: name of the file on the drone
+        :param local_path: where to save it
+        :param path: folder on the drone (defaults to the media folder)
+        :param resume: if True (default), continue an existing .part file from an earlier download
+        :return: md5 (hex string) of the downloaded file
+        """
+        if (path is None):
+            path = self.media_path
+        part_path = local_path + ".part"
+
+        if (not resume and os.path.exists(part_path)):
+            os.remove(part_path)
+
+        tries = 0
+        while True:
+            # hash what we already have so the md5 of the whole file can still be checked
+            file_md5 = hashlib.md5()
+            skip = 0
+            if (os.path.exists(part_path)):
+                with open(part_path, "rb") as part_file:
+                    for chunk in iter(lambda: part_file.read(65536), ""):
+                        file_md5.update(chunk)
+                        skip += len(chunk)
+
+            try:
+                self._send_command(self.mambo.ftp_commands["get"], path + name)
+                with open(part_path, "ab") as part_file:
+                    for chunk in self._iter_transfer(file_md5, skip):
+                        part_file.write(chunk)
+                break
+            except MamboFTPError as error:
+                tries += 1
+                self.mambo._debug_print("ftp download of %s failed (%s), try %d" % (name, error, tries), 10)
+                if (tries > self.max_retries):
+                    raise
+
+                # bad data can't be resumed so start over
+                if (isinstance(error, MamboFTPChecksumError) and os.path.exists(part_path)):
+                    os.remove(part_path)
+
+        os.rename(part_path, local_path)
+        return file_md5.hexdigest()
+
+    def delete_file(self, name, path=None):
+        """
+        Delete a file on the drone
+
+        :param name: name of the file
+        :param path: folder on the drone (defaults to the media folder)
+        :return: True if the drone reported it was deleted and False otherwise
+        """
+        if (path is None):
+            path = self.media_path
+
+        self._send_command(self.mambo.ftp_commands["delete"], path + name)
+        try:
+            packet = self._next_packet()
+        except MamboFTPError:
+            return False
+        return packet.startswith(BLE_PACKET_DELETE_SUCCESS)
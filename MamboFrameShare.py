@@ -0,0 +1,311 @@
+"""
+MamboFrameShare lets other processes (a detector, a recorder, an operator display, ...) read the frames that
+MamboVision decodes without each of them opening its own connection to the mambo's RTSP stream (which the
+mambo handles poorly).  The frames are decoded once and published into a ring of slots in a memory mapped
+file under /dev/shm that any number of processes can attach to.
+
+Python 2 has no multiprocessing.shared_memory so the ring is an mmap of a file in /dev/shm (a RAM backed
+file system on linux, falling back to the temp directory elsewhere).  The file holds:
+
+* a header: magic, version, number of slots, height, width, channels and the sequence number of the latest frame
+* the sequence number and capture time of the frame in each slot
+* the frames themselves (uint8, slots x height x width x channels)
+
+Each slot works as a seqlock: the publisher marks the slot as being written (sequence -1), copies the frame in,
+and then writes the frame's sequence number.  Readers check that the slot's sequence number is the one they
+expect before and after reading it.
+
+A new ring (when the publisher starts, or when the frame size changes because a MamboVisionGovernor changed
+the downscale or roi) is written to a temporary file and renamed into place, so clients still mapping the old
+ring are never truncated under.  Clients notice that the file was replaced (its inode changed) and attach to
+the new ring.
+
+In the process doing the capture:
+
+    vision.start_frame_sharing("mambo_frames")
+
+In the other processes:
+
+    client = MamboFrameShareClient("mambo_frames")
+    (frame_seq, frame_time, image) = client.wait_for_new_frame(timeout=1.0)
+"""
+import mmap
+import os
+import tempfile
+import time
+
+import numpy as np
+
+FRAME_SHARE_MAGIC = 0x4d414d424f465348
+FRAME_SHARE_VERSION = 1
+
+# positions in the header (int64 words)
+HEADER_MAGIC = 0
+HEADER_VERSION = 1
+HEADER_SLOTS = 2
+HEADER_HEIGHT = 3
+HEADER_WIDTH = 4
+HEADER_CHANNELS = 5
+HEADER_LATEST_SEQ = 6
+HEADER_WORDS = 8
+
+# slot sequence number while the publisher is writing the slot
+SLOT_WRITING = -1
+
+
+def frame_share_path(name):
+    """
+    :param name: name of the shared frame ring
+    :return: path of its file (in /dev/shm if it exists)
+    """
+    if (os.path.isdir("/dev/shm")):
+        return os.path.join("/dev/shm", name)
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def _map_arrays(mapped, slots, shape):
+    """
+    Create the numpy views of the header, slot sequences, slot times and frames in a mapped file
+
+    :return: (header, slot_seqs, slot_times, frames)
+    """
+    offset = HEADER_WORDS * 8
+    header = np.ndarray((HEADER_WORDS,), dtype=np.int64, buffer=mapped, offset=0)
+    slot_seqs = np.ndarray((slots,), dtype=np.int64, buffer=mapped, offset=offset)
+    offset += 8 * slots
+    slot_times = np.ndarray((slots,), dtype=np.float64, buffer=mapped, offset=offset)
+    offset += 8 * slots
+    # start the frames on a 64 byte boundary
+    offset = (offset + 63) // 64 * 64
+    frames = np.ndarray((slots,) + shape, dtype=np.uint8, buffer=mapped, offset=offset)
+    return (header, slot_seqs, slot_times, frames)
+
+
+def _file_size(slots, shape):
+    offset = (HEADER_WORDS * 8 + 16 * slots + 63) // 64 * 64
+    return offset + slots * int(np.prod(shape))
+
+
+class MamboFrameSharePublisher:
+    """
+    Writes frames into the shared ring (MamboVision creates one in start_frame_sharing)
+    """
+
+    def __init__(self, name, shape, slots=4):
+        """
+        :param name: name of the shared frame ring (the file name in /dev/shm)
+        :param shape: (height, width, channels) of the first frames.  A frame of another shape replaces the ring
+        with one of the new shape.
+        :param slots: number of frames in the ring.  A reader's view of a frame stays valid until slots - 1 newer
+        frames have been published.
+        """
+        self.name = name
+        self.path = frame_share_path(name)
+        self.slots = slots
+
+        # number of times the ring was replaced because the frame size changed
+        self.resized = 0
+
+        self._create(tuple(shape))
+
+    def _create(self, shape):
+        """
+        Create a ring for frames of a shape in a temporary file and rename it into place
+        """
+        self.shape = shape
+        size = _file_size(self.slots, shape)
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mapped = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+        (self.header, self.slot_seqs, self.slot_times, self.frames) = _map_arrays(self.mapped, self.slots, shape)
+        self.header[HEADER_VERSION] = FRAME_SHARE_VERSION
+        self.header[HEADER_SLOTS] = self.slots
+        self.header[HEADER_HEIGHT] = shape[0]
+        self.header[HEADER_WIDTH] = shape[1]
+        self.header[HEADER_CHANNELS] = shape[2]
+        self.header[HEADER_LATEST_SEQ] = 0
+        self.header[HEADER_MAGIC] = FRAME_SHARE_MAGIC
+
+        # clients attached to the old ring keep their mapping (the old file is only unlinked)
+        os.rename(tmp_path, self.path)
+
+    def publish(self, frame, frame_time, frame_seq):
+        """
+        Copy a frame into the ring
+
+        :param frame: the image (if its shape isn't the ring's, the ring is replaced by one of the new shape)
+        :param frame_time: capture time of the frame
+        :param frame_seq: sequence number of the frame (must increase and start at 1)
+        :return: True once the frame is published
+        """
+        if (frame.shape != self.shape):
+            self._create(frame.shape)
+            self.resized += 1
+
+        slot = frame_seq % self.slots
+        self.slot_seqs[slot] = SLOT_WRITING
+        self.frames[slot] = frame
+        self.slot_times[slot] = frame_time
+        self.slot_seqs[slot] = frame_seq
+        self.header[HEADER_LATEST_SEQ] = frame_seq
+        return True
+
+    def close(self):
+        """
+        Remove the shared ring (attached clients keep their mapping until they close it).  The memory is unmapped
+        once nothing refers to it any more.
+        """
+        self.header = self.slot_seqs = self.slot_times = self.frames = self.mapped = None
+        if (os.path.exists(self.path)):
+            os.remove(self.path)
+
+
+class MamboFrameShareClient:
+    """
+    Reads frames from a shared ring in another process
+    """
+
+    def __init__(self, name, attach_timeout=5.0):
+        """
+        :param name: name of the shared frame ring (the name given to start_frame_sharing)
+        :param attach_timeout: seconds to wait for the publisher to create the ring
+        """
+        self.name = name
+        self.path = frame_share_path(name)
+
+        end_time = time.time() + attach_timeout
+        while (not self._attach()):
+            if (time.time() > end_time):
+                raise IOError("no shared frames named %s" % name)
+            time.sleep(0.05)
+
+    def _attach(self):
+        """
+        Map the ring if the publisher has finished creating it
+
+        :return: True if attached and False otherwise
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+
+        try:
+            stat = os.fstat(fd)
+            if (stat.st_size < HEADER_WORDS * 8):
+                return False
+            mapped = mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        header = np.ndarray((HEADER_WORDS,), dtype=np.int64, buffer=mapped, offset=0)
+        if (header[HEADER_MAGIC] != FRAME_SHARE_MAGIC or header[HEADER_VERSION] != FRAME_SHARE_VERSION):
+            mapped.close()
+            return False
+
+        self.slots = int(header[HEADER_SLOTS])
+        self.shape = (int(header[HEADER_HEIGHT]), int(header[HEADER_WIDTH]), int(header[HEADER_CHANNELS]))
+        self.mapped = mapped
+        (self.header, self.slot_seqs, self.slot_times, self.frames) = _map_arrays(mapped, self.slots, self.shape)
+        # the publisher replaces the file (a new inode) when it restarts or the frame size changes
+        self.inode = stat.st_ino
+        return True
+
+    def reattach_if_replaced(self):
+        """
+        Attach to the publisher's new ring if it replaced the one this client is reading (the publisher restarted
+        or the frame size changed).  get_latest_frame and wait_for_new_frame check this themselves.  shape may
+        change, so arrays passed as out have to be reallocated.
+
+        :return: True if the client attached to a new ring
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            # the publisher stopped: keep reading the old ring until a new one appears
+            return False
+        if (inode == self.inode):
+            return False
+        return self._attach()
+
+    def get_latest_seq(self):
+        """
+        :return: sequence number of the latest published frame (0 before the first frame)
+        """
+        return int(self.header[HEADER_LATEST_SEQ])
+
+    def is_valid(self, frame_seq):
+        """
+        Check that a frame returned without a copy hasn't been overwritten yet
+
+        :param frame_seq: sequence number of the frame
+        :return: True if the frame is still in its slot
+        """
+        return self.slot_seqs[frame_seq % self.slots] == frame_seq
+
+    def get_latest_frame(self, out=None):
+        """
+        Read the latest frame
+
+        :param out: optional array (of the ring's shape) to copy the frame into.  If this is None, the image is a
+        read only view into the shared memory (no copy) that stays valid until slots - 1 newer frames have been
+        published (check with is_valid).
+        :return: (frame_seq, frame_time, image) or None before the first frame
+        """
+        self.reattach_if_replaced()
+        while True:
+            frame_seq = int(self.header[HEADER_LATEST_SEQ])
+            if (frame_seq == 0):
+                return None
+
+            slot = frame_seq % self.slots
+            if (self.slot_seqs[slot] != frame_seq):
+                # the publisher lapped us, try the new latest frame
+                continue
+
+            frame_time = float(self.slot_times[slot])
+            if (out is None):
+                image = self.frames[slot]
+            else:
+                np.copyto(out, self.frames[slot])
+                image = out
+
+            if (self.slot_seqs[slot] == frame_seq):
+                return (frame_seq, frame_time, image)
+
+    def wait_for_new_frame(self, timeout=None, last_seq=None, out=None, poll_interval=0.005):
+        """
+        Wait for a frame newer than last_seq (polls the header since there is no wakeup across processes)
+
+        :param timeout: maximum seconds to wait (None waits forever)
+        :param last_seq: sequence number of the last frame you have seen (defaults to the latest frame now)
+        :param out: optional array to copy the frame into (see get_latest_frame)
+        :param poll_interval: seconds between checks
+        :return: (frame_seq, frame_time, image) or None if no new frame arrived before the timeout
+        """
+        if (last_seq is None):
+            last_seq = self.get_latest_seq()
+        if (timeout is not None):
+            end_time = time.time() + timeout
+
+        while (self.get_latest_seq() <= last_seq):
+            if (self.reattach_if_replaced()):
+                # sequence numbers start over in a restarted publisher so any frame in the new ring is new
+                last_seq = 0
+                continue
+            if (timeout is not None and time.time() >= end_time):
+                return None
+            time.sleep(poll_interval)
+
+        return self.get_latest_frame(out)
+
+    def close(self):
+        """
+        Detach from the ring (the memory is unmapped once no images returned without a copy are left)
+        """
+        self.header = self.slot_seqs = self.slot_times = self.frames = self.mapped = None
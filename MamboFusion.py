@@ -0,0 +1,223 @@
+"""
+MamboFusion lines up video frames with the drone's sensors.  Vision based control needs the attitude and
+altitude at the moment a frame was captured, not whatever arrived over BLE most recently.
+
+MamboSensorHistory listens to the mambo's sensor packets (add_sensor_listener) and keeps a fixed size ring of
+timestamped samples (numpy arrays, nothing is allocated per sample).  Frames from MamboVision carry their
+capture time so the sensor state for a frame (or for many frames at once) is interpolated with np.interp:
+
+    history = MamboSensorHistory(mambo)
+    ...
+    (frame_seq, frame_time, image) = vision.wait_for_new_frame(timeout=1.0)
+    state = history.state_for_frame(frame_time)
+    print state['altitude'], state['roll'], state['pitch'], state['yaw']
+
+Both the frame and the sensor timestamps are time.time() on this computer (python 2 has no monotonic clock
+in the standard library).  The timestamps the drone puts in its packets are not used since the drone's clock
+isn't synchronized with ours.
+
+Each packet only carries one message (DroneAltitude, DroneQuaternion or DroneSpeed), so every sample also
+records which fields the packet actually updated.  A field is only interpolated between the samples where it
+was updated: the values held over from older packets would otherwise look like steps at the wrong times.
+
+Quaternions are interpolated component by component and normalized again (nlerp), which is accurate for the
+short gaps between sensor packets.
+"""
+import threading
+
+import numpy as np
+
+from MamboNavigation import quaternions_to_euler
+
+DEFAULT_FUSION_FIELDS = ("altitude", "quaternion_w", "quaternion_x", "quaternion_y", "quaternion_z",
+                         "speed_x", "speed_y", "speed_z")
+
+# the last argument of each navigation packet (the sample is complete when it arrives)
+DEFAULT_FUSION_TRIGGERS = ("DroneAltitude_ts", "DroneQuaternion_ts", "DroneSpeed_ts")
+
+QUATERNION_FIELDS = ("quaternion_w", "quaternion_x", "quaternion_y", "quaternion_z")
+
+# the sensor message that updates each MamboSensors field (fields not listed count as updated by every sample)
+FUSION_FIELD_MESSAGES = {
+    'altitude': "DroneAltitude",
+    'altitude_ts': "DroneAltitude",
+    'quaternion_w': "DroneQuaternion",
+    'quaternion_x': "DroneQuaternion",
+    'quaternion_y': "DroneQuaternion",
+    'quaternion_z': "DroneQuaternion",
+    'quaternion_ts': "DroneQuaternion",
+    'speed_x': "DroneSpeed",
+    'speed_y': "DroneSpeed",
+    'speed_z': "DroneSpeed",
+    'speed_ts': "DroneSpeed",
+    'battery': "BatteryStateChanged",
+}
+
+
+class MamboSensorHistory:
+    """
+    Ring of timestamped sensor samples that can be interpolated at any time (e.g. a frame's capture time)
+    """
+
+    def __init__(self, mambo, size=2048, fields=DEFAULT_FUSION_FIELDS, trigger_names=DEFAULT_FUSION_TRIGGERS):
+        """
+        :param mambo: the Mambo (the history adds itself as a sensor listener)
+        :param size: number of samples kept.  The navigation sensors arrive about 15 times a second so the default
+        covers a couple of minutes.
+        :param fields: names of the MamboSensors attributes to record (numbers only)
+        :param trigger_names: record a sample when a packet has one of these sensor names (None records a sample
+        for every sensor packet)
+        """
+        self.mambo = mambo
+        self.size = size
+        self.fields = tuple(fields)
+        self.field_index = dict([(field, idx) for (idx, field) in enumerate(self.fields)])
+        if (trigger_names is not None):
+            trigger_names = frozenset(trigger_names)
+        self.trigger_names = trigger_names
+
+        self.times = np.zeros(size)
+        self.values = np.zeros((size, len(self.fields)))
+        # which fields each sample's packet actually updated (the rest hold their older values)
+        self.updated = np.zeros((size, len(self.fields)), dtype=bool)
+        self.update_masks = dict()
+
+        # total number of samples recorded (the newest is at (count - 1) % size)
+        self.count = 0
+        self.lock = threading.Lock()
+
+        mambo.add_sensor_listener(self._sensor_update)
+
+    def close(self):
+        """
+        Stop recording
+        """
+        self.mambo.remove_sensor_listener(self._sensor_update)
+
+    def _sensor_update(self, sensors, names, receive_time):
+        """
+        Sensor listener: record a sample when a navigation packet arrives
+        """
+        if (self.trigger_names is not None and self.trigger_names.isdisjoint(names)):
+            return
+
+        message = names[0].split("_")[0]
+        mask = self.update_masks.get(message)
+        if (mask is None):
+            mask = np.array([FUSION_FIELD_MESSAGES.get(field, message) == message for field in self.fields])
+            self.update_masks[message] = mask
+
+        with self.lock:
+            index = self.count % self.size
+            self.times[index] = receive_time
+            self.updated[index] = mask
+            row = self.values[index]
+            for (idx, field) in enumerate(self.fields):
+                row[idx] = getattr(sensors, field)
+            self.count += 1
+
+    def _copy_history(self):
+        """
+        :return: (times, values, updated) copies of the recorded samples, oldest first
+        """
+        with self.lock:
+            if (self.count <= self.size):
+                return (self.times[:self.count].copy(), self.values[:self.count].copy(),
+                        self.updated[:self.count].copy())
+            start = self.count % self.size
+            return (np.roll(self.times, -start), np.roll(self.values, -start, axis=0),
+                    np.roll(self.updated, -start, axis=0))
+
+    def get_history(self):
+        """
+        Copy of the recorded samples, oldest first.  A field that the sample's packet didn't update holds the
+        value from an older packet.
+
+        :return: (times, values): array of N times and array of shape (N, number of fields)
+        """
+        (times, values, updated) = self._copy_history()
+        return (times, values)
+
+    def window(self, start_time, end_time):
+        """
+        The samples recorded between two times
+
+        :return: (times, values) as in get_history
+        """
+        (times, values) = self.get_history()
+        first = np.searchsorted(times, start_time, side='left')
+        last = np.searchsorted(times, end_time, side='right')
+        return (times[first:last], values[first:last])
+
+    def interpolate(self, query_times):
+        """
+        Interpolate every field at each of the query times (all at once, with np.interp)
+
+        :param query_times: array of times (time.time() values, e.g. frame capture times)
+        :return: (values, valid): array of shape (len(query_times), number of fields) and a boolean array that is
+        False for times outside of the recorded history of any field (those get the field's first or last value)
+        """
+        query_times = np.atleast_1d(np.asarray(query_times, dtype=float))
+        (times, values, updated) = self._copy_history()
+        result = np.zeros((len(query_times), len(self.fields)))
+        valid = np.ones(len(query_times), dtype=bool)
+
+        quaternion_columns = [self.field_index[field] for field in QUATERNION_FIELDS if field in self.field_index]
+        if (len(quaternion_columns) == 4):
+            # q and -q are the same rotation so flip any sample on the other side from its predecessor before
+            # interpolating (only the samples that carried a quaternion)
+            rows = updated[:, quaternion_columns[0]]
+            quaternions = values[rows][:, quaternion_columns]
+            if (len(quaternions) > 1):
+                flips = np.sum(quaternions[1:] * quaternions[:-1], axis=1) < 0
+                signs = np.concatenate(([1.0], np.cumprod(np.where(flips, -1.0, 1.0))))
+                values[np.ix_(rows, quaternion_columns)] = quaternions * signs[:, np.newaxis]
+
+        for column in range(len(self.fields)):
+            # each field only between the samples where its packet arrived
+            rows = updated[:, column]
+            field_times = times[rows]
+            if (len(field_times) == 0):
+                valid[:] = False
+                continue
+            result[:, column] = np.interp(query_times, field_times, values[rows, column])
+            valid &= (query_times >= field_times[0]) & (query_times <= field_times[-1])
+
+        if (len(quaternion_columns) == 4):
+            norms = np.linalg.norm(result[:, quaternion_columns], axis=1)
+            norms[norms == 0] = 1.0
+            result[:, quaternion_columns] /= norms[:, np.newaxis]
+
+        return (result, valid)
+
+    def states_for_frames(self, frame_times):
+        """
+        Sensor state at the capture time of each frame
+
+        :param frame_times: array of frame capture times
+        :return: dictionary of field name to an array of values (one per frame), plus 'roll', 'pitch' and 'yaw'
+        (degrees, if the quaternion is recorded), 'time' and 'valid'
+        """
+        frame_times = np.atleast_1d(np.asarray(frame_times, dtype=float))
+        (values, valid) = self.interpolate(frame_times)
+        states = dict([(field, values[:, idx]) for (idx, field) in enumerate(self.fields)])
+        if (all([field in self.field_index for field in QUATERNION_FIELDS])):
+            quaternion_columns = [self.field_index[field] for field in QUATERNION_FIELDS]
+            euler = np.degrees(quaternions_to_euler(values[:, quaternion_columns]))
+            states['roll'] = euler[:, 0]
+            states['pitch'] = euler[:, 1]
+            states['yaw'] = euler[:, 2]
+        states['time'] = frame_times
+        states['valid'] = valid
+        return states
+
+    def state_for_frame(self, frame_time):
+        """
+        Sensor state at the capture time of one frame
+
+        :param frame_time: capture time of the frame (from MamboVision.get_latest_frame or wait_for_new_frame)
+        :return: dictionary of field name to value, plus 'roll', 'pitch' and 'yaw' (degrees), 'time' and 'valid'
+        (False if the frame is outside of the recorded history)
+        """
+        states = self.states_for_frames([frame_time])
+        return dict([(key, value[0].item()) for (key, value) in states.items()])
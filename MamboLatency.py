@@ -0,0 +1,111 @@
+"""
+MamboLatency measures glass to command latency for vision in the loop control: the time from a frame being
+captured by MamboVision to the PCMD packet it produced being written to BLE.
+
+A trace follows one frame through each hop:
+
+* capture: the frame was saved by MamboVision (its frame_time)
+* dequeue: your code picked the frame up (begin)
+* processed: your code finished processing it (mark)
+* command: fly_direct was called with the trace
+* ble_write: the first PCMD packet carrying the command was written
+
+    (frame_seq, frame_time, image) = vision.wait_for_new_frame(timeout=1.0)
+    trace = mambo.latency_tracker.begin(frame_seq, frame_time)
+    ... process the image ...
+    mambo.latency_tracker.mark(trace, "processed")
+    mambo.fly_direct(roll, pitch, yaw, vertical, duration=0.1, trace=trace)
+
+Every hop is recorded in the latency_hop_seconds histogram (labelled with the hop, measured from the previous
+hop) and the whole trip in glass_to_command_seconds, so get_metrics() shows which stage dominates.
+"""
+import collections
+import itertools
+import time
+
+# the hops of a trace in order
+LATENCY_HOPS = ("capture", "dequeue", "processed", "command", "ble_write")
+
+
+class MamboLatencyTrace:
+    """
+    Timestamps of one frame on its way to a command
+    """
+
+    def __init__(self, trace_id, frame_seq):
+        self.trace_id = trace_id
+        self.frame_seq = frame_seq
+        # time of each hop (None until the hop happens)
+        self.times = [None] * len(LATENCY_HOPS)
+        self.finished = False
+
+    def get_hop_times(self):
+        """
+        :return: dictionary of hop name to time for the hops that happened
+        """
+        return dict([(hop, hop_time) for (hop, hop_time) in zip(LATENCY_HOPS, self.times) if hop_time is not None])
+
+
+class MamboLatencyTracker:
+    """
+    Creates traces and records their hop latencies into MamboMetrics (the Mambo creates one as
+    mambo.latency_tracker)
+    """
+
+    def __init__(self, metrics, history_size=256):
+        """
+        :param metrics: MamboMetrics for the histograms
+        :param history_size: number of finished traces kept in self.history
+        """
+        self.metrics = metrics
+        self.trace_ids = itertools.count(1)
+        self.hop_index = dict([(hop, idx) for (idx, hop) in enumerate(LATENCY_HOPS)])
+        self.history = collections.deque(maxlen=history_size)
+
+    def begin(self, frame_seq, frame_time):
+        """
+        Start a trace for a frame your code just picked up (records the capture and dequeue hops)
+
+        :param frame_seq: sequence number of the frame
+        :param frame_time: capture time of the frame
+        :return: the trace
+        """
+        trace = MamboLatencyTrace(next(self.trace_ids), frame_seq)
+        trace.times[0] = frame_time
+        trace.times[1] = time.time()
+        return trace
+
+    def mark(self, trace, hop, hop_time=None):
+        """
+        Record that a trace reached a hop
+
+        :param trace: the trace (None is ignored so callers don't have to check)
+        :param hop: name of the hop (see LATENCY_HOPS)
+        :param hop_time: time of the hop (defaults to now)
+        """
+        if (trace is None or trace.finished):
+            return
+        if (hop_time is None):
+            hop_time = time.time()
+        trace.times[self.hop_index[hop]] = hop_time
+        if (hop == "ble_write"):
+            self.finish(trace)
+
+    def finish(self, trace):
+        """
+        Record the hop latencies of a trace (called automatically when it reaches ble_write)
+
+        :param trace: the trace
+        """
+        trace.finished = True
+        previous = None
+        for (hop, hop_time) in zip(LATENCY_HOPS, trace.times):
+            if (hop_time is None):
+                continue
+            if (previous is not None):
+                self.metrics.record("latency_hop_seconds", hop_time - previous, labels={'hop': hop})
+            previous = hop_time
+
+        if (trace.times[0] is not None and trace.times[-1] is not None):
+            self.metrics.record("glass_to_command_seconds", trace.times[-1] - trace.times[0])
+        self.history.append(trace)
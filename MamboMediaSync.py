@@ -0,0 +1,176 @@
+"""
+MamboMediaSync copies the pictures on a mambo into a local folder, only downloading what is new.
+
+A manifest (manifest.json in the local folder) remembers the name, size, md5 and sync time of everything
+already copied.  Each sync lists the files on the drone (one FTP round trip), compares the listing to the
+manifest, and only downloads the files that are missing locally or whose size changed.
+
+Downloads run over BLE on the calling thread while a second thread re-checks each finished file on disk
+against its md5, moves it into place and records it in the manifest, so the next download starts without
+waiting for the disk.
+
+Use a separate local folder for each drone in a fleet.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import Queue
+
+
+class MamboMediaSync:
+    """
+    Incremental sync of the pictures on a mambo to a local folder
+    """
+
+    def __init__(self, mambo, local_dir, manifest_name="manifest.json", queue_size=4):
+        """
+        :param mambo: connected Mambo object
+        :param local_dir: local folder for the pictures (created if it doesn't exist)
+        :param manifest_name: name of the manifest file in the local folder
+        :param queue_size: number of downloaded files that can wait for verification before downloads pause
+        """
+        self.mambo = mambo
+        self.local_dir = local_dir
+        self.manifest_path = os.path.join(local_dir, manifest_name)
+        self.queue_size = queue_size
+
+        if (not os.path.isdir(local_dir)):
+            os.makedirs(local_dir)
+
+        self.manifest = self.load_manifest()
+        self.manifest_lock = threading.Lock()
+
+        # names of the files that failed to download or verify and the ones verified in the last sync
+        self.failed = list()
+        self.verified = list()
+
+    def load_manifest(self):
+        """
+        Read the manifest from the local folder
+
+        :return: dictionary of file name to {'size', 'md5', 'synced_at'}
+        """
+        if (not os.path.exists(self.manifest_path)):
+            return dict()
+        with open(self.manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    def save_manifest(self):
+        """
+        Write the manifest (to a temporary file first so a crash never leaves a broken manifest)
+        """
+        tmp_path = self.manifest_path + ".tmp"
+        with self.manifest_lock:
+            with open(tmp_path, "w") as manifest_file:
+                json.dump(self.manifest, manifest_file, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.manifest_path)
+
+    def diff(self, listing):
+        """
+        Compare a listing from the drone to the manifest
+
+        :param listing: list of (name, size) from the drone
+        :return: list of (name, size) that need to be downloaded
+        """
+        needed = list()
+        for (name, size) in listing:
+            entry = self.manifest.get(name)
+            if (entry is None or entry['size'] != size or
+                    not os.path.exists(os.path.join(self.local_dir, name))):
+                needed.append((name, size))
+        return needed
+
+    def _file_md5(self, path):
+        file_md5 = hashlib.md5()
+        with open(path, "rb") as local_file:
+            for chunk in iter(lambda: local_file.read(65536), ""):
+                file_md5.update(chunk)
+        return file_md5.hexdigest()
+
+    def _verify_files(self, downloaded):
+        """
+        Thread that checks each downloaded file on disk, moves it into place and adds it to the manifest
+
+        :param downloaded: Queue of (name, size, md5, temporary path), ended by None
+        """
+        while True:
+            item = downloaded.get()
+            if (item is None):
+                return
+
+            (name, size, md5, tmp_path) = item
+            try:
+                if (os.path.getsize(tmp_path) != size or self._file_md5(tmp_path) != md5):
+                    self.mambo._debug_print("media sync: %s failed verification" % name, 10)
+                    self.failed.append(name)
+                    os.remove(tmp_path)
+                    continue
+
+                os.rename(tmp_path, os.path.join(self.local_dir, name))
+            except (IOError, OSError) as error:
+                # e.g. the disk is full: skip this file (it is downloaded again next sync) and keep going
+                self.mambo._debug_print("media sync: could not save %s (%s)" % (name, error), 10)
+                self.failed.append(name)
+                if (os.path.exists(tmp_path)):
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+                continue
+
+            with self.manifest_lock:
+                self.manifest[name] = {'size': size, 'md5': md5, 'synced_at': time.time()}
+            self.verified.append(name)
+
+    def _queue_for_verifier(self, downloaded, verifier, item):
+        """
+        Hand an item to the verifier thread without waiting forever if it has stopped
+
+        :return: True if the item was queued and False if the verifier isn't running
+        """
+        while True:
+            try:
+                downloaded.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                if (not verifier.is_alive()):
+                    return False
+
+    def sync(self):
+        """
+        Download everything on the drone that isn't already in the local folder
+
+        :return: list of the names of the files that were downloaded, verified and added to the manifest
+        """
+        listing = self.mambo.get_camera_files()
+        needed = self.diff(listing)
+        self.failed = list()
+        self.verified = list()
+        if (len(needed) == 0):
+            return list()
+
+        downloaded = Queue.Queue(maxsize=self.queue_size)
+        verifier = threading.Thread(target=self._verify_files, args=(downloaded,))
+        verifier.daemon = True
+        verifier.start()
+
+        try:
+            for (name, size) in needed:
+                tmp_path = os.path.join(self.local_dir, "." + name + ".download")
+                try:
+                    md5 = self.mambo.ftp.get_file(name, tmp_path)
+                except Exception as error:
+                    self.mambo._debug_print("media sync: failed to download %s (%s)" % (name, error), 10)
+                    self.failed.append(name)
+                    continue
+                if (not self._queue_for_verifier(downloaded, verifier, (name, size, md5, tmp_path))):
+                    self.mambo._debug_print("media sync: the verifier stopped, giving up", 10)
+                    break
+        finally:
+            self._queue_for_verifier(downloaded, verifier, None)
+            verifier.join()
+            self.save_manifest()
+
+        return list(self.verified)
@@ -0,0 +1,288 @@
+"""
+MamboMetrics holds the counters, gauges and latency histograms used to watch how the BLE link to the
+mambo is performing (command ack latency, retries, reconnects, PCMD rate, etc).
+
+Histograms use fixed buckets so recording a value is just a bisect and a couple of additions.  Metrics can be
+recorded from several threads at once (e.g. the BLE thread and MamboVisionPipeline workers): every update and
+export holds the registry's lock, which is only held for those few operations.
+Use get_metrics() for a snapshot (including p50/p90/p99 estimates) or write_prometheus() to write
+the Prometheus text format (for example into a node_exporter textfile collector directory).
+"""
+import bisect
+import os
+import threading
+import time
+
+# default buckets for latencies (seconds)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# default buckets for small counts (e.g. retries)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10)
+
+
+class MamboHistogram:
+    """
+    Histogram with fixed bucket upper bounds (the last bucket catches everything above the top bound)
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        """
+        Record a value in the histogram
+
+        :param value: the value to record
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """
+        Estimate the percentile by interpolating inside the bucket it falls in
+
+        :param q: percentile as a fraction (0.5 for the median, 0.99 for p99)
+        :return: estimated value or None if nothing has been recorded
+        """
+        if (self.count == 0):
+            return None
+
+        target = q * self.count
+        cumulative = 0
+        for idx, bucket_count in enumerate(self.counts):
+            if (bucket_count > 0 and cumulative + bucket_count >= target):
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                if (idx == len(self.buckets)):
+                    # no upper bound on the last bucket
+                    return lower
+                upper = self.buckets[idx]
+                return lower + (upper - lower) * (target - cumulative) / float(bucket_count)
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """
+        :return: dictionary with the count, sum, mean, percentiles and cumulative bucket counts
+        """
+        cumulative = 0
+        buckets = list()
+        for idx, upper in enumerate(self.buckets):
+            cumulative += self.counts[idx]
+            buckets.append((upper, cumulative))
+        buckets.append(("+Inf", self.count))
+
+        if (self.count > 0):
+            mean = self.sum / self.count
+        else:
+            mean = None
+
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': mean,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': buckets
+        }
+
+
+class MamboMetrics:
+    """
+    Registry of named counters, gauges and histograms.  Each metric can have labels (e.g. the command name).
+    """
+
+    def __init__(self, prefix="mambo_", constant_labels=None):
+        """
+        :param prefix: prefix added to every metric name when exporting to Prometheus
+        :param constant_labels: dictionary of labels added to every metric when exporting (e.g. the drone address)
+        """
+        self.prefix = prefix
+        if (constant_labels is None):
+            constant_labels = dict()
+        self.constant_labels = constant_labels
+
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+        # held for every update and while exporting (updates are read-modify-writes and can come from several
+        # threads, and the exports iterate over the dictionaries)
+        self.lock = threading.Lock()
+
+        self.writer_thread = None
+        self.writer_running = False
+
+    def _key(self, name, labels):
+        if (labels is None):
+            return (name, ())
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, amount=1, labels=None):
+        """
+        Increment a counter
+
+        :param name: name of the counter
+        :param amount: amount to add
+        :param labels: optional dictionary of labels
+        """
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, labels=None):
+        """
+        Set a gauge to a value
+
+        :param name: name of the gauge
+        :param value: new value
+        :param labels: optional dictionary of labels
+        """
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def record(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        """
+        Record a value in a histogram (created with the specified buckets the first time it is used)
+
+        :param name: name of the histogram
+        :param value: value to record
+        :param labels: optional dictionary of labels
+        :param buckets: bucket upper bounds (only used the first time)
+        """
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if (histogram is None):
+                histogram = self.histograms[key] = MamboHistogram(buckets)
+            histogram.record(value)
+
+    def get_counter(self, name, labels=None):
+        """
+        :return: the value of the counter for the name and labels (0 if it was never incremented)
+        """
+        return self.counters.get(self._key(name, labels), 0)
+
+    def get_histogram(self, name, labels=None):
+        """
+        :return: the MamboHistogram for the name and labels or None if nothing was recorded
+        """
+        return self.histograms.get(self._key(name, labels))
+
+    def get_histogram_snapshot(self, name, labels=None):
+        """
+        :return: snapshot of the histogram for the name and labels (see MamboHistogram.snapshot) taken under the
+        lock, or None if nothing was recorded
+        """
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if (histogram is None):
+                return None
+            return histogram.snapshot()
+
+    def _copy_metrics(self):
+        """
+        :return: (counters, gauges, histograms) lists of (key, value) copied under the lock (histograms as
+        snapshots)
+        """
+        with self.lock:
+            return (list(self.counters.items()), list(self.gauges.items()),
+                    [(key, histogram.snapshot()) for (key, histogram) in self.histograms.items()])
+
+    def _label_str(self, label_tuple):
+        return ",".join(["%s=%s" % (label, value) for (label, value) in label_tuple])
+
+    def get_metrics(self):
+        """
+        Snapshot of all of the metrics.  Each section maps the metric name to a dictionary keyed by the label string
+        (e.g. "command=Piloting.TakeOff" or "" if there are no labels).
+
+        :return: dictionary with 'counters', 'gauges' and 'histograms'
+        """
+        (counters, gauges, histograms) = self._copy_metrics()
+        snapshot = {'counters': dict(), 'gauges': dict(), 'histograms': dict()}
+        for ((name, label_tuple), value) in counters:
+            snapshot['counters'].setdefault(name, dict())[self._label_str(label_tuple)] = value
+        for ((name, label_tuple), value) in gauges:
+            snapshot['gauges'].setdefault(name, dict())[self._label_str(label_tuple)] = value
+        for ((name, label_tuple), histogram) in histograms:
+            snapshot['histograms'].setdefault(name, dict())[self._label_str(label_tuple)] = histogram
+        return snapshot
+
+    def _prometheus_labels(self, label_tuple, extra=()):
+        labels = sorted(self.constant_labels.items()) + list(label_tuple) + list(extra)
+        if (len(labels) == 0):
+            return ""
+        return "{%s}" % ",".join(['%s="%s"' % (label, str(value).replace('"', '\\"')) for (label, value) in labels])
+
+    def to_prometheus(self):
+        """
+        Format all of the metrics in the Prometheus text exposition format
+
+        :return: string
+        """
+        (counters, gauges, histograms) = self._copy_metrics()
+        lines = list()
+        for (metrics, metric_type) in ((counters, "counter"), (gauges, "gauge")):
+            typed = set()
+            for ((name, label_tuple), value) in sorted(metrics):
+                full_name = self.prefix + name
+                if (full_name not in typed):
+                    lines.append("# TYPE %s %s" % (full_name, metric_type))
+                    typed.add(full_name)
+                lines.append("%s%s %s" % (full_name, self._prometheus_labels(label_tuple), value))
+
+        typed = set()
+        for ((name, label_tuple), histogram) in sorted(histograms):
+            full_name = self.prefix + name
+            if (full_name not in typed):
+                lines.append("# TYPE %s histogram" % full_name)
+                typed.add(full_name)
+            for (upper, cumulative) in histogram['buckets']:
+                lines.append("%s_bucket%s %d" % (full_name, self._prometheus_labels(label_tuple, [("le", upper)]),
+                                                 cumulative))
+            lines.append("%s_sum%s %s" % (full_name, self._prometheus_labels(label_tuple), histogram['sum']))
+            lines.append("%s_count%s %d" % (full_name, self._prometheus_labels(label_tuple), histogram['count']))
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics to a Prometheus text file.  The file is written to a temporary file and renamed so
+        readers never see a partial file.
+
+        :param path: file to write
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(self.to_prometheus())
+        os.rename(tmp_path, path)
+
+    def start_prometheus_writer(self, path, interval=10.0):
+        """
+        Start a background thread that rewrites the Prometheus text file every interval seconds
+
+        :param path: file to write
+        :param interval: seconds between writes
+        """
+        self.writer_running = True
+        self.writer_thread = threading.Thread(target=self._prometheus_writer, args=(path, interval))
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def stop_prometheus_writer(self):
+        """
+        Stop the background Prometheus writer thread
+        """
+        self.writer_running = False
+
+    def _prometheus_writer(self, path, interval):
+        while (self.writer_running):
+            self.write_prometheus(path)
+            time.sleep(interval)
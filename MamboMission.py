@@ -0,0 +1,332 @@
+"""
+MamboMission runs declarative mission plans (JSON or YAML) instead of python scripts.  A plan is validated
+and compiled before the flight: every command is looked up in the xml files and packed into a ready to send
+packet (only the sequence number is patched in at send time) and fly_direct steps become timed PCMD
+setpoints.  The compiled mission is then run by a deadline scheduler with a completion condition for each step.
+
+A plan looks like this (see demoMission.json):
+
+    {
+        "name": "tricks",
+        "steps": [
+            {"action": "takeoff", "until": {"state": ["hovering", "flying"], "timeout": 5}},
+            {"action": "flip", "direction": "left", "until": {"duration": 3}},
+            {"action": "fly_direct", "pitch": 50, "duration": 1},
+            {"action": "turn_degrees", "degrees": 90},
+            {"action": "sleep", "duration": 2},
+            {"action": "land", "until": {"state": "landed", "timeout": 10}}
+        ]
+    }
+
+Actions: takeoff, land, hover, flip (direction), turn_degrees (degrees), fly_direct (roll, pitch, yaw,
+vertical_movement, duration), open_claw, close_claw, fire_gun, take_picture, turn_on_auto_takeoff and sleep
+(duration).  Commands sent on the ack channel always wait for their ack.  A step can also wait with "until":
+
+* "state": a flying state (or list of them) to wait for (one of the FlyingStateChanged states in minidrone.xml)
+* "duration": seconds from the start of the step
+* "timeout": seconds before the step fails (defaults to default_timeout)
+
+A step can also have "at": the number of seconds after the mission starts that the step should start (it
+waits for that deadline) and a "name" used in the results.
+
+YAML plans need the PyYAML package.
+"""
+import json
+import struct
+import time
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class MamboMissionError(Exception):
+    """
+    Raised when a mission plan is not valid
+    """
+    pass
+
+
+class MamboMissionStep:
+    """
+    One compiled step of a mission
+    """
+
+    def __init__(self, index, name, action):
+        self.index = index
+        self.name = name
+        self.action = action
+
+        # packet sent on the ack channel (or None)
+        self.packet = None
+
+        # PCMD packet and how long to send it (fly_direct and sleep steps)
+        self.pcmd_packet = None
+        self.duration = None
+
+        # completion conditions
+        self.states = None
+        self.until_duration = None
+        self.timeout = None
+
+        # seconds after the start of the mission that the step starts (None means right after the previous step)
+        self.start_at = None
+
+
+class MamboMission:
+    """
+    Compile and run mission plans on a connected Mambo
+    """
+
+    def __init__(self, mambo, pcmd_interval=0.1, default_timeout=10.0):
+        """
+        :param mambo: connected Mambo object.  Call ask_for_state_update first if you use the claw or gun (the
+        accessory id is compiled into those packets).
+        :param pcmd_interval: seconds between PCMD packets in fly_direct steps.  Defaults to 0.1 (same as fly_direct).
+        :param default_timeout: seconds before a step with a state condition fails if it doesn't set a timeout
+        """
+        self.mambo = mambo
+        self.pcmd_interval = pcmd_interval
+        self.default_timeout = default_timeout
+
+        self.steps = list()
+        self.results = list()
+
+        # the packet layouts for every action that sends a command on the ack channel
+        self.noparam_actions = {
+            'takeoff': ("Piloting", "TakeOff"),
+            'land': ("Piloting", "Landing"),
+            'hover': ("Piloting", "FlatTrim"),
+            'take_picture': ("MediaRecord", "PictureV2"),
+        }
+        self.usb_actions = {
+            'open_claw': ("UsbAccessory", "ClawControl", "OPEN", "claw_id"),
+            'close_claw': ("UsbAccessory", "ClawControl", "CLOSE", "claw_id"),
+            'fire_gun': ("UsbAccessory", "GunControl", "FIRE", "gun_id"),
+        }
+        self.valid_actions = (list(self.noparam_actions.keys()) + list(self.usb_actions.keys()) +
+                              ['flip', 'turn_degrees', 'turn_on_auto_takeoff', 'fly_direct', 'sleep'])
+        self.valid_until = ('state', 'duration', 'timeout')
+
+        # names of the flying states (read from the xml the first time a plan is compiled)
+        self.flying_states = None
+
+    def load(self, path):
+        """
+        Load and compile a mission plan from a JSON or YAML (.yaml or .yml) file
+
+        :param path: path to the plan
+        :return: list of compiled steps
+        """
+        with open(path) as plan_file:
+            if (path.endswith(".yaml") or path.endswith(".yml")):
+                if (yaml is None):
+                    raise MamboMissionError("reading YAML missions needs the PyYAML package")
+                plan = yaml.safe_load(plan_file)
+            else:
+                plan = json.load(plan_file)
+        return self.compile(plan)
+
+    def _get_number(self, values, index, action, key, default=None, low=None, high=None):
+        """
+        Validate a number in a step (or in its until conditions)
+
+        :return: the value
+        """
+        value = values.get(key, default)
+        if (value is None):
+            raise MamboMissionError("step %d (%s) needs %s" % (index, action, key))
+        if (not isinstance(value, (int, long, float)) or isinstance(value, bool)):
+            raise MamboMissionError("step %d (%s): %s must be a number" % (index, action, key))
+        if ((low is not None and value < low) or (high is not None and value > high)):
+            raise MamboMissionError("step %d (%s): %s must be between %s and %s" % (index, action, key, low, high))
+        return value
+
+    def _get_flying_states(self):
+        """
+        :return: the names of the flying states in the FlyingStateChanged enum of minidrone.xml
+        """
+        if (self.flying_states is None):
+            flying_states = list()
+            for child in self.mambo.minidrone_commands.project.myclass:
+                if child['name'] == "PilotingState":
+                    for subchild in child.cmd:
+                        if subchild['name'] == "FlyingStateChanged":
+                            for arg_child in subchild.arg:
+                                if arg_child['name'] == "state":
+                                    flying_states = [echild['name'] for echild in arg_child.enum]
+            self.flying_states = flying_states
+        return self.flying_states
+
+    def compile(self, plan):
+        """
+        Validate a mission plan and compile it into ready to send packets and timed setpoints.  Raises
+        MamboMissionError if the plan is not valid.
+
+        :param plan: dictionary with a list of "steps" (or just the list of steps)
+        :return: list of compiled steps (also saved in self.steps)
+        """
+        if (isinstance(plan, dict)):
+            plan_steps = plan.get('steps')
+        else:
+            plan_steps = plan
+        if (not isinstance(plan_steps, list) or len(plan_steps) == 0):
+            raise MamboMissionError("the mission needs a list of steps")
+
+        mambo = self.mambo
+        steps = list()
+        for index, step in enumerate(plan_steps):
+            if (not isinstance(step, dict) or step.get('action') not in self.valid_actions):
+                raise MamboMissionError("step %d: action must be one of %s" % (index, ", ".join(self.valid_actions)))
+
+            action = step['action']
+            compiled = MamboMissionStep(index, step.get('name', "%d_%s" % (index, action)), action)
+
+            if (action in self.noparam_actions):
+                (myclass, cmd) = self.noparam_actions[action]
+                command_tuple = mambo._get_command_tuple(myclass, cmd)
+                compiled.packet = bytearray(struct.pack("<BBBBBB", mambo.data_types['DATA_WITH_ACK'], 0,
+                                                        command_tuple[0], command_tuple[1], command_tuple[2], 0))
+
+            elif (action in self.usb_actions):
+                (myclass, cmd, enum_name, id_name) = self.usb_actions[action]
+                usb_id = int(self._get_number(step, index, action, 'usb_id', default=getattr(mambo.sensors, id_name),
+                                              low=0, high=255))
+                (command_tuple, enum_value) = mambo._get_command_tuple_with_enum(myclass, cmd, enum_name)
+                compiled.packet = bytearray(struct.pack("<BBBBBBBI", mambo.data_types['DATA_WITH_ACK'], 0,
+                                                        command_tuple[0], command_tuple[1], command_tuple[2], 0,
+                                                        usb_id, enum_value))
+
+            elif (action == 'flip'):
+                direction = step.get('direction')
+                if (direction not in ("front", "back", "right", "left")):
+                    raise MamboMissionError("step %d (flip): direction must be front, back, right, or left" % index)
+                (command_tuple, enum_value) = mambo._get_command_tuple_with_enum("Animations", "Flip", direction)
+                compiled.packet = bytearray(struct.pack("<BBBBBBI", mambo.data_types['DATA_WITH_ACK'], 0,
+                                                        command_tuple[0], command_tuple[1], command_tuple[2], 0,
+                                                        enum_value))
+
+            elif (action == 'turn_degrees'):
+                degrees = self._get_number(step, index, action, 'degrees', low=-180, high=180)
+                command_tuple = mambo._get_command_tuple("Animations", "Cap")
+                compiled.packet = bytearray(struct.pack("<BBBBBBh", mambo.data_types['DATA_WITH_ACK'], 0,
+                                                        command_tuple[0], command_tuple[1], command_tuple[2], 0,
+                                                        int(degrees)))
+
+            elif (action == 'turn_on_auto_takeoff'):
+                command_tuple = mambo._get_command_tuple("Piloting", "AutoTakeOffMode")
+                compiled.packet = bytearray(struct.pack("<BBBBBBB", mambo.data_types['DATA_WITH_ACK'], 0,
+                                                        command_tuple[0], command_tuple[1], command_tuple[2], 0, 1))
+
+            elif (action == 'fly_direct'):
+                values = [int(self._get_number(step, index, action, key, default=0, low=-100, high=100))
+                          for key in ('roll', 'pitch', 'yaw', 'vertical_movement')]
+                compiled.duration = self._get_number(step, index, action, 'duration', low=0)
+                command_tuple = mambo._get_command_tuple("Piloting", "PCMD")
+                compiled.pcmd_packet = bytearray(mambo.pcmd_struct.pack(mambo.data_types['DATA_NO_ACK'], 0,
+                                                                        command_tuple[0], command_tuple[1],
+                                                                        command_tuple[2], 0, 1,
+                                                                        values[0], values[1], values[2], values[3], 0))
+
+            elif (action == 'sleep'):
+                compiled.duration = self._get_number(step, index, action, 'duration', low=0)
+
+            # completion conditions
+            until = step.get('until', dict())
+            if (not isinstance(until, dict)):
+                raise MamboMissionError("step %d (%s): until must be a dictionary" % (index, action))
+            for key in until:
+                if (key not in self.valid_until):
+                    raise MamboMissionError("step %d (%s): unknown until condition %s (use %s)" %
+                                            (index, action, key, ", ".join(self.valid_until)))
+            if ('state' in until):
+                states = until['state']
+                if (not isinstance(states, list)):
+                    states = [states]
+                flying_states = self._get_flying_states()
+                for state in states:
+                    if (state not in flying_states):
+                        raise MamboMissionError("step %d (%s): until state %s is not a flying state (use %s)" %
+                                                (index, action, state, ", ".join(flying_states)))
+                compiled.states = tuple(states)
+            if ('duration' in until):
+                compiled.until_duration = self._get_number(until, index, action, 'duration', low=0)
+            compiled.timeout = self._get_number(until, index, action, 'timeout', default=self.default_timeout, low=0)
+
+            if ('at' in step):
+                compiled.start_at = self._get_number(step, index, action, 'at', low=0)
+
+            steps.append(compiled)
+
+        self.steps = steps
+        return steps
+
+    def _wait_until(self, deadline):
+        """
+        Handle notifications until the deadline (wall clock)
+        """
+        while True:
+            remaining = deadline - time.time()
+            if (remaining <= 0):
+                return
+            self.mambo._wait_for_notifications(min(remaining, 0.1))
+
+    def _run_step(self, step):
+        """
+        Run one compiled step
+
+        :return: True if the step completed and False otherwise
+        """
+        mambo = self.mambo
+        step_start = time.time()
+        success = True
+
+        if (step.packet is not None):
+            success = mambo._send_precompiled_packet_ack(step.packet)
+
+        if (step.pcmd_packet is not None):
+            # send on a fixed schedule so the step timing doesn't drift with the BLE writes
+            end_time = step_start + step.duration
+            next_send = step_start
+            while (next_send < end_time):
+                mambo._send_precompiled_pcmd(step.pcmd_packet)
+                next_send += self.pcmd_interval
+                self._wait_until(min(next_send, end_time))
+        elif (step.duration is not None):
+            self._wait_until(step_start + step.duration)
+
+        if (success and step.states is not None):
+            success = mambo.wait_for_flying_state(step.states, step.timeout - (time.time() - step_start))
+
+        if (success and step.until_duration is not None):
+            self._wait_until(step_start + step.until_duration)
+
+        return success
+
+    def run(self, stop_on_failure=True):
+        """
+        Run the compiled mission
+
+        :param stop_on_failure: if True (default), stop at the first step that fails
+        :return: list of (step name, success, start time, duration) for each step that ran (times in seconds from
+        the start of the mission).  Also saved in self.results.
+        """
+        if (len(self.steps) == 0):
+            raise MamboMissionError("compile a mission before running it")
+
+        self.results = list()
+        mission_start = time.time()
+        for step in self.steps:
+            if (step.start_at is not None):
+                self._wait_until(mission_start + step.start_at)
+
+            step_start = time.time()
+            success = self._run_step(step)
+            self.results.append((step.name, success, step_start - mission_start, time.time() - step_start))
+            self.mambo._debug_print("mission step %s finished: %s" % (step.name, success), 5)
+
+            if (not success and stop_on_failure):
+                break
+
+        return self.results
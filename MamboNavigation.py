@@ -0,0 +1,71 @@
+"""
+Vectorized versions of the derived navigation state in MamboSensors (euler angles, world frame velocity
+and dead reckoning) for evaluating a whole sensor history at once with numpy.
+
+The single value versions live on MamboSensors (attitude, roll, pitch, yaw, heading, world_velocity and
+position) and use the same conventions:
+
+* the quaternion is the rotation from the NED frame to the drone's body frame
+* the speed is in the horizontal frame with the drone's heading (x forward, y right, z down)
+* the speed timestamps are in milliseconds and wrap at 16 bits
+"""
+import numpy as np
+
+
+def quaternions_to_euler(quaternions):
+    """
+    Convert an array of quaternions to euler angles
+
+    :param quaternions: array of shape (N, 4) with (w, x, y, z) in each row
+    :return: array of shape (N, 3) with (roll, pitch, yaw) in radians
+    """
+    quaternions = np.asarray(quaternions, dtype=float)
+    (w, x, y, z) = (quaternions[:, 0], quaternions[:, 1], quaternions[:, 2], quaternions[:, 3])
+    roll = np.arctan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2.0 * (w * y - z * x), -1.0, 1.0))
+    yaw = np.arctan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z))
+    return np.column_stack((roll, pitch, yaw))
+
+
+def headings(quaternions):
+    """
+    :param quaternions: array of shape (N, 4) with (w, x, y, z) in each row
+    :return: array of N headings in degrees [0, 360)
+    """
+    return np.degrees(quaternions_to_euler(quaternions)[:, 2]) % 360.0
+
+
+def world_velocities(speeds, yaws):
+    """
+    Rotate speeds from the drone's heading frame into the world frame
+
+    :param speeds: array of shape (N, 3) with (speed_x, speed_y, speed_z) in each row
+    :param yaws: array of N yaw angles in radians
+    :return: array of shape (N, 3) with (north, east, down) velocities in m/s
+    """
+    speeds = np.asarray(speeds, dtype=float)
+    (cos_yaw, sin_yaw) = (np.cos(yaws), np.sin(yaws))
+    return np.column_stack((cos_yaw * speeds[:, 0] - sin_yaw * speeds[:, 1],
+                            sin_yaw * speeds[:, 0] + cos_yaw * speeds[:, 1],
+                            speeds[:, 2]))
+
+
+def dead_reckon(timestamps, speeds, yaws, max_gap=1.0, start=(0.0, 0.0)):
+    """
+    Integrate a history of speed samples into positions (each sample's velocity is applied over the interval
+    since the previous sample, which matches MamboSensors.position)
+
+    :param timestamps: array of N speed timestamps in milliseconds (16 bit, wrapping)
+    :param speeds: array of shape (N, 3) with (speed_x, speed_y, speed_z) in each row
+    :param yaws: array of N yaw angles in radians at the time of each sample
+    :param max_gap: gaps between samples longer than this (seconds) are not integrated
+    :param start: (north, east) position before the first sample
+    :return: array of shape (N, 2) with the (north, east) position after each sample
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    dt = np.zeros(len(timestamps))
+    dt[1:] = (np.diff(timestamps) % 65536) / 1000.0
+    dt[dt > max_gap] = 0.0
+
+    velocities = world_velocities(speeds, yaws)
+    return np.asarray(start, dtype=float) + np.cumsum(velocities[:, 0:2] * dt[:, np.newaxis], axis=0)
@@ -0,0 +1,216 @@
+"""
+MamboRecorder saves the video from the mambo's FPV camera to disk for reviewing flights later without
+slowing down the live frames.
+
+There are two modes:
+
+* frames (the default): MamboVision hands each saved frame to the recorder, which copies it into one of a fixed
+  set of preallocated buffers and queues it for a writer thread that encodes it with cv2.VideoWriter.  If the
+  writer falls behind and every buffer is in use, the frame is dropped (and counted) instead of making the
+  capture thread wait.
+* passthrough: ffmpeg copies the stream straight to disk without decoding or re-encoding it (-c copy).  This
+  keeps the full frame rate and quality at almost no CPU cost but opens a second connection to the stream and
+  needs ffmpeg installed.
+
+Recordings are split into segments that rotate after segment_seconds (or segment_bytes in frame mode) and,
+in frame mode, whenever the frame size changes (e.g. when MamboVisionGovernor changes the downscale).  The
+segments are named mambo_<date>_<time>.<extension> in the recording directory.
+
+    vision.start_recording("flights")
+    ...
+    vision.stop_recording()
+"""
+import os
+import subprocess
+import threading
+import time
+import Queue
+
+import cv2
+import numpy as np
+
+
+class MamboRecorder:
+    """
+    Records frames (or the raw stream) into rotating segments on a background thread
+    """
+
+    def __init__(self, directory, fps=10, segment_seconds=300, segment_bytes=None, queue_size=30,
+                 codec="MJPG", extension="avi", passthrough=False, stream_url=None):
+        """
+        :param directory: folder for the segments (created if it doesn't exist)
+        :param fps: frame rate written into the file (use the rate MamboVision saves frames at)
+        :param segment_seconds: start a new segment after this many seconds
+        :param segment_bytes: start a new segment once the file is larger than this (frame mode only, None for no
+        limit)
+        :param queue_size: number of frames that can wait for the writer before frames are dropped
+        :param codec: fourcc of the codec for frame mode (MJPG is cheap to encode on a Raspberry Pi)
+        :param extension: file extension of the segments (also picks the container)
+        :param passthrough: if True, copy the stream with ffmpeg instead of encoding frames
+        :param stream_url: address of the stream (needed for passthrough)
+        """
+        self.directory = directory
+        self.fps = fps
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.queue_size = queue_size
+        self.codec = codec
+        self.extension = extension
+        self.passthrough = passthrough
+        self.stream_url = stream_url
+
+        if (not os.path.isdir(directory)):
+            os.makedirs(directory)
+
+        # frames waiting for the writer and the free buffers (allocated when the first frame arrives)
+        self.frames = Queue.Queue()
+        self.free_buffers = Queue.Queue()
+        self.buffer_shape = None
+        # bumped when the buffers are replaced so the writer doesn't return old ones to the pool
+        self.buffer_generation = 0
+
+        self.writer = None
+        self.writer_size = None
+        self.segment_path = None
+        self.segment_start = None
+        self.segments = list()
+
+        self.frames_written = 0
+        self.frames_dropped = 0
+
+        self.writer_thread = None
+        self.ffmpeg = None
+        self.recording = False
+
+    def _new_segment_path(self):
+        path = os.path.join(self.directory, "mambo_%s.%s" % (time.strftime("%Y%m%d_%H%M%S"), self.extension))
+        # two segments in the same second get a counter
+        count = 1
+        while (os.path.exists(path) or path in self.segments):
+            path = os.path.join(self.directory, "mambo_%s_%d.%s" % (time.strftime("%Y%m%d_%H%M%S"), count,
+                                                                    self.extension))
+            count += 1
+        return path
+
+    def start(self):
+        """
+        Start recording (in passthrough mode this starts ffmpeg)
+        """
+        self.recording = True
+        if (self.passthrough):
+            if (self.stream_url is None):
+                raise ValueError("passthrough recording needs the stream_url")
+            pattern = os.path.join(self.directory, "mambo_%Y%m%d_%H%M%S." + self.extension)
+            self.ffmpeg = subprocess.Popen(["ffmpeg", "-loglevel", "error", "-i", self.stream_url,
+                                            "-c", "copy", "-f", "segment", "-segment_time", str(self.segment_seconds),
+                                            "-reset_timestamps", "1", "-strftime", "1", pattern],
+                                           stdin=subprocess.PIPE)
+        else:
+            self.writer_thread = threading.Thread(target=self._write_frames)
+            self.writer_thread.daemon = True
+            self.writer_thread.start()
+
+    def add_frame(self, frame, frame_time):
+        """
+        Queue a frame for writing (called on the capture thread so it never waits).  The frame is copied so the
+        caller can reuse it right away.
+
+        :param frame: the image
+        :param frame_time: capture time of the frame
+        :return: True if the frame was queued and False if it was dropped
+        """
+        if (not self.recording or self.passthrough):
+            return False
+
+        if (self.buffer_shape != frame.shape):
+            # first frame (or the stream changed size): replace the free buffers (the ones still queued are
+            # dropped by the writer once they are written, so the pool never holds more than queue_size)
+            self.buffer_shape = frame.shape
+            self.buffer_generation += 1
+            while True:
+                try:
+                    self.free_buffers.get_nowait()
+                except Queue.Empty:
+                    break
+            for idx in range(self.queue_size - self.frames.qsize()):
+                self.free_buffers.put(np.empty(frame.shape, dtype=frame.dtype))
+
+        try:
+            buffer = self.free_buffers.get_nowait()
+        except Queue.Empty:
+            self.frames_dropped += 1
+            return False
+
+        np.copyto(buffer, frame)
+        self.frames.put((buffer, frame_time, self.buffer_generation))
+        return True
+
+    def _open_segment(self, frame):
+        self._close_segment()
+        self.segment_path = self._new_segment_path()
+        (height, width) = frame.shape[0:2]
+        self.writer = cv2.VideoWriter(self.segment_path, cv2.VideoWriter_fourcc(*self.codec), self.fps,
+                                      (width, height))
+        self.writer_size = frame.shape[0:2]
+        self.segment_start = time.time()
+        self.segments.append(self.segment_path)
+
+    def _close_segment(self):
+        if (self.writer is not None):
+            self.writer.release()
+            self.writer = None
+
+    def _segment_full(self):
+        if (time.time() - self.segment_start >= self.segment_seconds):
+            return True
+        return (self.segment_bytes is not None and os.path.exists(self.segment_path) and
+                os.path.getsize(self.segment_path) >= self.segment_bytes)
+
+    def _write_frames(self):
+        """
+        Writer thread: encode the queued frames into the current segment
+        """
+        while True:
+            item = self.frames.get()
+            if (item is None):
+                break
+
+            (buffer, frame_time, generation) = item
+            # VideoWriter silently drops frames of another size so a size change starts a new segment
+            if (self.writer is None or buffer.shape[0:2] != self.writer_size or self._segment_full()):
+                self._open_segment(buffer)
+            self.writer.write(buffer)
+            self.frames_written += 1
+
+            if (generation == self.buffer_generation):
+                self.free_buffers.put(buffer)
+
+        self._close_segment()
+
+    def stop(self):
+        """
+        Stop recording.  In frame mode the frames already queued are written first.
+        """
+        self.recording = False
+        if (self.ffmpeg is not None):
+            # q asks ffmpeg to finish the segment cleanly
+            try:
+                self.ffmpeg.communicate("q")
+            except (IOError, OSError):
+                self.ffmpeg.terminate()
+            self.ffmpeg = None
+        if (self.writer_thread is not None):
+            self.frames.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+
+    def get_stats(self):
+        """
+        :return: dictionary with 'frames_written', 'frames_dropped', 'queued' and 'segments' (list of paths)
+        """
+        return {
+            'frames_written': self.frames_written,
+            'frames_dropped': self.frames_dropped,
+            'queued': self.frames.qsize(),
+            'segments': list(self.segments)
+        }
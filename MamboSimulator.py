@@ -0,0 +1,598 @@
+"""
+MamboSimulator is a lightweight software-in-the-loop model of the Mambo.  It lets you tune
+controllers without the drone (and without BLE) because the simulated sensors react to the commands
+you send.
+
+The simulator understands the same packets the Mambo class builds (PCMD from fly_direct, TakeOff and
+Landing) and sends back DroneSpeed, DroneAltitude, DroneQuaternion and FlyingStateChanged
+notifications in the same binary format the real drone uses.  The physics for all of the drones in a
+fleet are stepped together with numpy so large fleet scenarios can run faster than real time.
+
+To fly a Mambo object against the simulator, swap its BLE peripheral for a simulated one before
+connecting:
+
+    fleet = MamboFleetSimulator(num_drones=1)
+    mambo = Mambo("simulated")
+    mambo.drone = SimulatedPeripheral(fleet, index=0)
+    mambo.connect(num_retries=3)
+
+For fleet scenarios faster than real time, drive the fleet directly with set_pcmd/takeoff/land and
+call run() or step() yourself.
+"""
+import collections
+import math
+import struct
+import threading
+import time
+
+import numpy as np
+import untangle
+
+
+class MamboFleetSimulator:
+    """
+    Vectorized flight dynamics for one or more simulated mambos.  Every state variable is a numpy
+    array with one entry per drone so a single step() updates the whole fleet.
+    """
+
+    def __init__(self, num_drones=1, notification_rates=None, realtime=True):
+        """
+        Create the simulated fleet.  All drones start landed at the origin.
+
+        :param num_drones: number of drones to simulate
+        :param notification_rates: dictionary of notification name to the rate (Hz) it is sent at.
+        Defaults to 5 Hz for DroneSpeed, DroneAltitude and DroneQuaternion.
+        :param realtime: if True, the simulation clock follows the wall clock (used when flying a Mambo
+        object against the simulator).  If False, time only advances when step() or run() is called.
+        """
+        self.num_drones = num_drones
+        self.realtime = realtime
+
+        # rates that the navigation data is sent back to the user
+        if (notification_rates is None):
+            notification_rates = {
+                'DroneSpeed': 5.0,
+                'DroneAltitude': 5.0,
+                'DroneQuaternion': 5.0
+            }
+        self.notification_rates = notification_rates
+
+        # physical parameters (roughly matched to the mambo's default settings)
+        self.gravity = 9.81
+        self.max_tilt = math.radians(15.0)
+        self.max_yaw_rate = math.radians(180.0)
+        self.max_vertical_speed = 1.0
+        self.attitude_time_constant = 0.15
+        self.drag = 1.0
+        self.takeoff_altitude = 1.0
+        self.takeoff_speed = 0.6
+        self.landing_speed = 0.5
+
+        # the mambo goes back to hovering if it stops hearing PCMD commands
+        self.pcmd_timeout = 0.5
+
+        # maximum step size when catching the simulation up to the wall clock
+        self.max_step = 0.01
+
+        # parse the same xml files as the Mambo so the ids and enums always match
+        self.common_commands = untangle.parse('common.xml')
+        self.minidrone_commands = untangle.parse('minidrone.xml')
+
+        self.command_ids = {
+            'TakeOff': self._get_command_tuple("Piloting", "TakeOff"),
+            'Landing': self._get_command_tuple("Piloting", "Landing"),
+            'PCMD': self._get_command_tuple("Piloting", "PCMD"),
+            'Emergency': self._get_command_tuple("Piloting", "Emergency"),
+            'FlyingStateChanged': self._get_command_tuple("PilotingState", "FlyingStateChanged"),
+            'DroneSpeed': self._get_command_tuple("NavigationDataState", "DroneSpeed"),
+            'DroneAltitude': self._get_command_tuple("NavigationDataState", "DroneAltitude"),
+            'DroneQuaternion': self._get_command_tuple("NavigationDataState", "DroneQuaternion"),
+        }
+        self.flying_states = self._get_enum_names("PilotingState", "FlyingStateChanged", "state")
+        self.state_ids = dict((name, idx) for idx, name in enumerate(self.flying_states))
+
+        # packet types and the formats of the packets sent back to the user
+        self.data_types = {
+            'ACK': 1,
+            'DATA_NO_ACK': 2,
+            'LOW_LATENCY_DATA': 3,
+            'DATA_WITH_ACK': 4
+        }
+        self.notification_formats = {
+            'DroneSpeed': struct.Struct("<BBBBBBfffH"),
+            'DroneAltitude': struct.Struct("<BBBBBBfH"),
+            'DroneQuaternion': struct.Struct("<BBBBBBffffH"),
+            'FlyingStateChanged': struct.Struct("<BBBBBBi"),
+        }
+
+        # the state of every drone
+        self.time = 0.0
+        self.position = np.zeros((num_drones, 2))      # north and east (m)
+        self.altitude = np.zeros(num_drones)           # above takeoff (m)
+        self.velocity = np.zeros((num_drones, 3))      # north, east, up (m/s)
+        self.attitude = np.zeros((num_drones, 3))      # roll, pitch, yaw (radians)
+        self.commands = np.zeros((num_drones, 4))      # roll, pitch, yaw, gaz [-100, 100]
+        self.command_flag = np.zeros(num_drones, dtype=bool)
+        self.last_pcmd_time = np.zeros(num_drones)
+        self.state = np.zeros(num_drones, dtype=int) + self.state_ids['landed']
+
+        # each drone has its own notification queue and sequence counters (one per channel)
+        self.outboxes = [collections.deque() for i in range(num_drones)]
+        self.send_counters = [{'ACK_DRONE_DATA': 0, 'NO_ACK_DRONE_DATA': 0} for i in range(num_drones)]
+        self.next_notification_time = dict((name, 0.0) for name in self.notification_rates)
+
+        # peripherals attached to each drone (used by run() to deliver notifications)
+        self.peripherals = [None] * num_drones
+
+        self.lock = threading.RLock()
+        self.wall_start = time.time()
+
+    def _find_command(self, myclass, cmd):
+        """
+        Find the project id, class id and command node for the specified class and command name
+
+        :param myclass: class name in the xml file
+        :param cmd: command name in the xml file
+        :return: tuple of (project_id, class_id, cmd node) or None if it wasn't found
+        """
+        for commands in (self.minidrone_commands, self.common_commands):
+            project_id = int(commands.project['id'])
+            for child in commands.project.myclass:
+                if child['name'] == myclass:
+                    for subchild in child.cmd:
+                        if subchild['name'] == cmd:
+                            return (project_id, int(child['id']), subchild)
+        return None
+
+    def _get_command_tuple(self, myclass, cmd):
+        """
+        Parse the xml for the 3 tuple of ids used in the packet headers
+
+        :param myclass: class name in the xml file
+        :param cmd: command name in the xml file
+        :return: (project_id, class_id, cmd_id)
+        """
+        (project_id, class_id, cmd_node) = self._find_command(myclass, cmd)
+        return (project_id, class_id, int(cmd_node['id']))
+
+    def _get_enum_names(self, myclass, cmd, arg_name):
+        """
+        Parse the xml for the list of enum names of the specified argument
+
+        :return: list of enum names in the order of their values
+        """
+        (project_id, class_id, cmd_node) = self._find_command(myclass, cmd)
+        for arg_child in cmd_node.arg:
+            if arg_child['name'] == arg_name:
+                return [echild['name'] for echild in arg_child.enum]
+        return []
+
+    def attach(self, peripheral, index):
+        """
+        Attach a simulated peripheral to the specified drone so it receives that drone's notifications
+
+        :param peripheral: SimulatedPeripheral
+        :param index: index of the drone in the fleet
+        """
+        self.peripherals[index] = peripheral
+
+    def receive_packet(self, index, packet):
+        """
+        Handle a command packet written by the user to the specified drone
+
+        :param index: index of the drone in the fleet
+        :param packet: packet built by the Mambo class
+        :return: nothing
+        """
+        if (len(packet) < 6):
+            return
+
+        command_tuple = tuple(struct.unpack_from("<BBB", packet, offset=2))
+
+        with self.lock:
+            if (command_tuple == self.command_ids['PCMD']):
+                (flag, roll, pitch, yaw, gaz) = struct.unpack_from("<Bbbbb", packet, offset=6)
+                self.set_pcmd(index, roll, pitch, yaw, gaz, flag)
+            elif (command_tuple == self.command_ids['TakeOff']):
+                self.takeoff(index)
+            elif (command_tuple == self.command_ids['Landing']):
+                self.land(index)
+            elif (command_tuple == self.command_ids['Emergency']):
+                self._set_state(np.array([index]), 'emergency')
+
+    def set_pcmd(self, indices, roll, pitch, yaw, gaz, flag=1):
+        """
+        Set the PCMD values for one or more drones.  Each value can be a scalar or an array with one
+        entry per index.  Values are clipped to [-100, 100] just like fly_direct.
+
+        :param indices: index or array of indices of the drones in the fleet
+        :return: nothing
+        """
+        with self.lock:
+            self.commands[indices] = np.clip(np.column_stack(np.broadcast_arrays(roll, pitch, yaw, gaz)), -100, 100)
+            self.command_flag[indices] = np.asarray(flag, dtype=bool)
+            self.last_pcmd_time[indices] = self.time
+
+    def takeoff(self, indices):
+        """
+        Start the takeoff for the specified drones (ignored for drones that are not landed)
+
+        :param indices: index or array of indices of the drones in the fleet
+        """
+        with self.lock:
+            indices = np.atleast_1d(indices)
+            landed = indices[self.state[indices] == self.state_ids['landed']]
+            self._set_state(landed, 'takingoff')
+
+    def land(self, indices):
+        """
+        Start the landing for the specified drones (ignored for drones that are not in the air)
+
+        :param indices: index or array of indices of the drones in the fleet
+        """
+        with self.lock:
+            indices = np.atleast_1d(indices)
+            airborne = indices[self._airborne_mask()[indices]]
+            self._set_state(airborne, 'landing')
+
+    def _airborne_mask(self):
+        """
+        :return: boolean array that is True for every drone that is off the ground
+        """
+        return ((self.state == self.state_ids['takingoff']) | (self.state == self.state_ids['hovering']) |
+                (self.state == self.state_ids['flying']) | (self.state == self.state_ids['landing']))
+
+    def _set_state(self, indices, state_name):
+        """
+        Change the flying state of the specified drones and queue a FlyingStateChanged for each that changed
+
+        :param indices: array of indices of the drones in the fleet
+        :param state_name: name of the new state (from the xml enum)
+        """
+        state_id = self.state_ids[state_name]
+        changed = indices[self.state[indices] != state_id]
+        self.state[changed] = state_id
+        for index in changed:
+            self._queue_notification(index, 'FlyingStateChanged', state_id)
+
+    def _queue_notification(self, index, name, *values):
+        """
+        Build a notification packet in the drone's wire format and queue it for the user
+
+        :param index: index of the drone in the fleet
+        :param name: name of the notification (key in notification_formats)
+        :param values: the values of the arguments
+        """
+        if (name == 'FlyingStateChanged'):
+            channel = 'ACK_DRONE_DATA'
+            data_type = self.data_types['DATA_WITH_ACK']
+        else:
+            channel = 'NO_ACK_DRONE_DATA'
+            data_type = self.data_types['DATA_NO_ACK']
+
+        counters = self.send_counters[index]
+        counters[channel] = (counters[channel] + 1) % 256
+        command_tuple = self.command_ids[name]
+        packet = self.notification_formats[name].pack(data_type, counters[channel],
+                                                      command_tuple[0], command_tuple[1], command_tuple[2], 0,
+                                                      *values)
+        self.outboxes[index].append((channel, packet))
+
+    def get_quaternions(self):
+        """
+        Convert the attitude of every drone to the quaternion the mambo reports
+
+        :return: array of shape (num_drones, 4) with (w, x, y, z) for each drone
+        """
+        half = self.attitude / 2.0
+        (cr, cp, cy) = (np.cos(half[:, 0]), np.cos(half[:, 1]), np.cos(half[:, 2]))
+        (sr, sp, sy) = (np.sin(half[:, 0]), np.sin(half[:, 1]), np.sin(half[:, 2]))
+        return np.column_stack((cr * cp * cy + sr * sp * sy,
+                                sr * cp * cy - cr * sp * sy,
+                                cr * sp * cy + sr * cp * sy,
+                                cr * cp * sy - sr * sp * cy))
+
+    def get_body_speeds(self):
+        """
+        Rotate the world velocity into the frame the mambo reports speed in (horizontal frame with the drone's
+        heading, down is positive)
+
+        :return: array of shape (num_drones, 3) with (speed_x, speed_y, speed_z)
+        """
+        yaw = self.attitude[:, 2]
+        (cos_yaw, sin_yaw) = (np.cos(yaw), np.sin(yaw))
+        return np.column_stack((cos_yaw * self.velocity[:, 0] + sin_yaw * self.velocity[:, 1],
+                                -sin_yaw * self.velocity[:, 0] + cos_yaw * self.velocity[:, 1],
+                                -self.velocity[:, 2]))
+
+    def step(self, dt):
+        """
+        Advance the whole fleet by dt seconds
+
+        :param dt: time step in seconds
+        :return: nothing
+        """
+        with self.lock:
+            self.time += dt
+
+            # drones that haven't heard a PCMD in a while go back to hovering
+            stale = (self.time - self.last_pcmd_time) > self.pcmd_timeout
+            self.commands[stale] = 0
+            self.command_flag[stale] = False
+
+            airborne = self._airborne_mask()
+            takingoff = self.state == self.state_ids['takingoff']
+            landing = self.state == self.state_ids['landing']
+            piloted = airborne & ~takingoff & ~landing
+
+            # attitude follows the commanded tilt with a first order response (only when piloted)
+            commands = self.commands / 100.0
+            tilt_enabled = (piloted & self.command_flag)[:, np.newaxis]
+            target_tilt = np.where(tilt_enabled, commands[:, 0:2] * self.max_tilt, 0.0)
+            # positive pitch command moves forward which is a nose down (negative) pitch angle
+            target_tilt[:, 1] *= -1
+            alpha = 1.0 - math.exp(-dt / self.attitude_time_constant)
+            self.attitude[:, 0:2] += (target_tilt - self.attitude[:, 0:2]) * alpha
+            self.attitude[:, 2] += np.where(piloted, commands[:, 2] * self.max_yaw_rate * dt, 0.0)
+            self.attitude[:, 2] = (self.attitude[:, 2] + math.pi) % (2 * math.pi) - math.pi
+
+            # horizontal acceleration in the body frame, then rotated into the world frame
+            forward = -self.gravity * np.tan(self.attitude[:, 1])
+            right = self.gravity * np.tan(self.attitude[:, 0])
+            yaw = self.attitude[:, 2]
+            (cos_yaw, sin_yaw) = (np.cos(yaw), np.sin(yaw))
+            accel_north = cos_yaw * forward - sin_yaw * right
+            accel_east = sin_yaw * forward + cos_yaw * right
+            self.velocity[:, 0] += (accel_north - self.drag * self.velocity[:, 0]) * dt
+            self.velocity[:, 1] += (accel_east - self.drag * self.velocity[:, 1]) * dt
+
+            # vertical speed depends on the flying state
+            vertical = np.where(piloted, commands[:, 3] * self.max_vertical_speed, 0.0)
+            vertical = np.where(takingoff, self.takeoff_speed, vertical)
+            vertical = np.where(landing, -self.landing_speed, vertical)
+            self.velocity[:, 2] = vertical
+
+            # nothing moves on the ground
+            self.velocity[~airborne] = 0
+            self.attitude[~airborne, 0:2] = 0
+
+            self.position += self.velocity[:, 0:2] * dt
+            self.altitude = np.maximum(self.altitude + self.velocity[:, 2] * dt, 0.0)
+
+            # an emergency cuts the motors so the drone drops straight down
+            self.altitude[self.state == self.state_ids['emergency']] = 0.0
+
+            # walk the takeoff/landing state machine
+            self._set_state(np.flatnonzero(takingoff & (self.altitude >= self.takeoff_altitude)), 'hovering')
+            touched_down = (landing | (self.state == self.state_ids['emergency'])) & (self.altitude <= 0.0)
+            self._set_state(np.flatnonzero(touched_down), 'landed')
+            self.velocity[touched_down] = 0
+            moving = piloted & (np.abs(self.commands) > 0).any(axis=1)
+            self._set_state(np.flatnonzero(moving & (self.state == self.state_ids['hovering'])), 'flying')
+            self._set_state(np.flatnonzero(piloted & ~moving & (self.state == self.state_ids['flying'])), 'hovering')
+
+            self._queue_periodic_notifications()
+
+    def _queue_periodic_notifications(self):
+        """
+        Queue the navigation data notifications that are due for every drone
+        """
+        due = [name for name in self.notification_rates if self.time >= self.next_notification_time[name]]
+        if (len(due) == 0):
+            return
+
+        ts = int(self.time * 1000) % 65536
+        for name in due:
+            self.next_notification_time[name] = self.time + 1.0 / self.notification_rates[name]
+            if (name == 'DroneSpeed'):
+                values = self.get_body_speeds()
+            elif (name == 'DroneAltitude'):
+                values = self.altitude[:, np.newaxis]
+            elif (name == 'DroneQuaternion'):
+                values = self.get_quaternions()
+            else:
+                continue
+
+            for index in range(self.num_drones):
+                self._queue_notification(index, name, *(list(values[index]) + [ts]))
+
+    def advance_realtime(self):
+        """
+        Step the simulation until it catches up with the wall clock (only used in realtime mode)
+        """
+        with self.lock:
+            target = time.time() - self.wall_start
+            while (self.time < target):
+                self.step(min(self.max_step, target - self.time))
+
+    def deliver_notifications(self, index):
+        """
+        Send all of the queued notifications for the specified drone to its peripheral's delegate
+
+        :param index: index of the drone in the fleet
+        :return: True if any notifications were delivered and False otherwise
+        """
+        peripheral = self.peripherals[index]
+        outbox = self.outboxes[index]
+        delivered = False
+        while (len(outbox) > 0):
+            (channel, packet) = outbox.popleft()
+            if (peripheral is not None):
+                peripheral._notify(channel, packet)
+            delivered = True
+        return delivered
+
+    def run(self, duration, dt=0.01, callback=None):
+        """
+        Run the fleet as fast as possible (not in real time) for duration simulated seconds.  Notifications are
+        delivered to any attached peripherals after every step.
+
+        :param duration: number of simulated seconds to run
+        :param dt: time step in seconds
+        :param callback: optional function called as callback(fleet) after every step (use it to set commands)
+        :return: nothing
+        """
+        end_time = self.time + duration
+        while (self.time < end_time):
+            self.step(min(dt, end_time - self.time))
+            for index in range(self.num_drones):
+                self.deliver_notifications(index)
+            if (callback is not None):
+                callback(self)
+
+
+class SimulatedCharacteristic:
+    """
+    Stand in for a bluepy characteristic
+    """
+
+    def __init__(self, peripheral, uuid, handle):
+        self.peripheral = peripheral
+        self.uuid = uuid
+        self.handle = handle
+
+    def getHandle(self):
+        # bluepy reports the value handle (one above the declaration)
+        return self.handle + 1
+
+    def write(self, val, withResponse=False):
+        self.peripheral._write(self, val)
+
+
+class SimulatedService:
+    """
+    Stand in for a bluepy service
+    """
+
+    def __init__(self, uuid, characteristics):
+        self.uuid = uuid
+        self.characteristics = characteristics
+
+    def getCharacteristics(self):
+        return self.characteristics
+
+
+class SimulatedPeripheral:
+    """
+    Stand in for the bluepy Peripheral that talks to one drone of a MamboFleetSimulator.  It exposes the same
+    services and characteristics as a real mambo so the Mambo class runs unmodified against it.
+    """
+
+    def __init__(self, fleet, index=0):
+        """
+        :param fleet: MamboFleetSimulator holding this drone
+        :param index: index of the drone in the fleet
+        """
+        self.fleet = fleet
+        self.index = index
+        self.delegate = None
+        self.connected = False
+
+        # the 3rd and 4th bytes of the UUIDs identify the services and characteristics (see Mambo.__init__)
+        uuid_format = "9a66%s-0800-9191-11e4-012d1540cb8e"
+        layout = [
+            ('fa00', ['fa0a', 'fa0b', 'fa0c', 'fa1e']),
+            ('fb00', ['fb0e', 'fb0f', 'fb1b', 'fb1c']),
+            ('fd21', ['fd22', 'fd23', 'fd24']),
+            ('fd51', ['fd52', 'fd53', 'fd54']),
+        ]
+
+        self.services = list()
+        self.characteristics_by_id = dict()
+        self.characteristics_by_handle = dict()
+        handle = 16
+        for (service_id, characteristic_ids) in layout:
+            characteristics = list()
+            for characteristic_id in characteristic_ids:
+                c = SimulatedCharacteristic(self, uuid_format % characteristic_id, handle)
+                characteristics.append(c)
+                self.characteristics_by_id[characteristic_id[2:4]] = c
+                self.characteristics_by_handle[c.getHandle()] = c
+                # declaration, value and notification config handles
+                handle += 3
+            self.services.append(SimulatedService(uuid_format % service_id, characteristics))
+
+        # ack channels for the two command channels
+        self.ack_channels = {'0b': '1b', '0c': '1c'}
+        self.ack_counters = {'1b': 0, '1c': 0}
+
+        # received acks from the user on the 1e channel
+        self.acks_received = 0
+
+        fleet.attach(self, index)
+
+    def connect(self, addr, addrType="random"):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def getServices(self):
+        return self.services
+
+    def setDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def withDelegate(self, delegate):
+        return self.setDelegate(delegate)
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        # only used to turn on notifications in the handshake
+        pass
+
+    def _write(self, characteristic, packet):
+        """
+        Handle a packet written to one of the characteristics
+
+        :param characteristic: SimulatedCharacteristic written to
+        :param packet: the packet
+        """
+        characteristic_id = characteristic.uuid[6:8]
+        if (characteristic_id == '1e'):
+            self.acks_received += 1
+            return
+        elif (characteristic_id not in ('0a', '0b', '0c')):
+            return
+
+        self.fleet.receive_packet(self.index, packet)
+
+        # the drone acks the ack and high priority channels with the sequence number it received
+        if (characteristic_id in self.ack_channels):
+            ack_channel = self.ack_channels[characteristic_id]
+            self.ack_counters[ack_channel] = (self.ack_counters[ack_channel] + 1) % 256
+            ack = struct.pack("<BBB", self.fleet.data_types['ACK'], self.ack_counters[ack_channel],
+                              struct.unpack_from("<B", packet, offset=1)[0])
+            with self.fleet.lock:
+                self.fleet.outboxes[self.index].append((ack_channel, ack))
+
+    def _notify(self, channel, packet):
+        """
+        Send a notification to the delegate on the characteristic for the channel
+
+        :param channel: channel name (as in the Mambo characteristic_receive_uuids) or the characteristic id
+        :param packet: the packet
+        """
+        if (self.delegate is None):
+            return
+        characteristic_ids = {'ACK_DRONE_DATA': '0e', 'NO_ACK_DRONE_DATA': '0f'}
+        characteristic_id = characteristic_ids.get(channel, channel)
+        self.delegate.handleNotification(self.characteristics_by_id[characteristic_id].getHandle(), packet)
+
+    def waitForNotifications(self, timeout):
+        """
+        Wait up to timeout seconds (wall clock) for notifications, stepping the simulation as time passes
+
+        :param timeout: seconds to wait
+        :return: True if any notifications were delivered and False otherwise
+        """
+        end_time = time.time() + timeout
+        while True:
+            if (self.fleet.realtime):
+                self.fleet.advance_realtime()
+            if (self.fleet.deliver_notifications(self.index)):
+                return True
+            remaining = end_time - time.time()
+            if (remaining <= 0):
+                return False
+            time.sleep(min(remaining, self.fleet.max_step))
@@ -0,0 +1,322 @@
+"""
+MamboTelemetry publishes the mambo's sensor updates as small binary datagrams so dashboards, loggers and other
+processes can follow the drone without touching the BLE connection (or each other).
+
+Every decoded sensor packet becomes one record.  By default records go to a UDP multicast group on the
+loopback interface, so any number of subscribers on the same computer can listen:
+
+    publisher = MamboTelemetryPublisher(mambo, rates={'quaternion': 20, 'speed': 20})
+    ...
+    # in another process
+    subscriber = MamboTelemetrySubscriber()
+    while True:
+        record = subscriber.receive(timeout=1.0)
+        if (record is not None and record['record'] == "altitude"):
+            print record['altitude']
+
+Records can also be sent to plain UDP addresses (host, port) or to Unix datagram sockets (a path).
+
+Each datagram is a 16 byte header (magic, version, record type, sequence number and the time the BLE packet
+was received) followed by the fixed fields of the record (TELEMETRY_RECORDS), all little endian.  The sequence
+number counts every record the publisher produced, so subscribers can tell how many they missed.
+"""
+import os
+import socket
+import struct
+import threading
+
+TELEMETRY_MAGIC = 0x4d54
+TELEMETRY_VERSION = 1
+TELEMETRY_GROUP = ("239.255.77.77", 5577)
+
+# magic, version, record type, sequence number, receive time
+TELEMETRY_HEADER = struct.Struct("<HBBId")
+
+# record type: (name, struct of the fields, names of the fields).  Enums are sent as their index in
+# TELEMETRY_ENUMS (255 if unknown) and sensors that haven't arrived yet as 255.
+TELEMETRY_RECORDS = {
+    1: ("speed", struct.Struct("<fffI"), ("speed_x", "speed_y", "speed_z", "speed_ts")),
+    2: ("altitude", struct.Struct("<fI"), ("altitude", "altitude_ts")),
+    3: ("quaternion", struct.Struct("<ffffI"),
+        ("quaternion_w", "quaternion_x", "quaternion_y", "quaternion_z", "quaternion_ts")),
+    4: ("state", struct.Struct("<BBBBBB"), ("battery", "flying_state", "claw_id", "claw_state", "gun_id", "gun_state")),
+}
+
+TELEMETRY_ENUMS = {
+    'flying_state': ("landed", "takingoff", "hovering", "flying", "landing", "emergency", "rolling", "init"),
+    'claw_state': ("OPENED", "OPENING", "CLOSED", "CLOSING"),
+    'gun_state': ("READY", "BUSY"),
+}
+
+# the record type sent for each sensor message
+TELEMETRY_MESSAGES = {
+    'DroneSpeed': 1,
+    'DroneAltitude': 2,
+    'DroneQuaternion': 3,
+    'BatteryStateChanged': 4,
+    'FlyingStateChanged': 4,
+    'ClawState': 4,
+    'GunState': 4,
+}
+
+UNKNOWN_VALUE = 255
+
+
+def _open_socket(address):
+    if (isinstance(address, basestring)):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+def _is_multicast(host):
+    return 224 <= int(host.split(".")[0]) <= 239
+
+
+class MamboTelemetryPublisher:
+    """
+    Sends a record for each sensor update (it is a sensor listener, so it runs on the BLE notification thread
+    and never blocks: records that can't be sent right away are dropped)
+    """
+
+    def __init__(self, mambo, destinations=(TELEMETRY_GROUP,), rates=None, interface="127.0.0.1"):
+        """
+        :param mambo: the Mambo whose sensors are published
+        :param destinations: where to send the records: (host, port) for UDP (multicast groups included) or the
+        path of a Unix datagram socket
+        :param rates: maximum records per second for each record name (e.g. {'quaternion': 20}).  Records with
+        no rate are sent for every update.  Updates in between are skipped, not delayed.
+        :param interface: address of the interface multicast records are sent from ("127.0.0.1" keeps them on
+        this computer)
+        """
+        self.mambo = mambo
+        self.destinations = list()
+        self.sockets = dict()
+        self.interface = interface
+        for destination in destinations:
+            self.add_destination(destination)
+
+        self.min_intervals = dict()
+        for (name, rate) in (rates or dict()).items():
+            self.set_rate(name, rate)
+        self.last_sent = dict()
+        self.seq = 0
+
+        self.records_sent = 0
+        self.records_dropped = 0
+        self.records_skipped = 0
+
+        mambo.add_sensor_listener(self._sensor_update)
+
+    def add_destination(self, destination):
+        """
+        Also send the records to a (host, port) or a Unix datagram socket path
+        """
+        family = "unix" if isinstance(destination, basestring) else "udp"
+        if (family not in self.sockets):
+            sock = _open_socket(destination)
+            sock.setblocking(False)
+            if (family == "udp"):
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+            self.sockets[family] = sock
+        self.destinations = self.destinations + [(destination, self.sockets[family])]
+
+    def remove_destination(self, destination):
+        """
+        Stop sending records to a destination
+        """
+        self.destinations = [(other, sock) for (other, sock) in self.destinations if other != destination]
+
+    def set_rate(self, name, rate):
+        """
+        Limit how often a record is sent
+
+        :param name: record name (speed, altitude, quaternion or state)
+        :param rate: maximum records per second (None for every update)
+        """
+        if (rate is None):
+            self.min_intervals.pop(name, None)
+        else:
+            self.min_intervals[name] = 1.0 / rate
+
+    def _value(self, field, value):
+        if (field in TELEMETRY_ENUMS):
+            if (value in TELEMETRY_ENUMS[field]):
+                return TELEMETRY_ENUMS[field].index(value)
+            return UNKNOWN_VALUE
+        if (value is None):
+            return UNKNOWN_VALUE
+        return value
+
+    def _sensor_update(self, sensors, names, receive_time):
+        record_type = TELEMETRY_MESSAGES.get(names[0].split("_")[0])
+        if (record_type is None):
+            return
+        (name, record_struct, fields) = TELEMETRY_RECORDS[record_type]
+
+        min_interval = self.min_intervals.get(name)
+        if (min_interval is not None):
+            if (receive_time - self.last_sent.get(name, 0.0) < min_interval):
+                self.records_skipped += 1
+                return
+            self.last_sent[name] = receive_time
+
+        self.seq = (self.seq + 1) & 0xffffffff
+        values = [self._value(field, getattr(sensors, field)) for field in fields]
+        try:
+            header = TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, TELEMETRY_VERSION, record_type, self.seq, receive_time)
+            datagram = header + record_struct.pack(*values)
+        except struct.error:
+            self.records_dropped += 1
+            return
+
+        for (destination, sock) in self.destinations:
+            try:
+                sock.sendto(datagram, destination)
+                self.records_sent += 1
+            except socket.error:
+                # nobody listening on a Unix socket or the send buffer is full (never stop the BLE thread)
+                self.records_dropped += 1
+
+    def get_stats(self):
+        """
+        :return: dictionary with the records sent, dropped (couldn't be sent) and skipped (rate limits)
+        """
+        return {
+            'sent': self.records_sent,
+            'dropped': self.records_dropped,
+            'skipped': self.records_skipped
+        }
+
+    def close(self):
+        """
+        Stop publishing
+        """
+        self.mambo.remove_sensor_listener(self._sensor_update)
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets = dict()
+        self.destinations = list()
+
+
+def decode_record(datagram):
+    """
+    Decode a telemetry datagram
+
+    :return: dictionary with the record name ('record'), sequence number ('seq'), receive time ('time') and the
+    fields of the record (enums are turned back into strings, missing values into None) or None if the datagram
+    isn't a telemetry record
+    """
+    if (len(datagram) < TELEMETRY_HEADER.size):
+        return None
+    (magic, version, record_type, seq, receive_time) = TELEMETRY_HEADER.unpack_from(datagram)
+    if (magic != TELEMETRY_MAGIC or version != TELEMETRY_VERSION or record_type not in TELEMETRY_RECORDS):
+        return None
+    (name, record_struct, fields) = TELEMETRY_RECORDS[record_type]
+    if (len(datagram) != TELEMETRY_HEADER.size + record_struct.size):
+        return None
+
+    record = {'record': name, 'seq': seq, 'time': receive_time}
+    for (field, value) in zip(fields, record_struct.unpack_from(datagram, TELEMETRY_HEADER.size)):
+        if (name == "state" and value == UNKNOWN_VALUE):
+            value = None
+        elif (field in TELEMETRY_ENUMS):
+            enum = TELEMETRY_ENUMS[field]
+            value = enum[value] if value < len(enum) else None
+        record[field] = value
+    return record
+
+
+class MamboTelemetrySubscriber:
+    """
+    Receives the records of a MamboTelemetryPublisher
+    """
+
+    def __init__(self, address=TELEMETRY_GROUP, interface="127.0.0.1"):
+        """
+        :param address: (host, port) to listen on (a multicast group is joined) or a Unix datagram socket path
+        :param interface: address of the interface to join the multicast group on
+        """
+        self.address = address
+        self.sock = _open_socket(address)
+        if (isinstance(address, basestring)):
+            if (os.path.exists(address)):
+                os.remove(address)
+            self.sock.bind(address)
+        else:
+            (host, port) = address
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if (_is_multicast(host)):
+                self.sock.bind(("", port))
+                membership = socket.inet_aton(host) + socket.inet_aton(interface)
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            else:
+                self.sock.bind(address)
+
+        # latest record of each kind
+        self.latest = dict()
+        self.last_seq = None
+        self.records_received = 0
+        self.records_missed = 0
+
+        self.running = False
+        self.subscriber_thread = None
+
+    def receive(self, timeout=None):
+        """
+        Wait for the next record
+
+        :param timeout: seconds to wait (None waits forever)
+        :return: the record (see decode_record) or None on timeout
+        """
+        self.sock.settimeout(timeout)
+        try:
+            datagram = self.sock.recv(256)
+        except socket.timeout:
+            return None
+
+        record = decode_record(datagram)
+        if (record is None):
+            return None
+        # (a lower sequence number means the publisher was restarted)
+        if (self.last_seq is not None and record['seq'] > self.last_seq):
+            self.records_missed += record['seq'] - self.last_seq - 1
+        self.last_seq = record['seq']
+        self.records_received += 1
+        self.latest[record['record']] = record
+        return record
+
+    def start(self, callback):
+        """
+        Receive records on a background thread
+
+        :param callback: function called with each record
+        """
+        self.running = True
+        self.subscriber_thread = threading.Thread(target=self._run, args=(callback,))
+        self.subscriber_thread.daemon = True
+        self.subscriber_thread.start()
+
+    def _run(self, callback):
+        while (self.running):
+            record = self.receive(timeout=0.5)
+            if (record is not None):
+                callback(record)
+
+    def stop(self):
+        """
+        Stop the background thread
+        """
+        self.running = False
+        if (self.subscriber_thread is not None):
+            self.subscriber_thread.join()
+            self.subscriber_thread = None
+
+    def close(self):
+        """
+        Stop receiving and close the socket
+        """
+        self.stop()
+        self.sock.close()
+        if (isinstance(self.address, basestring) and os.path.exists(self.address)):
+            os.remove(self.address)
@@ -0,0 +1,127 @@
+"""
+MamboTracer records a timeline of what the library is doing (BLE connection and discovery, command writes
+and ack waits, reconnects, notification waits, sensor decoding, fly_direct and the vision capture) and exports
+it in the Chrome trace event format, which chrome://tracing and https://ui.perfetto.dev open directly.
+
+    tracer = mambo.enable_tracing()
+    vision.tracer = tracer          # optional: include the vision thread
+    ... fly ...
+    with tracer.span("my_planner", "user"):
+        ... your own code shows up too ...
+    tracer.export("flight_trace.json")
+
+Tracing is off until enable_tracing is called: every trace point is a single "if tracer is not None" check.
+Events go into a ring buffer (the oldest are dropped once it is full) so it can be left on for a whole flight.
+"""
+import collections
+import json
+import os
+import thread
+import threading
+import time
+
+
+class MamboTraceSpan:
+    """
+    Context manager that records a span around a block of code
+    """
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.complete(self.name, self.category, self.start, self.args)
+        return False
+
+
+class MamboTracer:
+    """
+    Ring buffer of trace events that can be exported as a Chrome/Perfetto trace
+    """
+
+    def __init__(self, size=100000):
+        """
+        :param size: maximum number of events kept (the oldest are dropped first)
+        """
+        self.events = collections.deque(maxlen=size)
+        self.pid = os.getpid()
+        self.thread_names = dict()
+
+    def _thread_id(self):
+        tid = thread.get_ident()
+        if (tid not in self.thread_names):
+            self.thread_names[tid] = threading.current_thread().name
+        return tid
+
+    def complete(self, name, category, start, args=None):
+        """
+        Record a span that started at start and ends now
+
+        :param name: name of the span
+        :param category: category (ble, command, sensors, vision, user...)
+        :param start: time.time() when the span started
+        :param args: optional dictionary shown with the event
+        """
+        end = time.time()
+        self.events.append(("X", name, category, start, end - start, self._thread_id(), args))
+
+    def instant(self, name, category, args=None):
+        """
+        Record an instant event (something that happened at one point in time)
+        """
+        self.events.append(("i", name, category, time.time(), 0.0, self._thread_id(), args))
+
+    def counter(self, name, values):
+        """
+        Record the values of a counter track (e.g. {'altitude': 1.2})
+        """
+        self.events.append(("C", name, "counter", time.time(), 0.0, self._thread_id(), values))
+
+    def span(self, name, category="user", args=None):
+        """
+        :return: a context manager that records a span around the with block
+        """
+        return MamboTraceSpan(self, name, category, args)
+
+    def clear(self):
+        """
+        Forget the recorded events
+        """
+        self.events.clear()
+
+    def get_events(self):
+        """
+        :return: the recorded events as a list of Chrome trace event dictionaries (times in microseconds)
+        """
+        trace_events = list()
+        for (tid, name) in self.thread_names.items():
+            trace_events.append({'ph': "M", 'name': "thread_name", 'pid': self.pid, 'tid': tid,
+                                 'args': {'name': name}})
+
+        for (phase, name, category, start, duration, tid, args) in list(self.events):
+            event = {'ph': phase, 'name': name, 'cat': category, 'ts': start * 1e6, 'pid': self.pid, 'tid': tid}
+            if (phase == "X"):
+                event['dur'] = duration * 1e6
+            elif (phase == "i"):
+                event['s'] = "t"
+            if (args is not None):
+                event['args'] = args
+            trace_events.append(event)
+        return trace_events
+
+    def export(self, path):
+        """
+        Write the trace to a JSON file for chrome://tracing or ui.perfetto.dev
+
+        :param path: file to write
+        """
+        with open(path, "w") as trace_file:
+            json.dump({'traceEvents': self.get_events(), 'displayTimeUnit': "ms"}, trace_file)
@@ -0,0 +1,186 @@
+"""
+Video sources for MamboVision.  By default MamboVision reads the mambo's FPV stream but it can also read a
+video file, a camera attached to the computer or a synthetic generator, which makes it possible to develop
+and benchmark vision code (see benchmarkVision.py) without flying or joining the drone's wifi.
+
+A source is anything with the cv2.VideoCapture methods MamboVision uses (isOpened, grab, retrieve, read and
+release).  open_video_source picks one from a simple description:
+
+* None: the mambo's stream (MAMBO_STREAM_URL)
+* an int: the camera with that index (e.g. 0 for a webcam)
+* "synthetic" or "synthetic:640x360@30": a generated test pattern (width x height at a frame rate)
+* any other string: a URL (rtsp://, http://) or the path of a video file.  Files are played back at their
+  own frame rate and loop so they behave like a live stream.
+* an object that already has the methods (it is used as is)
+"""
+import os
+import time
+
+import cv2
+import numpy as np
+
+MAMBO_STREAM_URL = "rtsp://192.168.99.1/media/stream2"
+
+
+class MamboFileCapture:
+    """
+    Plays a video file like a live stream: frames are released at the file's frame rate (grab waits for the
+    next one) and the file loops at the end
+    """
+
+    def __init__(self, path, loop=True, realtime=True):
+        """
+        :param path: video file
+        :param loop: if True, start over at the end of the file
+        :param realtime: if True, release frames at the file's frame rate (False reads as fast as possible)
+        """
+        self.path = path
+        self.loop = loop
+        self.realtime = realtime
+        self.capture = cv2.VideoCapture(path)
+
+        file_fps = self.capture.get(cv2.CAP_PROP_FPS)
+        if (file_fps is None or file_fps <= 0 or file_fps > 1000):
+            file_fps = 30.0
+        self.frame_interval = 1.0 / file_fps
+        self.next_frame_time = None
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def grab(self):
+        if (self.realtime):
+            now = time.time()
+            if (self.next_frame_time is None):
+                self.next_frame_time = now
+            elif (self.next_frame_time > now):
+                time.sleep(self.next_frame_time - now)
+            # don't try to catch up after a stall (a live stream wouldn't either)
+            self.next_frame_time = max(self.next_frame_time + self.frame_interval, now)
+
+        if (self.capture.grab()):
+            return True
+        if (not self.loop):
+            return False
+        self.capture.release()
+        self.capture = cv2.VideoCapture(self.path)
+        return self.capture.grab()
+
+    def retrieve(self, image=None):
+        return self.capture.retrieve(image=image)
+
+    def read(self, image=None):
+        if (not self.grab()):
+            return (False, None)
+        return self.retrieve(image)
+
+    def release(self):
+        self.capture.release()
+
+
+class MamboSyntheticCapture:
+    """
+    Generates a test pattern (a square moving over a gradient with the frame number in the corner) at a fixed
+    frame rate.  Frames are drawn straight into the caller's image so it allocates nothing per frame.
+    """
+
+    def __init__(self, width=640, height=360, fps=30.0, realtime=True):
+        """
+        :param width: width of the frames
+        :param height: height of the frames
+        :param fps: frames per second
+        :param realtime: if True, grab waits for the next frame time (False generates as fast as possible)
+        """
+        self.width = width
+        self.height = height
+        self.fps = float(fps)
+        self.realtime = realtime
+        self.frame_number = 0
+        self.next_frame_time = None
+        self.opened = True
+
+        # the background is computed once and copied into each frame
+        gradient = np.linspace(0, 255, width).astype(np.uint8)
+        self.background = np.empty((height, width, 3), dtype=np.uint8)
+        self.background[:, :, 0] = gradient
+        self.background[:, :, 1] = gradient[::-1]
+        self.background[:, :, 2] = 64
+        self.square_size = max(height // 6, 1)
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        if (not self.opened):
+            return False
+        if (self.realtime):
+            now = time.time()
+            if (self.next_frame_time is None):
+                self.next_frame_time = now
+            elif (self.next_frame_time > now):
+                time.sleep(self.next_frame_time - now)
+            self.next_frame_time = max(self.next_frame_time + 1.0 / self.fps, now)
+        self.frame_number += 1
+        return True
+
+    def retrieve(self, image=None):
+        if (image is None or image.shape != self.background.shape):
+            image = np.empty(self.background.shape, dtype=np.uint8)
+        np.copyto(image, self.background)
+
+        # the square crosses the frame every two seconds
+        travel = self.width - self.square_size
+        position = int((self.frame_number / (2.0 * self.fps)) * travel) % max(2 * travel, 1)
+        if (position > travel):
+            position = 2 * travel - position
+        top = (self.height - self.square_size) // 2
+        image[top:top + self.square_size, position:position + self.square_size] = 255
+
+        # frame number in binary along the top left corner (so tests can check which frame they got)
+        for bit in range(16):
+            image[0:4, bit * 4:bit * 4 + 4] = 255 if (self.frame_number >> bit) & 1 else 0
+        return (True, image)
+
+    def read(self, image=None):
+        if (not self.grab()):
+            return (False, None)
+        return self.retrieve(image)
+
+    def release(self):
+        self.opened = False
+
+
+def open_video_source(source=None):
+    """
+    Open a video source (see the module documentation for the descriptions it understands)
+
+    :param source: None, a camera index, "synthetic[:WIDTHxHEIGHT@FPS]", a URL, a file path or a capture object
+    :return: an object with the cv2.VideoCapture methods MamboVision uses
+    """
+    if (source is None):
+        return cv2.VideoCapture(MAMBO_STREAM_URL)
+    if (isinstance(source, (int, long))):
+        return cv2.VideoCapture(source)
+    if (isinstance(source, basestring)):
+        if (source.startswith("synthetic")):
+            (width, height, fps) = (640, 360, 30.0)
+            if (":" in source):
+                (size, fps) = source.split(":", 1)[1].split("@")
+                (width, height) = [int(value) for value in size.split("x")]
+                fps = float(fps)
+            return MamboSyntheticCapture(width, height, fps)
+        if ("://" not in source and os.path.exists(source)):
+            return MamboFileCapture(source)
+        return cv2.VideoCapture(source)
+    return source
+
+
+def video_source_url(source):
+    """
+    :return: the URL of a stream source (used for passthrough recording) or None for other sources
+    """
+    if (source is None):
+        return MAMBO_STREAM_URL
+    if (isinstance(source, basestring) and not source.startswith("synthetic")):
+        return source
+    return None
@@ -19,11 +19,18 @@ https://github.com/tgogos/rpi_ffmpeg
 Author: Amy McGovern, dramymcgovern@gmail.com
 """
 import cv2
+import numpy as np
 import threading
 import time
+from MamboCondition import MamboCondition
+from MamboVisionPipeline import MamboVisionPipeline
+from MamboVisionGovernor import MamboVisionGovernor
+from MamboFrameShare import MamboFrameSharePublisher
+from MamboRecorder import MamboRecorder
+from MamboVideoSource import open_video_source, video_source_url
 
 class MamboVision:
-    def __init__(self, fps=10, buffer_size=10):
+    def __init__(self, fps=10, buffer_size=10, drain_stream=True, source=None):
         """
         Setup your vision object and initialize your buffers.  You won't start seeing pictures
         until you call open_video.
@@ -31,18 +38,82 @@ class MamboVision:
         :param fps: frames per second (don't set this very high on a Raspberry Pi!).  Defaults to 10 which is a number
         that should keep a Raspberry Pi busy but not overheated.
 
-        :param buffer_size: number of frames to buffer in memory.  Defaults to 10.
+        :param buffer_size: number of frames to buffer in memory (at least 2).  Defaults to 10.  The buffer is a
+        single numpy array of shape (buffer_size, height, width, 3) allocated when the first frame arrives and
+        opencv decodes straight into it, so capturing doesn't allocate memory for each frame.
+
+        :param drain_stream: if True (default), keep reading the stream as fast as it arrives (with grab, which
+        doesn't decode) and only decode the frames that are saved (at most fps a second).  This keeps the frames
+        fresh since old frames never pile up inside opencv.  If False, read and decode a frame and then sleep
+        for 1/fps (the stream lags behind if the drone sends frames faster than fps).
+
+        :param source: where the video comes from.  Defaults to None which is the mambo's FPV stream.  It can also
+        be a camera index, a video file, a URL or "synthetic" for a generated test pattern (see MamboVideoSource.py)
+        so vision code can be developed and benchmarked without the drone.
         """
 
+        if (buffer_size < 2):
+            raise ValueError("buffer_size must be at least 2")
+
         self.fps = fps
         self.buffer_size = buffer_size
-
-        # initialize a buffer (will contain the last buffer_size vision objects)
-        self.buffer = [None] * buffer_size
+        self.drain_stream = drain_stream
+
+        # the video source and its address (None if it isn't a stream or file)
+        self.source = source
+        self.stream_url = video_source_url(source)
+
+        # the ring buffer of frames (allocated when the first frame arrives) with the capture time and sequence
+        # number of the frame in each slot (sequence number 0 means the slot is empty and -1 that a frame is being
+        # decoded into it)
+        self.buffer = None
+        self.buffer_times = np.zeros(buffer_size)
+        self.buffer_seqs = np.zeros(buffer_size, dtype=np.int64)
         self.buffer_index = 0
 
+        # frame_seq counts the frames saved to the buffer.  buffer_index, frame_seq and frame_time are only
+        # changed while holding new_frame (which also wakes up anyone waiting for a new frame).  The capture
+        # thread marks the slot after buffer_index (the oldest frame) with -1 while holding the lock and then
+        # decodes into it without the lock.
+        # (a MamboCondition wakes the waiters right away, python 2's Condition.wait(timeout) polls)
+        self.new_frame = MamboCondition()
+        self.frame_seq = 0
+        self.frame_time = None
+
+        # saved frames are shrunk by this factor and cropped to roi, (x, y, width, height) as fractions of the
+        # frame, if it isn't None.  A MamboVisionGovernor changes these (and fps) while the video is running.
+        self.downscale = 1.0
+        self.roi = None
+        self.decode_buffer = None
+
+        # optional change detection (see enable_change_detection).  Each saved frame gets a score: how different
+        # it is from the last significantly changed frame (0 is identical, 1 is as different as possible).
+        self.change_threshold = None
+        self.change_scale = 8
+        self.change_thumbnail = None
+        self.change_reference = None
+        self.buffer_scores = np.zeros(buffer_size)
+        self.change_seq = 0
+        self.change_index = 0
+
+        # frames read from the source and frames decoded (with drain_stream most frames are grabbed but not decoded)
+        self.frames_grabbed = 0
+        self.frames_decoded = 0
+
+        # publishes the frames to other processes (see start_frame_sharing)
+        self.frame_share = None
+        self.frame_share_name = None
+        self.frame_share_slots = None
+
+        # records the frames to disk (see start_recording)
+        self.recorder = None
+
+        # optional MamboTracer for the decode and save timeline (e.g. vision.tracer = mambo.enable_tracing())
+        self.tracer = None
+
         # setup the thread for monitoring the vision (but don't start it until we connect in open_video)
         self.vision_thread = threading.Thread(target=self._buffer_vision, args=(fps, buffer_size))
+        self.vision_thread.daemon = True
 
         self.vision_running = True
 
@@ -67,7 +138,7 @@ class MamboVision:
         :return True if the vision opened correctly and False otherwise
         """
         print "opening the camera"
-        self.capture = cv2.VideoCapture("rtsp://192.168.99.1/media/stream2")
+        self.capture = open_video_source(self.source)
 
         #print self.capture.get(cv2.CV_CAP_PROPS_FPS)
 
@@ -75,7 +146,7 @@ class MamboVision:
         try_num = 1
         while (not self.capture.isOpened() and try_num < max_retries):
             print "re-trying to open the capture"
-            self.capture = cv2.VideoCapture("rtsp://192.168.99.1/media/stream2")
+            self.capture = open_video_source(self.source)
             try_num += 1
 
         # return whether the vision opened
@@ -99,35 +170,423 @@ class MamboVision:
         :param buffer_size: number of images to buffer (set in init)
         :return:
         """
+        next_save = time.time()
 
         while (self.vision_running):
-            # grab the latest image
-            print "grabbing frame"
-            capture_correct, video_frame = self.capture.read()
-            print capture_correct
+            # decode straight into the buffer unless the frame has to be shrunk or cropped first
+            shrink = (self.downscale != 1.0 or self.roi is not None)
+            if (shrink):
+                target = self.decode_buffer
+            else:
+                target = self._next_slot()
+
+            if (self.drain_stream):
+                # grab blocks until the next frame arrives so this keeps up with the stream.  Only decode when
+                # it is time to save a frame.
+                if (not self.capture.grab()):
+                    time.sleep(0.01)
+                    continue
+                self.frames_grabbed += 1
+
+                now = time.time()
+                if (now < next_save):
+                    continue
+
+                decode_start = now
+                self._claim_next_slot()
+                capture_correct, video_frame = self.capture.retrieve(image=target)
+            else:
+                decode_start = time.time()
+                self._claim_next_slot()
+                capture_correct, video_frame = self.capture.read(image=target)
+                now = time.time()
+                self.frames_grabbed += 1
+
+            self.frames_decoded += 1
+            tracer = self.tracer
+            if (tracer is not None):
+                tracer.complete("decode_frame", "vision", decode_start, {'success': capture_correct})
+
             if (capture_correct):
-                self.buffer_index += 1
-                self.buffer_index %= buffer_size
-                print "saving frame to buffer"
-                #print video_frame
-                self.buffer[self.buffer_index] = video_frame
-                
-            # put the thread back to sleep for fps
-            print "sleeping for %f" % (1.0 / fps)
-            time.sleep(1.0 / fps)
-        
-
-    def get_latest_valid_picture(self):
+                if (tracer is not None):
+                    start = time.time()
+                if (shrink):
+                    self.decode_buffer = video_frame
+                    video_frame = self._shrink_frame(video_frame)
+                self._save_frame(video_frame, now)
+                if (tracer is not None):
+                    tracer.complete("save_frame", "vision", start, {'seq': self.frame_seq})
+
+            # schedule the next frame from the last one (but don't try to catch up after a stall).  fps is read
+            # every frame since the governor can change it.
+            next_save = max(next_save + 1.0 / self.fps, now)
+
+            if (not self.drain_stream):
+                time.sleep(max(next_save - time.time(), 0))
+
+        self._close_frame_share()
+
+    def _shrink_frame(self, video_frame):
+        """
+        Crop a frame to roi and shrink it by downscale (into the next slot of the buffer when the size matches)
+
+        :param video_frame: full size frame
+        :return: the smaller frame
+        """
+        roi = self.roi
+        downscale = self.downscale
+        (height, width) = video_frame.shape[0:2]
+
+        if (roi is not None):
+            (x, y, roi_width, roi_height) = roi
+            left = min(max(int(x * width), 0), width - 1)
+            top = min(max(int(y * height), 0), height - 1)
+            right = max(min(int((x + roi_width) * width), width), left + 1)
+            bottom = max(min(int((y + roi_height) * height), height), top + 1)
+            video_frame = video_frame[top:bottom, left:right]
+
+        out_width = max(int(video_frame.shape[1] / downscale), 1)
+        out_height = max(int(video_frame.shape[0] / downscale), 1)
+        slot = self._next_slot()
+        if (slot is not None and slot.shape[0:2] == (out_height, out_width)):
+            return cv2.resize(video_frame, (out_width, out_height), dst=slot, interpolation=cv2.INTER_AREA)
+        return cv2.resize(video_frame, (out_width, out_height), interpolation=cv2.INTER_AREA)
+
+    def _next_slot(self):
+        """
+        :return: the slot in the buffer that the next frame is decoded into (None until the buffer is allocated)
+        """
+        if (self.buffer is None):
+            return None
+        return self.buffer[(self.buffer_index + 1) % self.buffer_size]
+
+    def _claim_next_slot(self):
+        """
+        Mark the next slot as being overwritten before decoding (or shrinking or copying) a frame into it, so
+        readers that look a frame up by its sequence number don't return it half written
+        """
+        with self.new_frame:
+            self.buffer_seqs[(self.buffer_index + 1) % self.buffer_size] = -1
+
+    def _save_frame(self, video_frame, frame_time):
+        """
+        Save a frame in the buffer and wake up anyone waiting for it
+
+        :param video_frame: the image (usually already decoded into the next slot)
+        :param frame_time: time the frame was captured
+        """
+        next_index = (self.buffer_index + 1) % self.buffer_size
+
+        if (self.buffer is None or self.buffer.shape[1:] != video_frame.shape):
+            # first frame (or the stream changed size).  Views of the old buffer stay valid.
+            with self.new_frame:
+                self.buffer = np.zeros((self.buffer_size,) + video_frame.shape, dtype=video_frame.dtype)
+                self.buffer_seqs[:] = 0
+
+        if (not np.may_share_memory(video_frame, self.buffer)):
+            # opencv allocated a new image instead of decoding into the slot
+            self.buffer[next_index] = video_frame
+
+        if (self.change_threshold is not None):
+            (score, changed) = self._change_score(self.buffer[next_index])
+        else:
+            (score, changed) = (0.0, False)
+
+        with self.new_frame:
+            self.buffer_times[next_index] = frame_time
+            self.buffer_scores[next_index] = score
+            self.frame_seq += 1
+            self.buffer_seqs[next_index] = self.frame_seq
+            self.buffer_index = next_index
+            self.frame_time = frame_time
+            if (changed):
+                self.change_seq = self.frame_seq
+                self.change_index = next_index
+            self.new_frame.notify_all()
+
+        # the recorder copies the frame and returns right away (it drops frames rather than waiting)
+        recorder = self.recorder
+        if (recorder is not None):
+            recorder.add_frame(self.buffer[next_index], frame_time)
+
+        # the shared ring is only created and removed on the capture thread
+        if (self.frame_share_name is not None):
+            self._share_frame(self.buffer[next_index], frame_time, self.frame_seq)
+        elif (self.frame_share is not None):
+            self._close_frame_share()
+
+    def _change_score(self, video_frame):
+        """
+        Compare a frame to the last significantly changed frame using a small thumbnail (every change_scale-th
+        pixel, channels summed)
+
+        :return: (score, changed): the mean absolute difference scaled to [0, 1] and whether it is over the threshold
+        """
+        step = self.change_scale
+        small = video_frame[::step, ::step]
+        if (self.change_thumbnail is None or self.change_thumbnail.shape != small.shape[0:2]):
+            self.change_thumbnail = np.empty(small.shape[0:2], dtype=np.int16)
+            self.change_reference = None
+
+        if (small.ndim == 3):
+            np.sum(small, axis=2, dtype=np.int16, out=self.change_thumbnail)
+            full_scale = 255.0 * small.shape[2]
+        else:
+            self.change_thumbnail[:] = small
+            full_scale = 255.0
+
+        if (self.change_reference is None):
+            # nothing to compare the first frame to so it counts as changed
+            self.change_reference = self.change_thumbnail.copy()
+            return (1.0, True)
+
+        score = np.mean(np.abs(self.change_thumbnail - self.change_reference)) / full_scale
+        changed = (score >= self.change_threshold)
+        if (changed):
+            np.copyto(self.change_reference, self.change_thumbnail)
+        return (score, changed)
+
+    def _share_frame(self, video_frame, frame_time, frame_seq):
+        """
+        Publish a frame to the other processes (creating the shared ring from the first frame's size)
+        """
+        if (self.frame_share is None):
+            self.frame_share = MamboFrameSharePublisher(self.frame_share_name, video_frame.shape,
+                                                        self.frame_share_slots)
+        self.frame_share.publish(video_frame, frame_time, frame_seq)
+
+    def _close_frame_share(self):
+        if (self.frame_share is not None):
+            self.frame_share.close()
+            self.frame_share = None
+
+    def _view(self, index):
+        """
+        :return: read only view of a slot in the buffer
+        """
+        view = self.buffer[index]
+        view.flags.writeable = False
+        return view
+
+    def get_latest_valid_picture(self, copy=True):
         """
         Return the latest valid image (from the buffer)
 
-        :return: last valid image received from the Mambo
+        :param copy: if True (default), return a copy of the image that you can keep and draw on.  If False,
+        return a read only view into the buffer (no copy) which stays valid until buffer_size - 1 newer frames
+        arrive (see get_latest_frame).
+        :return: last valid image received from the Mambo (None before the first frame)
+        """
+        with self.new_frame:
+            if (self.frame_seq == 0):
+                return None
+            if (copy):
+                return self.buffer[self.buffer_index].copy()
+            return self._view(self.buffer_index)
+
+    def get_latest_frame(self):
+        """
+        Return the latest valid image along with its sequence number and capture time.  The image is a read only
+        view into the buffer (no copy) which stays valid until buffer_size - 1 newer frames arrive.  Use
+        copy_latest_frame (or np.copy) to keep it longer or change it.
+
+        :return: (frame_seq, frame_time, image).  frame_seq is 0 (and the image None) until the first frame arrives.
+        """
+        with self.new_frame:
+            if (self.frame_seq == 0):
+                return (0, None, None)
+            return (self.frame_seq, self.frame_time, self._view(self.buffer_index))
+
+    def copy_latest_frame(self, out):
+        """
+        Copy the latest valid image into an array you own (so it can be kept or changed without allocating)
+
+        :param out: numpy array with the same shape and dtype as the frames
+        :return: (frame_seq, frame_time) of the copied frame or None before the first frame
         """
-        return self.buffer[self.buffer_index]
+        with self.new_frame:
+            if (self.frame_seq == 0):
+                return None
+            # the capture thread only decodes into the slot after buffer_index and needs the lock to move on,
+            # so the latest slot can't change during the copy
+            np.copyto(out, self.buffer[self.buffer_index])
+            return (self.frame_seq, self.frame_time)
+
+    def get_recent_frames(self, count=None):
+        """
+        Return the frames in the buffer, oldest first, as read only views (valid until the capture thread wraps
+        around to their slot)
+
+        :param count: maximum number of frames (defaults to the whole buffer)
+        :return: list of (frame_seq, frame_time, image)
+        """
+        if (count is None or count > self.buffer_size - 1):
+            # the slot after buffer_index may be in the middle of being decoded
+            count = self.buffer_size - 1
+
+        frames = list()
+        with self.new_frame:
+            for offset in range(count - 1, -1, -1):
+                index = (self.buffer_index - offset) % self.buffer_size
+                if (self.buffer_seqs[index] > 0):
+                    frames.append((int(self.buffer_seqs[index]), self.buffer_times[index], self._view(index)))
+        return frames
+
+    def enable_change_detection(self, threshold=0.02, scale=8):
+        """
+        Score every saved frame by how much it differs from the last significantly changed frame so expensive
+        processing can skip frames where nothing happened (e.g. while hovering).  Use wait_for_changed_frame to get
+        only the frames that changed.  The score uses a thumbnail (every scale-th pixel) so it costs much less
+        than decoding the frame.
+
+        :param threshold: score (mean absolute difference as a fraction of full scale) that counts as changed
+        :param scale: take every scale-th pixel in each direction for the thumbnail
+        """
+        self.change_scale = scale
+        self.change_reference = None
+        self.change_threshold = threshold
+
+    def disable_change_detection(self):
+        """
+        Stop scoring the frames
+        """
+        self.change_threshold = None
+
+    def _wait_locked(self, seq_name, last_seq, timeout):
+        """
+        Wait (holding new_frame) until the attribute seq_name is larger than last_seq
+
+        :return: True if it is and False if the timeout ran out
+        """
+        if (timeout is not None):
+            end_time = time.time() + timeout
+
+        while (getattr(self, seq_name) <= last_seq):
+            if (timeout is None):
+                self.new_frame.wait()
+            else:
+                remaining = end_time - time.time()
+                if (remaining <= 0):
+                    return False
+                self.new_frame.wait(remaining)
+        return True
+
+    def wait_for_changed_frame(self, timeout=None, last_seq=None):
+        """
+        Block until a significantly changed frame newer than last_seq is saved (call enable_change_detection first)
+
+        :param timeout: maximum seconds to wait (None waits forever)
+        :param last_seq: sequence number of the last frame you processed.  Defaults to the latest frame when this is
+        called.
+        :return: (frame_seq, frame_time, image, score) or None if nothing changed before the timeout.  The image is a
+        read only view as in get_latest_frame.
+        """
+        if (self.change_threshold is None):
+            raise RuntimeError("call enable_change_detection before waiting for changed frames")
+
+        with self.new_frame:
+            if (last_seq is None):
+                last_seq = self.frame_seq
+            if (not self._wait_locked("change_seq", last_seq, timeout)):
+                return None
+
+            index = self.change_index
+            if (self.buffer_seqs[index] != self.change_seq):
+                # the changed frame has been (or is being) overwritten so the latest frame is the best we have
+                index = self.buffer_index
+            return (int(self.buffer_seqs[index]), self.buffer_times[index], self._view(index),
+                    self.buffer_scores[index])
+
+    def wait_for_new_frame(self, timeout=None, last_seq=None):
+        """
+        Block until a frame newer than last_seq is saved to the buffer
+
+        :param timeout: maximum seconds to wait (None waits forever)
+        :param last_seq: sequence number of the last frame you have seen (from get_latest_frame or an earlier
+        call).  Defaults to the latest frame when this is called (so it waits for the next one).
+        :return: (frame_seq, frame_time, image) or None if no new frame arrived before the timeout.  The image is a
+        read only view as in get_latest_frame.
+        """
+        with self.new_frame:
+            if (last_seq is None):
+                last_seq = self.frame_seq
+            if (not self._wait_locked("frame_seq", last_seq, timeout)):
+                return None
+
+            return (self.frame_seq, self.frame_time, self._view(self.buffer_index))
 
     def stop_vision_buffering(self):
         """
         Should stop the vision thread
         """
         self.vision_running = False
-    
+
+    def start_frame_sharing(self, name="mambo_frames", slots=4):
+        """
+        Publish every saved frame into shared memory so other processes can read them with a
+        MamboFrameShareClient (see MamboFrameShare.py) instead of opening the stream again.  The ring is created
+        when the next frame arrives.
+
+        :param name: name of the shared ring (the clients use the same name)
+        :param slots: number of frames kept in the ring
+        """
+        self.frame_share_slots = slots
+        self.frame_share_name = name
+
+    def stop_frame_sharing(self):
+        """
+        Stop publishing frames and remove the shared ring
+        """
+        self.frame_share_name = None
+        if (not self.vision_thread.is_alive()):
+            self._close_frame_share()
+
+    def start_recording(self, directory, segment_seconds=300, passthrough=False, **kwargs):
+        """
+        Record the video to disk on a background thread (see MamboRecorder.py).  Recording never makes the
+        capture thread wait: if the disk can't keep up, frames are dropped and counted.
+
+        :param directory: folder for the recording segments
+        :param segment_seconds: start a new file after this many seconds
+        :param passthrough: if True, copy the stream with ffmpeg without re-encoding it (needs ffmpeg and opens a
+        second connection to the stream).  If False, the saved frames are encoded (at fps).
+        :param kwargs: other MamboRecorder options (segment_bytes, queue_size, codec, extension)
+        :return: the MamboRecorder (get_stats() reports the frames written and dropped)
+        """
+        self.stop_recording()
+        recorder = MamboRecorder(directory, fps=self.fps, segment_seconds=segment_seconds, passthrough=passthrough,
+                                 stream_url=self.stream_url, **kwargs)
+        recorder.start()
+        self.recorder = recorder
+        return recorder
+
+    def stop_recording(self):
+        """
+        Stop recording (the frames already queued are still written)
+        """
+        recorder = self.recorder
+        self.recorder = None
+        if (recorder is not None):
+            recorder.stop()
+
+    def create_pipeline(self, metrics=None):
+        """
+        Create a processing pipeline fed with the frames from this object (see MamboVisionPipeline.py).  Add the
+        stages and call start() on it once the video is buffering.
+
+        :param metrics: optional MamboMetrics for the stage statistics (e.g. mambo.metrics)
+        :return: the MamboVisionPipeline
+        """
+        return MamboVisionPipeline(self, metrics=metrics)
+
+    def create_governor(self, target_latency=0.2, metrics=None, **kwargs):
+        """
+        Create a governor that adjusts fps, downscale and roi to keep the latency under a target (see
+        MamboVisionGovernor.py).  Call start() on it and report each frame you finish with frame_done(frame_time).
+
+        :param target_latency: seconds from capture until your code finishes with a frame
+        :param metrics: optional MamboMetrics for the governor's decisions (e.g. mambo.metrics)
+        :param kwargs: other MamboVisionGovernor options (max_fps, roi, levels, interval, ...)
+        :return: the MamboVisionGovernor
+        """
+        return MamboVisionGovernor(self, target_latency=target_latency, metrics=metrics, **kwargs)
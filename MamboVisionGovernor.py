@@ -0,0 +1,244 @@
+"""
+MamboVisionGovernor tunes MamboVision while it runs so the same code works on a Raspberry Pi 3 and on a
+desktop without picking fps by hand.  It watches
+
+* the end to end latency: the age of each frame when your code finishes with it (call frame_done)
+* the depth of the pipeline queues (if you use a MamboVisionPipeline)
+* the CPU temperature and load
+
+and moves up or down a ladder of settings (capture rate, downscale factor and region of interest cropping),
+from full quality at the top to the cheapest setting at the bottom, to keep the latency under a target.  It
+steps down as soon as the host can't keep up and only steps back up after things have been calm for a while,
+so it doesn't oscillate.
+
+    governor = vision.create_governor(target_latency=0.15, metrics=mambo.metrics)
+    governor.start()
+    while True:
+        (frame_seq, frame_time, image) = vision.wait_for_new_frame(timeout=1.0)
+        ... process the image ...
+        governor.frame_done(frame_time)
+
+The decisions are exposed as gauges and counters in the metrics (vision_governor_level, vision_governor_fps,
+vision_governor_downscale, vision_governor_roi, vision_governor_latency_seconds, host_cpu_temperature_celsius,
+host_load and vision_governor_changes_total) and the recent ones are kept in governor.decisions.
+
+Downscaling or cropping changes the size of the saved frames: the frame buffer is reallocated when that happens.
+"""
+import collections
+import multiprocessing
+import os
+import threading
+import time
+
+from MamboMetrics import MamboMetrics
+
+# the ladder of settings from best quality to cheapest: (fraction of max_fps, downscale factor, crop to roi)
+DEFAULT_GOVERNOR_LEVELS = (
+    (1.0, 1.0, False),
+    (0.75, 1.0, False),
+    (0.75, 1.5, False),
+    (0.5, 1.5, False),
+    (0.5, 2.0, False),
+    (0.5, 2.0, True),
+    (0.33, 2.0, True),
+    (0.25, 3.0, True),
+)
+
+CPU_TEMPERATURE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+
+
+class MamboVisionGovernor:
+    """
+    Adjusts a MamboVision's fps, downscale and roi to hit a target latency
+    """
+
+    def __init__(self, vision, target_latency=0.2, max_fps=None, roi=(0.2, 0.2, 0.6, 0.6),
+                 levels=DEFAULT_GOVERNOR_LEVELS, interval=1.0, hold_intervals=5, max_queue_depth=1,
+                 max_temperature=75.0, max_load=0.9, metrics=None):
+        """
+        :param vision: the MamboVision to tune
+        :param target_latency: seconds from capture until frame_done that the governor aims to stay under
+        :param max_fps: the highest capture rate (defaults to the vision's fps when the governor is created)
+        :param roi: region kept by the levels that crop: (x, y, width, height) as fractions of the frame
+        :param levels: ladder of (fraction of max_fps, downscale, crop) from best to cheapest
+        :param interval: seconds between decisions
+        :param hold_intervals: calm decisions needed in a row before stepping back up
+        :param max_queue_depth: step down if more items than this are waiting in the pipeline queues
+        :param max_temperature: step down if the CPU is hotter than this (celsius)
+        :param max_load: step down if the 1 minute load average per core is above this
+        :param metrics: MamboMetrics for the decisions (a new one is created if this is None)
+        """
+        self.vision = vision
+        self.target_latency = target_latency
+        if (max_fps is None):
+            max_fps = vision.fps
+        self.max_fps = max_fps
+        self.roi = roi
+        self.levels = levels
+        self.interval = interval
+        self.hold_intervals = hold_intervals
+        self.max_queue_depth = max_queue_depth
+        self.max_temperature = max_temperature
+        self.max_load = max_load
+        if (metrics is None):
+            metrics = MamboMetrics()
+        self.metrics = metrics
+
+        self.level = 0
+        self.calm_count = 0
+        self.cpu_count = multiprocessing.cpu_count()
+        self.pipeline = None
+
+        # latencies reported by frame_done since the last decision
+        self.latency_lock = threading.Lock()
+        self.latencies = list()
+
+        # recent decisions: (time, level, reason)
+        self.decisions = collections.deque(maxlen=100)
+
+        self.running = False
+        self.governor_thread = None
+
+    def watch_pipeline(self, pipeline):
+        """
+        Include the queue depth of a MamboVisionPipeline in the decisions (and its end to end latency if you
+        don't call frame_done)
+
+        :param pipeline: the pipeline
+        """
+        self.pipeline = pipeline
+        pipeline.set_result_callback(lambda frame_seq, frame_time, result: self.frame_done(frame_time))
+
+    def frame_done(self, frame_time):
+        """
+        Report that your code has finished with a frame
+
+        :param frame_time: capture time of the frame (from get_latest_frame or wait_for_new_frame)
+        """
+        latency = time.time() - frame_time
+        with self.latency_lock:
+            self.latencies.append(latency)
+
+    def _read_temperature(self):
+        """
+        :return: CPU temperature in celsius or None if it isn't available
+        """
+        try:
+            with open(CPU_TEMPERATURE_PATH) as temperature_file:
+                return int(temperature_file.read().strip()) / 1000.0
+        except (IOError, ValueError):
+            return None
+
+    def _queue_depth(self):
+        if (self.pipeline is None):
+            return 0
+        return sum([len(stage.input.items) for stage in self.pipeline.stages])
+
+    def apply_level(self, level):
+        """
+        Change the vision settings to a level of the ladder
+
+        :param level: index into levels (0 is the best quality)
+        """
+        level = min(max(level, 0), len(self.levels) - 1)
+        (fps_fraction, downscale, crop) = self.levels[level]
+        self.level = level
+        self.vision.fps = max(self.max_fps * fps_fraction, 1.0)
+        self.vision.downscale = downscale
+        if (crop):
+            self.vision.roi = self.roi
+        else:
+            self.vision.roi = None
+
+        self.metrics.set_gauge("vision_governor_level", level)
+        self.metrics.set_gauge("vision_governor_fps", self.vision.fps)
+        self.metrics.set_gauge("vision_governor_downscale", downscale)
+        self.metrics.set_gauge("vision_governor_roi", 1 if crop else 0)
+
+    def decide(self):
+        """
+        Look at the measurements since the last decision and move along the ladder if needed
+
+        :return: the reason for the change or None if the level didn't change
+        """
+        with self.latency_lock:
+            latencies = self.latencies
+            self.latencies = list()
+
+        latency = None
+        if (len(latencies) > 0):
+            latency = sorted(latencies)[int(0.9 * (len(latencies) - 1))]
+            self.metrics.set_gauge("vision_governor_latency_seconds", latency)
+
+        temperature = self._read_temperature()
+        if (temperature is not None):
+            self.metrics.set_gauge("host_cpu_temperature_celsius", temperature)
+        load = os.getloadavg()[0] / self.cpu_count
+        self.metrics.set_gauge("host_load", load)
+        depth = self._queue_depth()
+
+        # anything over its limit makes the governor step down right away
+        reason = None
+        if (latency is not None and latency > self.target_latency):
+            reason = "latency %.3f s over the target" % latency
+        elif (depth > self.max_queue_depth):
+            reason = "%d frames queued" % depth
+        elif (temperature is not None and temperature > self.max_temperature):
+            reason = "cpu at %.1f C" % temperature
+        elif (load > self.max_load):
+            reason = "load %.2f per core" % load
+
+        if (reason is not None):
+            self.calm_count = 0
+            if (self.level < len(self.levels) - 1):
+                self._change(self.level + 1, "down", reason)
+                return reason
+            return None
+
+        # step back up once everything has been well under the limits for a while
+        calm = ((latency is None or latency < 0.6 * self.target_latency) and depth == 0 and
+                (temperature is None or temperature < self.max_temperature - 5.0) and load < 0.8 * self.max_load)
+        if (not calm):
+            self.calm_count = 0
+            return None
+
+        self.calm_count += 1
+        if (self.calm_count >= self.hold_intervals and self.level > 0):
+            self.calm_count = 0
+            reason = "headroom (latency %s)" % ("unknown" if latency is None else "%.3f s" % latency)
+            self._change(self.level - 1, "up", reason)
+            return reason
+        return None
+
+    def _change(self, level, direction, reason):
+        self.apply_level(level)
+        self.metrics.increment("vision_governor_changes_total", labels={'direction': direction})
+        self.decisions.append((time.time(), level, reason))
+
+    def start(self):
+        """
+        Start adjusting the vision settings on a background thread (starting from the best quality level)
+        """
+        self.apply_level(0)
+        self.running = True
+        self.governor_thread = threading.Thread(target=self._run)
+        self.governor_thread.daemon = True
+        self.governor_thread.start()
+
+    def stop(self, restore=True):
+        """
+        Stop adjusting the settings
+
+        :param restore: if True (default), go back to the best quality level
+        """
+        self.running = False
+        if (self.governor_thread is not None):
+            self.governor_thread.join()
+            self.governor_thread = None
+        if (restore):
+            self.apply_level(0)
+
+    def _run(self):
+        while (self.running):
+            time.sleep(self.interval)
+            self.decide()
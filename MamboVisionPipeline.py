@@ -0,0 +1,299 @@
+"""
+MamboVisionPipeline runs vision processing (detection, tracking, annotation, ...) as a chain of stages on
+their own threads (or processes) so the work never blocks the video capture or the flight control loop.
+
+Each stage is a function that takes the output of the previous stage (the first stage gets the image) and
+returns its output.  Stages are connected by small bounded queues that drop the oldest item when they are
+full: a slow stage always works on the newest frame it can get instead of falling further and further behind.
+
+    pipeline = vision.create_pipeline()
+    pipeline.add_stage("detect", find_blobs, workers=2, use_processes=True)
+    pipeline.add_stage("track", update_tracker)
+    pipeline.start()
+    ...
+    (frame_seq, frame_time, tracks) = pipeline.get_latest_result()
+
+Stages with use_processes=True run their function in a multiprocessing pool (use this for heavy work on a
+multi-core board).  Those functions have to be defined at the top level of a module so they can be pickled.
+
+Each stage records how long its function takes (pipeline_stage_seconds histogram), how many items it handled and how
+many were dropped in front of it.  get_stats() summarizes them including the throughput of each stage.
+
+A stage function that raises only loses that item: the error is printed, counted in pipeline_errors_total and
+the worker goes on with the next item.
+"""
+import collections
+import multiprocessing
+import threading
+import time
+
+from MamboCondition import MamboCondition
+from MamboMetrics import MamboMetrics
+
+
+class MamboDropQueue:
+    """
+    Bounded queue that drops the oldest item when a new one is put into a full queue
+    """
+
+    def __init__(self, maxsize):
+        self.items = collections.deque(maxlen=maxsize)
+        # wakes a waiting worker as soon as an item is put (see MamboCondition.py)
+        self.not_empty = MamboCondition()
+
+    def put(self, item):
+        """
+        Add an item (dropping the oldest one if the queue is full)
+
+        :return: True if an item was dropped and False otherwise
+        """
+        with self.not_empty:
+            dropped = (len(self.items) == self.items.maxlen)
+            self.items.append(item)
+            self.not_empty.notify()
+        return dropped
+
+    def get(self, timeout):
+        """
+        Remove and return the oldest item
+
+        :param timeout: seconds to wait for an item
+        :return: the item or None if the queue stayed empty
+        """
+        with self.not_empty:
+            if (len(self.items) == 0):
+                self.not_empty.wait(timeout)
+                if (len(self.items) == 0):
+                    return None
+            return self.items.popleft()
+
+
+class MamboPipelineStage:
+    """
+    One stage of the pipeline (created with MamboVisionPipeline.add_stage)
+    """
+
+    def __init__(self, name, function, workers, use_processes, queue_size):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.use_processes = use_processes
+        self.input = MamboDropQueue(queue_size)
+
+        # the next stage (None for the last stage)
+        self.next_stage = None
+
+        self.pool = None
+        self.threads = list()
+
+
+class MamboVisionPipeline:
+    """
+    Chain of processing stages fed with the newest frames from a MamboVision object
+    """
+
+    def __init__(self, vision, metrics=None, copy_frames=True, debug_level=10):
+        """
+        :param vision: MamboVision object that is capturing video
+        :param metrics: MamboMetrics to record the stage statistics in (a new one is created if this is None).  Pass
+        mambo.metrics to export them with the rest of the drone's metrics.
+        :param copy_frames: if True (default), copy each frame out of the vision buffer before it enters the
+        pipeline.  The buffer slots are reused after buffer_size frames so only turn this off if every stage is
+        quicker than that.
+        :param debug_level: only print messages at this level or above (as in Mambo, errors are level 10).  None
+        prints nothing.
+        """
+        self.vision = vision
+        if (metrics is None):
+            metrics = MamboMetrics()
+        self.metrics = metrics
+        self.copy_frames = copy_frames
+        self.debug_level = debug_level
+
+        self.stages = list()
+        self.running = False
+        self.feeder_thread = None
+        self.start_time = None
+
+        # output of the last stage for the newest frame
+        self.result_lock = threading.Lock()
+        self.latest_result = (0, None, None)
+        self.result_callback = None
+
+    def add_stage(self, name, function, workers=1, use_processes=False, queue_size=2):
+        """
+        Add a stage to the end of the pipeline (before calling start)
+
+        :param name: name of the stage (used in the statistics)
+        :param function: function called with the output of the previous stage (or the image for the first stage).
+        Returning None drops the item (e.g. nothing was detected).
+        :param workers: number of items this stage works on at once
+        :param use_processes: if True, run the function in a pool of workers processes instead of threads
+        :param queue_size: maximum number of items waiting for this stage (the oldest is dropped after that)
+        :return: the stage
+        """
+        if (self.running):
+            raise RuntimeError("add the stages before starting the pipeline")
+
+        stage = MamboPipelineStage(name, function, workers, use_processes, queue_size)
+        if (len(self.stages) > 0):
+            self.stages[-1].next_stage = stage
+        self.stages.append(stage)
+        return stage
+
+    def set_result_callback(self, callback):
+        """
+        Call a function with (frame_seq, frame_time, result) for every output of the last stage.  It runs on the
+        last stage's worker threads so keep it quick.
+
+        :param callback: the function (or None to remove it)
+        """
+        self.result_callback = callback
+
+    def start(self):
+        """
+        Start the stage workers and the thread that feeds them new frames
+        """
+        if (len(self.stages) == 0):
+            raise RuntimeError("the pipeline needs at least one stage")
+
+        self.running = True
+        self.start_time = time.time()
+        for stage in self.stages:
+            if (stage.use_processes):
+                stage.pool = multiprocessing.Pool(stage.workers)
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self._run_stage, args=(stage,))
+                thread.daemon = True
+                thread.start()
+                stage.threads.append(thread)
+
+        self.feeder_thread = threading.Thread(target=self._feed_frames)
+        self.feeder_thread.daemon = True
+        self.feeder_thread.start()
+
+    def stop(self):
+        """
+        Stop the pipeline (waits for the items being worked on to finish)
+        """
+        self.running = False
+        if (self.feeder_thread is not None):
+            self.feeder_thread.join()
+        for stage in self.stages:
+            for thread in stage.threads:
+                thread.join()
+            stage.threads = list()
+            if (stage.pool is not None):
+                stage.pool.terminate()
+                stage.pool = None
+
+    def _debug_print(self, print_str, level):
+        """
+        Print a message if its level is at least debug_level (errors in red as in Mambo)
+        """
+        if (self.debug_level is None or level < self.debug_level):
+            return
+        if (level >= 10):
+            print('\033[38;5;196m' + print_str + '\033[0m')
+        else:
+            print(print_str)
+
+    def _put(self, stage, item):
+        if (stage.input.put(item)):
+            self.metrics.increment("pipeline_dropped_total", labels={'stage': stage.name})
+
+    def _feed_frames(self):
+        """
+        Thread that sends every new frame from the vision object into the first stage
+        """
+        first_stage = self.stages[0]
+        last_seq = None
+        while (self.running):
+            frame = self.vision.wait_for_new_frame(timeout=0.5, last_seq=last_seq)
+            if (frame is None):
+                continue
+
+            (last_seq, frame_time, image) = frame
+            if (self.copy_frames):
+                image = image.copy()
+            self._put(first_stage, (last_seq, frame_time, image))
+
+    def _run_stage(self, stage):
+        """
+        Worker thread for a stage
+        """
+        labels = {'stage': stage.name}
+        while (self.running):
+            item = stage.input.get(0.5)
+            if (item is None):
+                continue
+
+            (frame_seq, frame_time, value) = item
+            start = time.time()
+            try:
+                if (stage.pool is not None):
+                    result = stage.pool.apply(stage.function, (value,))
+                else:
+                    result = stage.function(value)
+            except Exception as error:
+                # one bad frame must not stop the stage (and every stage after it)
+                self._debug_print("pipeline stage %s failed on frame %d: %s: %s" %
+                                  (stage.name, frame_seq, type(error).__name__, error), 10)
+                self.metrics.increment("pipeline_errors_total", labels=labels)
+                continue
+            end = time.time()
+
+            self.metrics.record("pipeline_stage_seconds", end - start, labels=labels)
+            self.metrics.increment("pipeline_processed_total", labels=labels)
+            if (result is None):
+                continue
+
+            if (stage.next_stage is not None):
+                self._put(stage.next_stage, (frame_seq, frame_time, result))
+            else:
+                self.metrics.record("pipeline_frame_latency_seconds", end - frame_time)
+                self._save_result(frame_seq, frame_time, result)
+
+    def _save_result(self, frame_seq, frame_time, result):
+        with self.result_lock:
+            # workers can finish out of order so only keep newer frames
+            if (frame_seq > self.latest_result[0]):
+                self.latest_result = (frame_seq, frame_time, result)
+        callback = self.result_callback
+        if (callback is not None):
+            try:
+                callback(frame_seq, frame_time, result)
+            except Exception as error:
+                self._debug_print("pipeline result callback failed on frame %d: %s: %s" %
+                                  (frame_seq, type(error).__name__, error), 10)
+                self.metrics.increment("pipeline_errors_total", labels={'stage': "result_callback"})
+
+    def get_latest_result(self):
+        """
+        :return: (frame_seq, frame_time, result) for the newest frame through the whole pipeline (frame_seq is 0
+        until the first result)
+        """
+        with self.result_lock:
+            return self.latest_result
+
+    def get_stats(self):
+        """
+        Summary of each stage
+
+        :return: dictionary of stage name to a dictionary with 'processed', 'dropped', 'errors' (items the function
+        raised on), 'throughput' (items per second since start) and 'latency' (histogram snapshot of the stage function's time in seconds)
+        """
+        elapsed = max(time.time() - self.start_time, 1e-6) if self.start_time is not None else None
+        stats = dict()
+        for stage in self.stages:
+            labels = {'stage': stage.name}
+            processed = self.metrics.get_counter("pipeline_processed_total", labels=labels)
+            latency = self.metrics.get_histogram_snapshot("pipeline_stage_seconds", labels=labels)
+            stats[stage.name] = {
+                'processed': processed,
+                'dropped': self.metrics.get_counter("pipeline_dropped_total", labels=labels),
+                'errors': self.metrics.get_counter("pipeline_errors_total", labels=labels),
+                'throughput': processed / elapsed if elapsed is not None else 0.0,
+                'latency': latency
+            }
+        return stats
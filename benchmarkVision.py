@@ -0,0 +1,133 @@
+"""
+Benchmark MamboVision without the drone: runs the capture against a synthetic source (or a video file, camera
+or stream) for a range of fps and buffer_size settings and reports, for each one:
+
+* decode fps (frames decoded per second) and the source rate (frames grabbed per second)
+* capture to consumer latency (age of each frame when the consumer gets it, including time spent on --work)
+* frames the consumer missed (newer frames arrived before it got to them)
+* CPU use of this process (percent of one core) and its memory while the setting runs (the resident size at
+  the end of the run and how much it grew during the run, read from /proc/self/statm so it is only reported on
+  linux)
+
+Use it to pick fps and buffer_size for a Raspberry Pi before flying, e.g.
+
+    python benchmarkVision.py --source synthetic:640x360@30 --fps 5 10 15 --buffer-size 2 10 --work 0.05
+
+--work simulates a consumer that spends that many seconds processing each frame.
+"""
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+from MamboVision import MamboVision
+
+
+def current_rss_mb():
+    """
+    :return: the current resident memory of this process in MB (nan if /proc isn't available)
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return float('nan')
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+
+
+def run_benchmark(source, fps, buffer_size, duration, work):
+    """
+    Run MamboVision with one setting and measure it
+
+    :return: dictionary of the results
+    """
+    start_rss = current_rss_mb()
+    vision = MamboVision(fps=fps, buffer_size=buffer_size, source=source)
+    if (not vision.open_video()):
+        raise IOError("could not open the video source %s" % source)
+    vision.start_video_buffering()
+
+    # wait for the first frame so opening the source isn't part of the measurement
+    first = vision.wait_for_new_frame(timeout=10.0, last_seq=0)
+    if (first is None):
+        raise IOError("no frames from the video source %s" % source)
+
+    latencies = list()
+    consumed = [0, 0]
+
+    def consume():
+        last_seq = first[0]
+        end_time = time.time() + duration
+        while (time.time() < end_time):
+            frame = vision.wait_for_new_frame(timeout=1.0, last_seq=last_seq)
+            if (frame is None):
+                continue
+            latencies.append(time.time() - frame[1])
+            consumed[0] += 1
+            consumed[1] += frame[0] - last_seq - 1
+            last_seq = frame[0]
+            if (work > 0):
+                time.sleep(work)
+
+    start_grabbed = vision.frames_grabbed
+    start_decoded = vision.frames_decoded
+    start_cpu = os.times()
+    start_time = time.time()
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    consumer.join()
+
+    elapsed = time.time() - start_time
+    end_cpu = os.times()
+    grabbed = vision.frames_grabbed - start_grabbed
+    decoded = vision.frames_decoded - start_decoded
+    # measured while the buffers are still allocated
+    end_rss = current_rss_mb()
+
+    vision.stop_vision_buffering()
+    vision.vision_thread.join()
+    vision.capture.release()
+
+    latencies = np.array(latencies) * 1000.0
+    return {
+        'fps': fps,
+        'buffer_size': buffer_size,
+        'source_fps': grabbed / elapsed,
+        'decode_fps': decoded / elapsed,
+        'consumed': consumed[0],
+        'missed': consumed[1],
+        'latency_p50': np.percentile(latencies, 50) if len(latencies) else float('nan'),
+        'latency_p99': np.percentile(latencies, 99) if len(latencies) else float('nan'),
+        'cpu': 100.0 * ((end_cpu[0] - start_cpu[0]) + (end_cpu[1] - start_cpu[1])) / elapsed,
+        'rss_mb': end_rss,
+        'rss_growth_mb': end_rss - start_rss
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark MamboVision capture and buffering")
+    parser.add_argument("--source", default="synthetic:640x360@30",
+                        help="synthetic[:WIDTHxHEIGHT@FPS], a video file, a URL or a camera index")
+    parser.add_argument("--fps", type=float, nargs="+", default=[5, 10, 15, 30])
+    parser.add_argument("--buffer-size", type=int, nargs="+", default=[2, 10])
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds to measure each setting")
+    parser.add_argument("--work", type=float, default=0.0, help="seconds the consumer spends on each frame")
+    args = parser.parse_args()
+
+    source = args.source
+    if (source.isdigit()):
+        source = int(source)
+
+    print "%6s %6s %10s %10s %9s %7s %9s %9s %6s %7s %8s" % ("fps", "buffer", "source fps", "decode fps",
+                                                              "consumed", "missed", "p50 (ms)", "p99 (ms)", "cpu %",
+                                                              "rss MB", "+rss MB")
+    for fps in args.fps:
+        for buffer_size in args.buffer_size:
+            result = run_benchmark(source, fps, buffer_size, args.duration, args.work)
+            print "%6.1f %6d %10.1f %10.1f %9d %7d %9.2f %9.2f %6.1f %7.1f %8.1f" % (
+                result['fps'], result['buffer_size'], result['source_fps'], result['decode_fps'],
+                result['consumed'], result['missed'], result['latency_p50'], result['latency_p99'], result['cpu'],
+                result['rss_mb'], result['rss_growth_mb'])
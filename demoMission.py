@@ -0,0 +1,34 @@
+"""
+Demo running a mission plan (demoMission.json) with the pymambo interface
+"""
+
+from Mambo import Mambo
+from MamboMission import MamboMission
+
+# you will need to change this to the address of YOUR mambo
+mamboAddr = "e0:14:d0:63:3d:d0"
+
+# make my mambo object
+mambo = Mambo(mamboAddr)
+
+print "trying to connect"
+success = mambo.connect(num_retries=3)
+print "connected: %s" % success
+
+# get the state information
+print "sleeping"
+mambo.smart_sleep(2)
+mambo.ask_for_state_update()
+mambo.smart_sleep(2)
+
+# check and compile the whole mission before taking off
+mission = MamboMission(mambo)
+mission.load("demoMission.json")
+
+print "running the mission"
+results = mission.run()
+for (name, success, start, duration) in results:
+    print "step %s: success %s, started at %0.2f, took %0.2f seconds" % (name, success, start, duration)
+
+print "disconnect"
+mambo.disconnect()
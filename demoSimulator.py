@@ -0,0 +1,36 @@
+"""
+Demo flying the pymambo interface against the simulator (no drone needed)
+"""
+
+from Mambo import Mambo
+from MamboSimulator import MamboFleetSimulator, SimulatedPeripheral
+
+# make a simulated fleet with one drone in it
+fleet = MamboFleetSimulator(num_drones=1)
+
+# make my mambo object and point it at the simulated drone instead of BLE
+mambo = Mambo("simulated")
+mambo.drone = SimulatedPeripheral(fleet, index=0)
+
+print "trying to connect"
+success = mambo.connect(num_retries=3)
+print "connected: %s" % success
+
+print "taking off!"
+mambo.safe_takeoff(5)
+print mambo.sensors
+
+print "Flying direct: going forward (positive pitch)"
+mambo.fly_direct(roll=0, pitch=50, yaw=0, vertical_movement=0, duration=1)
+print mambo.sensors
+
+print "Flying direct: yaw"
+mambo.fly_direct(roll=0, pitch=0, yaw=50, vertical_movement=0, duration=1)
+print mambo.sensors
+
+print "landing"
+mambo.safe_land()
+print mambo.sensors
+
+print "disconnect"
+mambo.disconnect()
@@ -0,0 +1,79 @@
+"""
+Demo stepping a MamboVisionGovernor through its levels while the frames are shared and recorded (no drone
+needed: it uses the synthetic video source).  Each downscale or crop changes the frame size, so this checks that
+
+* a MamboFrameShareClient keeps getting frames of the new size (the shared ring is replaced and it re-attaches)
+* the recorder starts a new segment for each new size and doesn't grow its buffer pool
+
+It prints what happens at each level and exits with an error if one of the checks fails.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from MamboVision import MamboVision
+from MamboFrameShare import MamboFrameShareClient
+
+failures = list()
+
+
+def check(condition, message):
+    if (not condition):
+        print "FAILED: %s" % message
+        failures.append(message)
+
+
+vision = MamboVision(fps=30, source="synthetic:640x360@30")
+vision.open_video()
+vision.start_video_buffering()
+
+directory = tempfile.mkdtemp(prefix="mambo_governor_")
+vision.start_frame_sharing("mambo_governor_demo")
+recorder = vision.start_recording(directory, queue_size=8)
+
+# wait for the first frame so the shared ring exists
+vision.wait_for_new_frame(timeout=5.0)
+client = MamboFrameShareClient("mambo_governor_demo")
+
+governor = vision.create_governor(max_fps=30)
+last_size = None
+sizes = 0
+for level in range(len(governor.levels)) + [0]:
+    governor.apply_level(level)
+    # let a few frames of the new size through
+    time.sleep(0.5)
+    frame = client.wait_for_new_frame(timeout=2.0)
+    check(frame is not None, "no shared frame at level %d" % level)
+    if (frame is None):
+        continue
+
+    (frame_seq, frame_time, image) = frame
+    local = vision.get_latest_frame()
+    print "level %d: downscale %.1f roi %s, saved frames %s, shared frames %s" % (
+        level, vision.downscale, vision.roi is not None, local[2].shape, image.shape)
+    check(image.shape == local[2].shape, "shared frame size %s isn't %s at level %d" %
+          (image.shape, local[2].shape, level))
+    if (image.shape != last_size):
+        sizes += 1
+        last_size = image.shape
+
+    pool = recorder.free_buffers.qsize() + recorder.frames.qsize()
+    check(pool <= recorder.queue_size, "recorder holds %d buffers (queue_size %d)" % (pool, recorder.queue_size))
+
+vision.stop_recording()
+vision.stop_frame_sharing()
+vision.stop_vision_buffering()
+client.close()
+
+stats = recorder.get_stats()
+print "recorded %d frames (%d dropped) into %d segments for %d frame sizes" % (
+    stats['frames_written'], stats['frames_dropped'], len(stats['segments']), sizes)
+check(len(stats['segments']) >= sizes, "only %d segments for %d frame sizes" % (len(stats['segments']), sizes))
+shutil.rmtree(directory, True)
+
+if (failures):
+    sys.exit(1)
+print "all checks passed"